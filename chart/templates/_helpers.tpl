@@ -0,0 +1,137 @@
+{{/*
+Environment shared by the API and the ingestion workers, each sets its own INGESTION_WORKERS.
+*/}}
+{{- define "rag.env" -}}
+- name: OPENAI_API_BASE
+  value: "{{ .Values.env.openaiApiBase }}"
+- name: OPENAI_API_KEY
+  value: "{{ .Values.env.openaiApiKey }}"
+- name: MODEL
+  value: "{{ .Values.env.model }}"
+- name: TEMPERATURE
+  value: "{{ .Values.env.temperature }}"
+- name: CONTEXT_WINDOW
+  value: "{{ .Values.env.contextWindow }}"
+- name: MAX_OUTPUT
+  value: "{{ .Values.env.maxOutput }}"
+- name: CHUNK_SIZE
+  value: "{{ .Values.env.chunkSize }}"
+- name: OVERLAP_SIZE
+  value: "{{ .Values.env.overlapSize }}"
+- name: RESPONSE_MODE
+  value: "{{ .Values.env.responseMode }}"
+- name: SSL_VERIFICATION
+  value: "{{ .Values.env.sslVerification }}"
+- name: PREFIX
+  value: "{{ .Values.env.prefix }}"
+- name: EMBEDDING_MODEL_NAME
+  value: "{{ .Values.env.embeddingModelName }}"
+- name: TOP_K
+  value: "{{ .Values.env.topK }}"
+- name: INGESTION_QUEUE_SIZE
+  value: "{{ .Values.env.ingestionQueueSize }}"
+- name: PARSER_WORKERS
+  value: "{{ .Values.env.parserWorkers }}"
+- name: EMBEDDING_BATCH_SIZE
+  value: "{{ .Values.env.embeddingBatchSize }}"
+- name: EMBEDDING_CONCURRENCY
+  value: "{{ .Values.env.embeddingConcurrency }}"
+- name: EMBEDDING_CACHE_MAX_ENTRIES
+  value: "{{ .Values.env.embeddingCacheMaxEntries }}"
+- name: QUERY_CACHE_MAX_ENTRIES
+  value: "{{ .Values.env.queryCacheMaxEntries }}"
+- name: QUERY_CACHE_TTL
+  value: "{{ .Values.env.queryCacheTtl }}"
+- name: LLM_MAX_CONNECTIONS
+  value: "{{ .Values.env.llmMaxConnections }}"
+- name: QUERY_ENGINE_CACHE_SIZE
+  value: "{{ .Values.env.queryEngineCacheSize }}"
+- name: WARM_COLLECTIONS
+  value: "{{ .Values.env.warmCollections }}"
+- name: MAX_INFLIGHT_UPLOAD_BYTES
+  value: "{{ .Values.env.maxInflightUploadBytes }}"
+- name: RETRIEVAL_MODE
+  value: "{{ .Values.env.retrievalMode }}"
+- name: HNSW_SPACE
+  value: "{{ .Values.env.hnswSpace }}"
+- name: HNSW_M
+  value: "{{ .Values.env.hnswM }}"
+- name: HNSW_CONSTRUCTION_EF
+  value: "{{ .Values.env.hnswConstructionEf }}"
+- name: HNSW_SEARCH_EF
+  value: "{{ .Values.env.hnswSearchEf }}"
+- name: HNSW_BATCH_SIZE
+  value: "{{ .Values.env.hnswBatchSize }}"
+- name: HNSW_SYNC_THRESHOLD
+  value: "{{ .Values.env.hnswSyncThreshold }}"
+- name: RERANKER
+  value: "{{ .Values.env.reranker }}"
+- name: RERANK_CANDIDATES
+  value: "{{ .Values.env.rerankCandidates }}"
+- name: RERANKER_MODEL
+  value: "{{ .Values.env.rerankerModel }}"
+- name: MMR_THRESHOLD
+  value: "{{ .Values.env.mmrThreshold }}"
+- name: COMPACT_DIMENSIONS
+  value: "{{ .Values.env.compactDimensions }}"
+- name: RESCORE_OVERSAMPLE
+  value: "{{ .Values.env.rescoreOversample }}"
+- name: RECALL_TOLERANCE
+  value: "{{ .Values.env.recallTolerance }}"
+- name: SERVER_TIMING
+  value: "{{ .Values.env.serverTiming }}"
+- name: CHUNKING_STRATEGY
+  value: "{{ .Values.env.chunkingStrategy }}"
+- name: AUTO_CREATE_COLLECTIONS
+  value: "{{ .Values.env.autoCreateCollections }}"
+- name: INDEX_CACHE_MAX_BYTES
+  value: "{{ .Values.env.indexCacheMaxBytes }}"
+- name: CHROMA_BACKEND
+  value: "{{ .Values.env.chromaBackend }}"
+- name: CHROMA_HOST
+  value: "{{ .Values.env.chromaHost }}"
+- name: CHROMA_PORT
+  value: "{{ .Values.env.chromaPort }}"
+- name: CHROMA_SSL
+  value: "{{ .Values.env.chromaSsl }}"
+- name: INGESTION_QUEUE
+  value: "{{ .Values.env.ingestionQueue }}"
+- name: INGESTION_QUEUE_PATH
+  value: "{{ include "rag.sharedPath" (list . .Values.env.ingestionQueuePath "ingestion-queue.sqlite3") }}"
+- name: INGESTION_LEASE_SECONDS
+  value: "{{ .Values.env.ingestionLeaseSeconds }}"
+- name: SPOOL_DIRECTORY
+  value: "{{ include "rag.sharedPath" (list . .Values.env.spoolDirectory "spool") }}"
+- name: INGESTION_MAX_ATTEMPTS
+  value: "{{ .Values.env.ingestionMaxAttempts }}"
+- name: INGESTION_RETRY_SECONDS
+  value: "{{ .Values.env.ingestionRetrySeconds }}"
+- name: MAX_ARCHIVE_EXPANDED_BYTES
+  value: "{{ .Values.env.maxArchiveExpandedBytes }}"
+- name: MAX_ARCHIVE_MEMBERS
+  value: "{{ .Values.env.maxArchiveMembers }}"
+{{- end }}
+
+{{/*
+Claim mounted at sharedVolume.mountPath, the configured one or the rag-shared claim the chart creates for the sqlite
+queue so its journal and spooled uploads outlive the pod.
+*/}}
+{{- define "rag.sharedClaim" -}}
+{{- if .Values.sharedVolume.claimName -}}
+{{- .Values.sharedVolume.claimName -}}
+{{- else if eq .Values.env.ingestionQueue "sqlite" -}}
+rag-shared
+{{- end -}}
+{{- end }}
+
+{{/*
+A path that was set explicitly, otherwise the given name under the shared volume when there is one.
+*/}}
+{{- define "rag.sharedPath" -}}
+{{- $root := index . 0 -}}
+{{- $path := index . 1 -}}
+{{- if and (not $path) (include "rag.sharedClaim" $root) -}}
+{{- $path = printf "%s/%s" $root.Values.sharedVolume.mountPath (index . 2) -}}
+{{- end -}}
+{{- $path -}}
+{{- end }}
@@ -0,0 +1,112 @@
+import re
+from enum import Enum
+from typing import TYPE_CHECKING
+
+import tiktoken
+
+if TYPE_CHECKING:
+    from langchain.docstore.document import Document
+
+# Splits before the whitespace after a sentence and before every line break, so each segment keeps the whitespace
+# in front of it and is tokenized as it would be in place. Lines keep headings, list items and table rows whole.
+SEGMENT_BOUNDARY: re.Pattern = re.compile(r"(?<=[.!?])(?=\s)|(?=\n)")
+
+
+class ChunkingStrategy(str, Enum):
+    TOKEN = "token"
+    SENTENCE = "sentence"
+
+
+class TextChunker:
+    """Splits loaded pages into chunks of at most ``chunk_size`` tokens with one shared tokenizer.
+
+    Every page of a file is encoded in a single ``encode_batch`` call. The token strategy slices fixed windows
+    out of the token arrays and decodes them in a batch, giving the same chunks as langchain's
+    ``TokenTextSplitter``. The sentence strategy packs whole sentences and lines into chunks, only cutting a
+    segment that is longer than a chunk on its own, and overlaps chunks by whole segments.
+    """
+
+    def __init__(self, chunk_size: int, chunk_overlap: int, strategy: ChunkingStrategy = ChunkingStrategy.TOKEN,
+                 encoding_name: str = "gpt2"):
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.strategy = strategy
+        self.encoding: tiktoken.Encoding = tiktoken.get_encoding(encoding_name)
+
+    def encode(self, texts: list[str]) -> list[list[int]]:
+        # disallowed_special is set so that technical documents that contain special tokens can be loaded
+        return self.encoding.encode_batch(texts, disallowed_special=())
+
+    def windows(self, tokens: list[int]) -> list[list[int]]:
+        windows: list[list[int]] = []
+        start: int = 0
+        while start < len(tokens):
+            windows.append(tokens[start:start + self.chunk_size])
+            if start + self.chunk_size >= len(tokens):
+                break
+            start += self.chunk_size - self.chunk_overlap
+        return windows
+
+    def split_documents(self, documents: list["Document"]) -> tuple[list[str], list[dict]]:
+        if self.strategy is ChunkingStrategy.SENTENCE:
+            return self.split_sentences(documents)
+
+        windows: list[list[int]] = []
+        metadatas: list[dict] = []
+        for document, tokens in zip(documents, self.encode([document.page_content for document in documents])):
+            page_windows: list[list[int]] = self.windows(tokens)
+            windows.extend(page_windows)
+            metadatas.extend(dict(document.metadata) for _ in page_windows)
+        return self.encoding.decode_batch(windows), metadatas
+
+    def split_sentences(self, documents: list["Document"]) -> tuple[list[str], list[dict]]:
+        pages: list[list[str]] = [[segment for segment in SEGMENT_BOUNDARY.split(document.page_content)
+                                   if segment != ""] for document in documents]
+        segment_tokens: list[list[int]] = self.encode([segment for segments in pages for segment in segments])
+
+        contents: list[str] = []
+        metadatas: list[dict] = []
+        offset: int = 0
+        for document, segments in zip(documents, pages):
+            page_tokens: list[list[int]] = segment_tokens[offset:offset + len(segments)]
+            offset += len(segments)
+            for chunk in self.pack(segments, page_tokens):
+                contents.append(chunk)
+                metadatas.append(dict(document.metadata))
+        return contents, metadatas
+
+    def pack(self, segments: list[str], segment_tokens: list[list[int]]) -> list[str]:
+        chunks: list[str] = []
+        current: list[tuple[str, int]] = []
+        current_tokens: int = 0
+
+        def flush() -> None:
+            text: str = "".join(segment for segment, _ in current).strip()
+            if text != "":
+                chunks.append(text)
+
+        for segment, tokens in zip(segments, segment_tokens):
+            if len(tokens) > self.chunk_size:
+                # A segment longer than a chunk is cut into token windows of its own
+                flush()
+                current, current_tokens = [], 0
+                chunks.extend(text.strip() for text in self.encoding.decode_batch(self.windows(tokens))
+                              if text.strip() != "")
+                continue
+
+            if current_tokens + len(tokens) > self.chunk_size:
+                flush()
+                # Carry over the trailing segments that fit in the overlap
+                overlap: list[tuple[str, int]] = []
+                overlap_tokens: int = 0
+                for previous in reversed(current):
+                    if overlap_tokens + previous[1] > min(self.chunk_overlap, self.chunk_size - len(tokens)):
+                        break
+                    overlap.insert(0, previous)
+                    overlap_tokens += previous[1]
+                current, current_tokens = overlap, overlap_tokens
+
+            current.append((segment, len(tokens)))
+            current_tokens += len(tokens)
+        flush()
+        return chunks
@@ -0,0 +1,139 @@
+import os
+import sqlite3
+import threading
+from typing import Callable, Iterator
+
+import numpy as np
+from chromadb.api.models import Collection
+
+# Collection metadata key that marks a collection whose Chroma index holds projected vectors
+COMPACT_DIMENSIONS_KEY: str = "compact:dimensions"
+
+
+def distances(space: str, vectors: np.ndarray, queries: np.ndarray) -> np.ndarray:
+    # The distance functions Chroma's HNSW index uses for each space
+    if space == "ip":
+        return 1 - queries @ vectors.T
+    if space == "cosine":
+        vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        return 1 - queries @ vectors.T
+    return (queries ** 2).sum(axis=1)[:, None] - 2 * queries @ vectors.T + (vectors ** 2).sum(axis=1)[None, :]
+
+
+def compact_dimensions(collection: Collection) -> int | None:
+    dimensions = (collection.metadata or {}).get(COMPACT_DIMENSIONS_KEY)
+    return None if dimensions is None else int(dimensions)
+
+
+def collection_space(collection: Collection) -> str:
+    return (collection.metadata or {}).get("hnsw:space", "l2")
+
+
+class CompactVectors:
+    """Full-precision embeddings kept on disk for collections whose in-memory HNSW index is compact.
+
+    Chroma only stores float32 vectors, so a compact collection stores each embedding multiplied by a fixed
+    random orthonormal projection to fewer dimensions. Its resident index shrinks by the same factor, e.g. 768
+    to 192 dimensions is the footprint of int8 scalar quantization. Searches over-fetch candidates from the
+    compact index and re-score them exactly against the full vectors in SQLite, which are read from disk.
+    """
+
+    def __init__(self, embed_fn: Callable[[list[str]], list[list[float]]], path: str, oversample: int):
+        self.embed_fn = embed_fn
+        self.path = path
+        self.oversample = oversample
+        self.projections: dict[str, np.ndarray] = {}
+        self.lock: threading.Lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.connection: sqlite3.Connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS vectors (collection TEXT NOT NULL, chunk_id TEXT NOT NULL, "
+                                "vector BLOB NOT NULL, PRIMARY KEY (collection, chunk_id)) WITHOUT ROWID")
+        # The projection is stored rather than re-derived from a seed so it can't change under existing data
+        self.connection.execute("CREATE TABLE IF NOT EXISTS projections (collection TEXT PRIMARY KEY, "
+                                "rows INTEGER NOT NULL, columns INTEGER NOT NULL, matrix BLOB NOT NULL)")
+        self.connection.commit()
+
+    def projection(self, collection_name: str, dimensions: int, source_dimensions: int) -> np.ndarray:
+        with self.lock:
+            matrix: np.ndarray | None = self.projections.get(collection_name)
+            if matrix is not None:
+                return matrix
+            row = self.connection.execute("SELECT rows, columns, matrix FROM projections WHERE collection = ?",
+                                          (collection_name,)).fetchone()
+            if row is not None:
+                matrix = np.frombuffer(row[2], dtype=np.float32).reshape(row[0], row[1])
+            else:
+                # Orthonormal rows from the QR decomposition of a gaussian matrix
+                rows: int = min(dimensions, source_dimensions)
+                q, _ = np.linalg.qr(np.random.default_rng().standard_normal((source_dimensions, rows)))
+                matrix = np.ascontiguousarray(q.T, dtype=np.float32)
+                self.connection.execute("INSERT INTO projections VALUES (?, ?, ?, ?)",
+                                        (collection_name, rows, source_dimensions, matrix.tobytes()))
+                self.connection.commit()
+            self.projections[collection_name] = matrix
+            return matrix
+
+    def project(self, collection: Collection, vectors: np.ndarray) -> np.ndarray:
+        matrix: np.ndarray = self.projection(collection.name, compact_dimensions(collection), vectors.shape[-1])
+        return vectors @ matrix.T
+
+    def add(self, collection: Collection, contents: list[str], metadatas: list[dict], ids: list[str],
+            embeddings: list[list[float]] | None = None) -> None:
+        vectors: np.ndarray = np.array(self.embed_fn(contents) if embeddings is None else embeddings,
+                                       dtype=np.float32)
+        with self.lock:
+            self.connection.executemany("INSERT OR REPLACE INTO vectors VALUES (?, ?, ?)",
+                                        [(collection.name, chunk_id, vector.tobytes())
+                                         for chunk_id, vector in zip(ids, vectors)])
+            self.connection.commit()
+        collection.add(documents=contents, metadatas=metadatas, ids=ids,
+                       embeddings=self.project(collection, vectors).tolist())
+
+    def get(self, collection_name: str, ids: list[str]) -> dict[str, np.ndarray]:
+        vectors: dict[str, np.ndarray] = {}
+        with self.lock:
+            for start in range(0, len(ids), 500):
+                chunk_ids: list[str] = ids[start:start + 500]
+                rows: list[tuple] = self.connection.execute(
+                    f"SELECT chunk_id, vector FROM vectors WHERE collection = ? "
+                    f"AND chunk_id IN ({', '.join('?' * len(chunk_ids))})", [collection_name, *chunk_ids]).fetchall()
+                vectors.update((chunk_id, np.frombuffer(vector, dtype=np.float32)) for chunk_id, vector in rows)
+        return vectors
+
+    def iter_pages(self, collection_name: str, page_size: int = 10000) -> Iterator[tuple[list[str], np.ndarray]]:
+        after: str = ""
+        while True:
+            with self.lock:
+                rows: list[tuple] = self.connection.execute(
+                    "SELECT chunk_id, vector FROM vectors WHERE collection = ? AND chunk_id > ? ORDER BY chunk_id "
+                    "LIMIT ?", (collection_name, after, page_size)).fetchall()
+            if len(rows) == 0:
+                return
+            yield [row[0] for row in rows], np.array([np.frombuffer(row[1], dtype=np.float32) for row in rows])
+            after = rows[-1][0]
+
+    def rescore(self, collection: Collection, query_embedding: list[float], ids: list[str],
+                top_k: int) -> list[tuple[str, float]]:
+        # The top k candidates by exact distance to the full vectors, as Chroma would have computed it
+        vectors: dict[str, np.ndarray] = self.get(collection.name, ids)
+        found: list[str] = [chunk_id for chunk_id in ids if chunk_id in vectors]
+        if len(found) == 0:
+            return []
+        exact: np.ndarray = distances(collection_space(collection), np.array([vectors[i] for i in found]),
+                                      np.array([query_embedding], dtype=np.float32))[0]
+        return [(found[idx], float(exact[idx])) for idx in np.argsort(exact, kind="stable")[:top_k]]
+
+    def delete(self, collection_name: str, ids: list[str]) -> None:
+        with self.lock:
+            self.connection.executemany("DELETE FROM vectors WHERE collection = ? AND chunk_id = ?",
+                                        [(collection_name, chunk_id) for chunk_id in ids])
+            self.connection.commit()
+
+    def drop_collection(self, collection_name: str) -> None:
+        with self.lock:
+            self.connection.execute("DELETE FROM vectors WHERE collection = ?", (collection_name,))
+            self.connection.execute("DELETE FROM projections WHERE collection = ?", (collection_name,))
+            self.connection.commit()
+            self.projections.pop(collection_name, None)
@@ -0,0 +1,220 @@
+import base64
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Iterator
+
+from chromadb import GetResult
+from chromadb.api.models import Collection
+
+from generations import CollectionGenerations
+
+
+def encode_cursor(ingested_at: float, doc_uuid: str) -> str:
+    return base64.urlsafe_b64encode(json.dumps([ingested_at, doc_uuid]).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[float, str]:
+    try:
+        ingested_at, doc_uuid = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return float(ingested_at), str(doc_uuid)
+    except (ValueError, TypeError) as e:
+        raise ValueError(f"Invalid cursor {cursor}") from e
+
+
+def document_filter(collection_name: str, source_prefix: str | None, ingested_after: float | None,
+                    ingested_before: float | None) -> tuple[str, list]:
+    where: str = "collection = ?"
+    parameters: list = [collection_name]
+    if source_prefix is not None:
+        where += " AND substr(source, 1, ?) = ?"
+        parameters.extend([len(source_prefix), source_prefix])
+    if ingested_after is not None:
+        where += " AND ingested_at >= ?"
+        parameters.append(ingested_after)
+    if ingested_before is not None:
+        where += " AND ingested_at < ?"
+        parameters.append(ingested_before)
+    return where, parameters
+
+
+class DocumentRegistry:
+    """SQLite index of the documents in each collection and the Chroma chunk IDs that belong to them.
+
+    Documents are registered before their chunks are added to Chroma, so Chroma never holds chunks the
+    registry doesn't know about unless they were written by something else. When that happens (data from
+    before the registry existed, or direct writes) the collection is re-indexed from its chunk metadata.
+    With ``generations`` set, other processes write to the same Chroma server too, and a collection is
+    re-indexed when another process bumped its generation since the registry last matched it.
+    """
+
+    def __init__(self, path: str, generations: CollectionGenerations | None = None):
+        self.path = path
+        self.generations = generations
+        # Generation of each collection the registry matches, and documents this process is still writing
+        self.synced: dict[str, int] = {}
+        self.writing: set[tuple[str, str]] = set()
+        self.lock: threading.Lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.connection: sqlite3.Connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS documents (collection TEXT NOT NULL, uuid TEXT NOT NULL, "
+                                "source TEXT NOT NULL, size INTEGER NOT NULL, chunks INTEGER NOT NULL, "
+                                "ingested_at REAL NOT NULL, PRIMARY KEY (collection, uuid))")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS documents_ingested_at "
+                                "ON documents (collection, ingested_at, uuid)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS chunks (collection TEXT NOT NULL, uuid TEXT NOT NULL, "
+                                "chunk_id TEXT NOT NULL, PRIMARY KEY (collection, chunk_id))")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS chunks_uuid ON chunks (collection, uuid)")
+        if "file_hash" not in [column[1] for column in self.connection.execute("PRAGMA table_info(documents)")]:
+            self.connection.execute("ALTER TABLE documents ADD COLUMN file_hash TEXT")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS documents_source ON documents (collection, source)")
+        self.connection.commit()
+
+    def add_document(self, collection_name: str, doc_uuid: str, source: str, size: int,
+                     chunk_ids: list[str], file_hash: str | None = None) -> None:
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO documents "
+                                    "(collection, uuid, source, size, chunks, ingested_at, file_hash) "
+                                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                    (collection_name, doc_uuid, source, size, len(chunk_ids), time.time(), file_hash))
+            self.connection.execute("DELETE FROM chunks WHERE collection = ? AND uuid = ?",
+                                    (collection_name, doc_uuid))
+            self.connection.executemany("INSERT OR REPLACE INTO chunks VALUES (?, ?, ?)",
+                                        [(collection_name, doc_uuid, chunk_id) for chunk_id in chunk_ids])
+            self.connection.commit()
+            # Documents are registered without a hash until all of their chunks are in Chroma
+            if file_hash is None:
+                self.writing.add((collection_name, doc_uuid))
+            else:
+                self.writing.discard((collection_name, doc_uuid))
+
+    def find_document(self, collection_name: str, source: str) -> tuple[str, str | None, int] | None:
+        # Returns (uuid, file_hash, size) of the most recently ingested document with this source
+        with self.lock:
+            return self.connection.execute("SELECT uuid, file_hash, size FROM documents "
+                                           "WHERE collection = ? AND source = ? ORDER BY ingested_at DESC LIMIT 1",
+                                           (collection_name, source)).fetchone()
+
+    def chunk_ids(self, collection_name: str, uuids: list[str]) -> list[str]:
+        chunk_ids: list[str] = []
+        with self.lock:
+            for doc_uuid in uuids:
+                rows = self.connection.execute("SELECT chunk_id FROM chunks WHERE collection = ? AND uuid = ?",
+                                               (collection_name, doc_uuid)).fetchall()
+                chunk_ids.extend(row[0] for row in rows)
+        return chunk_ids
+
+    def remove_documents(self, collection_name: str, uuids: list[str]) -> None:
+        with self.lock:
+            self.connection.executemany("DELETE FROM documents WHERE collection = ? AND uuid = ?",
+                                        [(collection_name, doc_uuid) for doc_uuid in uuids])
+            self.connection.executemany("DELETE FROM chunks WHERE collection = ? AND uuid = ?",
+                                        [(collection_name, doc_uuid) for doc_uuid in uuids])
+            self.connection.commit()
+            self.writing.difference_update((collection_name, doc_uuid) for doc_uuid in uuids)
+
+    def iter_documents(self, collection_name: str, limit: int | None = None, offset: int = 0,
+                       after: tuple[float, str] | None = None, source_prefix: str | None = None,
+                       ingested_after: float | None = None, ingested_before: float | None = None) -> Iterator[tuple]:
+        where, parameters = document_filter(collection_name, source_prefix, ingested_after, ingested_before)
+        if after is not None:
+            where += " AND (ingested_at, uuid) > (?, ?)"
+            parameters.extend(after)
+
+        # Readers get their own connection so a slow client streaming a long listing doesn't hold the lock. A
+        # streamed listing is read a step at a time on whichever worker thread is free, the connection is only
+        # ever used by one of them at a time.
+        connection: sqlite3.Connection = sqlite3.connect(self.path, check_same_thread=False)
+        try:
+            cursor: sqlite3.Cursor = connection.execute(
+                f"SELECT uuid, source, size, chunks, ingested_at FROM documents WHERE {where} "
+                f"ORDER BY ingested_at, uuid LIMIT ? OFFSET ?", [*parameters, -1 if limit is None else limit, offset])
+            while len(rows := cursor.fetchmany(500)) > 0:
+                yield from rows
+        finally:
+            connection.close()
+
+    def count_documents(self, collection_name: str, source_prefix: str | None = None,
+                        ingested_after: float | None = None, ingested_before: float | None = None) -> int:
+        where, parameters = document_filter(collection_name, source_prefix, ingested_after, ingested_before)
+        with self.lock:
+            return self.connection.execute(f"SELECT COUNT(*) FROM documents WHERE {where}", parameters).fetchone()[0]
+
+    def chunk_count(self, collection_name: str) -> int:
+        with self.lock:
+            return self.connection.execute("SELECT COALESCE(SUM(chunks), 0) FROM documents WHERE collection = ?",
+                                           (collection_name,)).fetchone()[0]
+
+    def drop_collection(self, collection_name: str) -> None:
+        with self.lock:
+            self.connection.execute("DELETE FROM documents WHERE collection = ?", (collection_name,))
+            self.connection.execute("DELETE FROM chunks WHERE collection = ?", (collection_name,))
+            self.connection.commit()
+            self.writing = {(name, doc_uuid) for name, doc_uuid in self.writing if name != collection_name}
+
+    def changed(self, collection_name: str, generation: int) -> None:
+        # Called once this process changed the collection and bumped it to generation, the registry is still in
+        # step unless another process bumped it in between
+        with self.lock:
+            if self.synced.get(collection_name) == generation - 1:
+                self.synced[collection_name] = generation
+
+    def reconcile(self, collection: Collection, page_size: int = 5000) -> None:
+        generation: int | None = None
+        if self.generations is None:
+            if collection.count() <= self.chunk_count(collection.name):
+                return
+        else:
+            generation = self.generations.get(collection.name)
+            if self.synced.get(collection.name) == generation:
+                return
+            if collection.name not in self.synced and collection.count() == self.chunk_count(collection.name):
+                # First look at the collection since this process started
+                self.synced[collection.name] = generation
+                return
+
+        logging.info(f"Re-indexing documents in collection {collection.name} from chunk metadata")
+        started: float = time.time()
+        documents: dict[str, tuple[str, list[str]]] = {}
+        offset: int = 0
+        while True:
+            page: GetResult = collection.get(include=['metadatas'], limit=page_size, offset=offset)
+            for chunk_id, metadata in zip(page['ids'], page['metadatas']):
+                if metadata is None or 'uuid' not in metadata:
+                    continue
+                documents.setdefault(metadata['uuid'], (metadata.get('source', ""), []))[1].append(chunk_id)
+            if len(page['ids']) < page_size:
+                break
+            offset += page_size
+
+        with self.lock:
+            # Keep what is already known about documents that are still present
+            known: dict[str, tuple] = {row[0]: row[1:] for row in self.connection.execute(
+                "SELECT uuid, size, ingested_at, file_hash FROM documents WHERE collection = ?", (collection.name,))}
+            # Documents this process is still writing, or wrote while Chroma was being read, are left as they are
+            kept: set[str] = {doc_uuid for doc_uuid, (_, ingested_at, _) in known.items() if ingested_at >= started}
+            kept.update(doc_uuid for name, doc_uuid in self.writing if name == collection.name)
+            documents = {doc_uuid: document for doc_uuid, document in documents.items() if doc_uuid not in kept}
+            replaced: list[tuple[str, str]] = [(collection.name, doc_uuid) for doc_uuid in known
+                                               if doc_uuid not in kept]
+            self.connection.executemany("DELETE FROM documents WHERE collection = ? AND uuid = ?", replaced)
+            self.connection.executemany("DELETE FROM chunks WHERE collection = ? AND uuid = ?", replaced)
+            now: float = time.time()
+            self.connection.executemany("INSERT INTO documents "
+                                        "(collection, uuid, source, chunks, size, ingested_at, file_hash) "
+                                        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                        [(collection.name, doc_uuid, source, len(chunk_ids),
+                                          *known.get(doc_uuid, (0, now, None)))
+                                         for doc_uuid, (source, chunk_ids) in documents.items()])
+            self.connection.executemany("INSERT INTO chunks VALUES (?, ?, ?)",
+                                        [(collection.name, doc_uuid, chunk_id)
+                                         for doc_uuid, (_, chunk_ids) in documents.items()
+                                         for chunk_id in chunk_ids])
+            self.connection.commit()
+            if generation is not None:
+                # Changes made while Chroma was being read bumped the generation past this one
+                self.synced[collection.name] = generation
@@ -1,149 +1,617 @@
+import asyncio
+import functools
+import logging
 import os
 import sys
-from typing import List, Mapping
+import threading
+from enum import Enum
+from typing import TYPE_CHECKING, Callable, Iterable, Iterator, List
 
 import chromadb
-import chromadb.utils.embedding_functions as embedding_functions
 import httpx
 from chromadb import ClientAPI, GetResult, Settings
 from chromadb.api.models import Collection
-from langchain_community.vectorstores import Chroma
+from chromadb.db.base import UniqueConstraintError
 from langchain_core.embeddings import Embeddings
-from llama_index import Response
-from llama_index import VectorStoreIndex, ServiceContext
-from llama_index.core.base_query_engine import BaseQueryEngine
-from llama_index.core.base_retriever import BaseRetriever
-from llama_index.indices.vector_store import VectorIndexRetriever
-from llama_index.llms import OpenAILike, LLM
-from llama_index.storage.storage_context import StorageContext
-from llama_index.vector_stores import ChromaVectorStore
 from pydantic import BaseModel
 
-from embeddings import PassThroughEmbeddings
+from chunking import ChunkingStrategy
+from compact_vectors import COMPACT_DIMENSIONS_KEY, CompactVectors, compact_dimensions
+from document_registry import DocumentRegistry, decode_cursor, encode_cursor
+from embeddings import CachedEmbeddingFunction, PassThroughEmbeddings, PooledOpenAIEmbeddingFunction
+from engine_registry import QueryEngineRegistry
+from generations import CollectionGenerations
+from hnsw import HnswConfig, IndexStats, RecallReport, check_recall, index_stats, unload_vector_segment
+from index_cache import IndexCache
 from ingest import Ingest
+from jobs import IngestionJob
+from lexical_index import LexicalIndex
+from query_cache import QueryCache
+
+if TYPE_CHECKING:
+    # llama-index takes seconds to import, so it is only imported once the first query engine is built
+    from llama_index import Response, ServiceContext, VectorStoreIndex
+    from llama_index.core.base_query_engine import BaseQueryEngine
+    from llama_index.llms import LLM
+    from llama_index.postprocessor import SentenceTransformerRerank
+    from llama_index.postprocessor.types import BaseNodePostprocessor
+
+
+class RetrievalMode(str, Enum):
+    VECTOR = "vector"
+    HYBRID = "hybrid"
+    LEXICAL = "lexical"
+
+
+class Reranker(str, Enum):
+    NONE = "none"
+    CROSS_ENCODER = "cross-encoder"
+    MMR = "mmr"
+
+
+class StorageBackend(str, Enum):
+    PERSISTENT = "persistent"
+    HTTP = "http"
+
+
+class CollectionExistsError(Exception):
+    pass
+
+
+class CollectionNotFoundError(ValueError):
+    pass
+
+
+def is_missing_collection(e: Exception) -> bool:
+    # The embedded client raises a ValueError, the HTTP client a bare Exception carrying the server's error message
+    return isinstance(e, ValueError) or "does not exist" in str(e)
 
 
 class UniqueDocument(BaseModel):
     uuid: str
     source: str
+    size: int | None = None
+    chunks: int | None = None
+    ingested_at: float | None = None
+
+
+class CollectionStats(BaseModel):
+    name: str
+    chunks: int
+    documents: int
+    compact_dimensions: int | None = None
+    index_loaded: bool
+    index_memory_bytes: int | None = None
 
 
 class DocumentStore:
     def __init__(self, default_collection_name="default"):
         self.default_collection_name = default_collection_name
-        self.client: ClientAPI = chromadb.PersistentClient(path="db", settings=Settings(anonymized_telemetry=False))
+        self.storage_backend: StorageBackend = StorageBackend(os.environ.get("CHROMA_BACKEND") or "persistent")
+        self.client: ClientAPI = self.create_client()
         self.embeddings_model_name = os.environ.get("EMBEDDING_MODEL_NAME") or "instructor-xl"
 
-        self.embeddings_function = embedding_functions.OpenAIEmbeddingFunction(
+        self.embedding_batch_size: int = int(os.environ.get("EMBEDDING_BATCH_SIZE") or 64)
+        self.embedding_concurrency: int = int(os.environ.get("EMBEDDING_CONCURRENCY") or 4)
+        # Queries are embedded without the embedding cache, which is meant for chunks
+        self.query_embeddings_function: PooledOpenAIEmbeddingFunction = PooledOpenAIEmbeddingFunction(
             api_key=os.environ.get("OPENAI_API_KEY"),
             api_base=os.environ.get("OPENAI_API_BASE"),
-            api_type="openai",
             model_name=os.environ.get("EMBEDDING_MODEL_NAME"),
+            verify=os.environ.get('SSL_VERIFICATION').lower() == "true",
+            max_connections=self.embedding_concurrency,
         )
+        self.embeddings_function = self.query_embeddings_function
+        self.embedding_cache: CachedEmbeddingFunction | None = None
+        self.embedding_cache_max_entries: int = int(os.environ.get("EMBEDDING_CACHE_MAX_ENTRIES") or 100000)
+        if self.embedding_cache_max_entries > 0:
+            self.embedding_cache = CachedEmbeddingFunction(
+                embed_fn=self.embeddings_function,
+                model_name=self.embeddings_model_name,
+                path=os.environ.get("EMBEDDING_CACHE_PATH") or "db/embedding-cache.sqlite3",
+                max_entries=self.embedding_cache_max_entries,
+            )
+            self.embeddings_function = self.embedding_cache
 
-        self.embeddings: Embeddings = PassThroughEmbeddings(embed_fn=self.embeddings_function)
+        self.embeddings: Embeddings = PassThroughEmbeddings(embed_fn=self.embeddings_function,
+                                                            query_embed_fn=self.query_embeddings_function)
 
-        self.collection: Collection = self.client.get_or_create_collection(name=default_collection_name,
-                                                                           embedding_function=self.embeddings_function)
+        self.hnsw_config: HnswConfig = HnswConfig.from_env()
+        self.compact_dimensions: int = int(os.environ.get("COMPACT_DIMENSIONS") or 0)
+        self.recall_tolerance: float = float(os.environ.get("RECALL_TOLERANCE") or 0.05)
+        # Always opened, collections created as compact stay compact whatever COMPACT_DIMENSIONS is now
+        self.compact_vectors: CompactVectors = CompactVectors(
+            embed_fn=self.embeddings_function,
+            path=os.environ.get("COMPACT_VECTORS_PATH") or "db/compact-vectors.sqlite3",
+            oversample=int(os.environ.get("RESCORE_OVERSAMPLE") or 4))
+        self.collection: Collection = self.get_or_create_collection(default_collection_name)
+        # Reads of a collection that doesn't exist are always rejected, uploads create it unless this is off
+        self.auto_create_collections: bool = \
+            (os.environ.get("AUTO_CREATE_COLLECTIONS") or "True").lower() == "true"
         self.chunk_size: int = int(os.environ.get('CHUNK_SIZE'))
         self.overlap_size: int = int(os.environ.get('OVERLAP_SIZE'))
+        self.chunking_strategy: ChunkingStrategy = ChunkingStrategy(os.environ.get("CHUNKING_STRATEGY") or "token")
         self.response_mode: str = os.environ.get('RESPONSE_MODE')
         self.context_window: int = int(os.environ.get('CONTEXT_WINDOW'))
         self.max_output: int = int(os.environ.get('MAX_OUTPUT'))
         self.temperature: float = float(os.environ.get('TEMPERATURE'))
         self.model: str = os.environ.get('MODEL')
         self.top_k: int = int(os.environ.get("TOP_K"))
-        self.ingestor: Ingest = Ingest(self.collection, self.chunk_size, self.overlap_size)
-        self.chroma_db: Chroma = Chroma(embedding_function=self.embeddings,
-                                        collection_name=default_collection_name,
-                                        client=self.client)
-
-        # LlamaIndex
-        api_key: str = os.environ.get('OPENAI_API_KEY')
-        api_base: str = os.environ.get('OPENAI_API_BASE')
-        verify_https: bool = os.environ.get('SSL_VERIFICATION').lower() == "true"
-        http_client: httpx.Client = httpx.Client(verify=verify_https)
-        self.llm: LLM = OpenAILike(is_chat_model=True, model=self.model, temperature=self.temperature,
-                                   max_tokens=self.context_window,
-                                   api_base=api_base, api_key=api_key,
-                                   http_client=http_client)
-        self.service_context: ServiceContext = ServiceContext.from_defaults(embed_model=self.embeddings,
-                                                                            llm=self.llm,
-                                                                            context_window=self.context_window,
-                                                                            num_output=self.max_output,
-                                                                            chunk_size=self.chunk_size,
-                                                                            chunk_overlap=self.overlap_size)
-        self.index_dictionary: dict = {}
-        self.index: VectorStoreIndex = self.construct_index_for_collection(self.default_collection_name)
-
-    def construct_index_for_collection(self, collection_name: str) -> VectorStoreIndex:
-        collection_entry: Collection = self.index_dictionary.get(collection_name)
-
-        if collection_entry is not None:
-            return collection_entry
+        self.parser_workers: int = int(os.environ.get("PARSER_WORKERS") or 2)
+        # With a Chroma server, other processes change collections too and bump their generations in the shared
+        # ingestion queue database
+        self.generations: CollectionGenerations | None = None
+        if self.storage_backend is StorageBackend.HTTP:
+            self.generations = CollectionGenerations(
+                path=os.environ.get("INGESTION_QUEUE_PATH") or "db/ingestion-queue.sqlite3")
+        self.registry: DocumentRegistry = DocumentRegistry(
+            path=os.environ.get("DOCUMENT_REGISTRY_PATH") or "db/documents.sqlite3", generations=self.generations)
+        self.lexical_index: LexicalIndex = LexicalIndex(
+            path=os.environ.get("LEXICAL_INDEX_PATH") or "db/lexical-index.sqlite3", generations=self.generations)
+        self.retrieval_mode: RetrievalMode = RetrievalMode(os.environ.get("RETRIEVAL_MODE") or "vector")
+        self.ingestor: Ingest = Ingest(self.collection, self.chunk_size, self.overlap_size, self.registry,
+                                       self.parser_workers, self.embedding_batch_size, self.embedding_concurrency,
+                                       self.lexical_index, self.compact_vectors, self.chunking_strategy)
+
+        # The LLM, service context, indices and query engines are built on first use or by warm_up()
+        self.llm_lock: threading.Lock = threading.Lock()
+        self._llm: "LLM | None" = None
+        self._service_context: "ServiceContext | None" = None
+        self.reranker: Reranker = Reranker(os.environ.get("RERANKER") or "none")
+        self.rerank_candidates: int = int(os.environ.get("RERANK_CANDIDATES") or 20)
+        self.mmr_threshold: float = float(os.environ.get("MMR_THRESHOLD") or 0.5)
+        self._cross_encoder: "SentenceTransformerRerank | None" = None
+        self.query_cache: QueryCache = QueryCache(max_entries=int(os.environ.get("QUERY_CACHE_MAX_ENTRIES") or 1000),
+                                                  ttl_seconds=float(os.environ.get("QUERY_CACHE_TTL") or 300),
+                                                  shared_generations=self.generations)
+        self.indices: IndexCache = IndexCache(build_index=self.construct_index_for_collection,
+                                              measure=self.index_memory_bytes, unload=self.unload_collection,
+                                              max_bytes=int(os.environ.get("INDEX_CACHE_MAX_BYTES") or 2 * 1024 ** 3))
+        self.query_engines: QueryEngineRegistry = QueryEngineRegistry(
+            build_engine=self.build_query_engine,
+            max_entries=int(os.environ.get("QUERY_ENGINE_CACHE_SIZE") or 64))
+        self.warm_collections: list[str] = [name.strip() for name in
+                                            (os.environ.get("WARM_COLLECTIONS") or default_collection_name).split(",")
+                                            if name.strip() != ""]
+        self.ready: threading.Event = threading.Event()
+
+    def create_client(self) -> ClientAPI:
+        settings: Settings = Settings(anonymized_telemetry=False)
+        if self.storage_backend is StorageBackend.HTTP:
+            # A Chroma server shared by every replica and ingestion worker
+            return chromadb.HttpClient(host=os.environ.get("CHROMA_HOST") or "localhost",
+                                       port=os.environ.get("CHROMA_PORT") or "8000",
+                                       ssl=(os.environ.get("CHROMA_SSL") or "False").lower() == "true",
+                                       settings=settings)
+        return chromadb.PersistentClient(path=os.environ.get("CHROMA_PATH") or "db", settings=settings)
+
+    @property
+    def llm(self) -> "LLM":
+        with self.llm_lock:
+            if self._llm is None:
+                from llm import PooledOpenAILike
+
+                verify_https: bool = os.environ.get('SSL_VERIFICATION').lower() == "true"
+                llm_max_connections: int = int(os.environ.get('LLM_MAX_CONNECTIONS') or 200)
+                async_http_client: httpx.AsyncClient = httpx.AsyncClient(
+                    verify=verify_https,
+                    limits=httpx.Limits(max_connections=llm_max_connections,
+                                        max_keepalive_connections=llm_max_connections),
+                )
+                self._llm = PooledOpenAILike(is_chat_model=True, model=self.model, temperature=self.temperature,
+                                             max_tokens=self.context_window,
+                                             api_base=os.environ.get('OPENAI_API_BASE'),
+                                             api_key=os.environ.get('OPENAI_API_KEY'),
+                                             http_client=httpx.Client(verify=verify_https),
+                                             async_http_client=async_http_client)
+            return self._llm
+
+    @property
+    def service_context(self) -> "ServiceContext":
+        if self._service_context is None:
+            from llama_index import ServiceContext
+
+            llm: LLM = self.llm
+            with self.llm_lock:
+                if self._service_context is None:
+                    self._service_context = ServiceContext.from_defaults(embed_model=self.embeddings, llm=llm,
+                                                                         context_window=self.context_window,
+                                                                         num_output=self.max_output,
+                                                                         chunk_size=self.chunk_size,
+                                                                         chunk_overlap=self.overlap_size)
+        return self._service_context
+
+    @service_context.setter
+    def service_context(self, service_context: "ServiceContext") -> None:
+        self._service_context = service_context
+
+    @property
+    def cross_encoder(self) -> "SentenceTransformerRerank":
+        # Loaded once and shared by every query engine, it only holds the model and top_n
+        with self.llm_lock:
+            if self._cross_encoder is None:
+                from llama_index.postprocessor import SentenceTransformerRerank
+
+                self._cross_encoder = SentenceTransformerRerank(
+                    model=os.environ.get("RERANKER_MODEL") or "cross-encoder/ms-marco-MiniLM-L-6-v2",
+                    top_n=self.top_k, device="cpu")
+            return self._cross_encoder
+
+    def warm_up(self) -> None:
+        # Builds what the first queries would otherwise wait for, then marks the store ready
+        if self.reranker is Reranker.CROSS_ENCODER:
+            _ = self.cross_encoder
+        if self.parser_workers > 0:
+            # Starts the parser processes so the first upload does not pay for them
+            self.ingestor.parser()
+        self.warm_query_engines()
+        self.ready.set()
+
+    def construct_index_for_collection(self, collection_name: str) -> "VectorStoreIndex":
+        from llama_index import StorageContext, VectorStoreIndex
+        from llama_index.vector_stores import ChromaVectorStore
+        from llm import CompactChromaVectorStore, ThreadedChromaVectorStore
+
+        # Called by the index cache, which keeps the result until the collection is unloaded
+        collection: Collection = self.get_collection(collection_name)
+        if compact_dimensions(collection) is not None:
+            vector_store: ChromaVectorStore = CompactChromaVectorStore(compact_vectors=self.compact_vectors,
+                                                                       chroma_collection=collection)
         else:
-            collection = self.client.get_or_create_collection(name=collection_name,
-                                                              embedding_function=self.embeddings_function)
+            vector_store: ChromaVectorStore = ThreadedChromaVectorStore(chroma_collection=collection)
+        storage_context: StorageContext = StorageContext.from_defaults(vector_store=vector_store)
 
-            vector_store: ChromaVectorStore = ChromaVectorStore(chroma_collection=collection)
-            storage_context: StorageContext = StorageContext.from_defaults(vector_store=vector_store)
+        return VectorStoreIndex.from_documents([], storage_context=storage_context,
+                                               service_context=self.service_context)
 
-            self.index_dictionary[collection_name] = VectorStoreIndex.from_documents(
-                [], storage_context=storage_context, service_context=self.service_context
-            )
+    def index_memory_bytes(self, collection_name: str) -> int:
+        # Loads the collection's HNSW index if it isn't loaded yet
+        try:
+            collection: Collection = self.get_collection(collection_name)
+        except CollectionNotFoundError:
+            return 0
+        return index_stats(self.client, collection).memory_bytes or 0
+
+    def unload_collection(self, collection_name: str) -> None:
+        # Query engines hold the collection's index, the next query rebuilds them and loads the index again
+        self.query_engines.evict_collection(collection_name)
+        try:
+            unload_vector_segment(self.client, self.get_collection(collection_name))
+        except CollectionNotFoundError:
+            pass
+
+    def get_collection(self, collection_name: str) -> Collection:
+        try:
+            return self.client.get_collection(name=collection_name, embedding_function=self.embeddings_function)
+        except Exception as e:
+            if not is_missing_collection(e):
+                raise
+            raise CollectionNotFoundError(f"Collection {collection_name} does not exist") from e
 
-            return self.index_dictionary[collection_name]
+    def get_upload_collection(self, collection_name: str) -> Collection:
+        if self.auto_create_collections:
+            return self.get_or_create_collection(collection_name)
+        return self.get_collection(collection_name)
 
     def get_or_create_collection(self, collection_name: str):
-        return self.client.get_or_create_collection(name=collection_name,
-                                                    embedding_function=self.embeddings_function)
+        try:
+            return self.get_collection(collection_name)
+        except CollectionNotFoundError:
+            # Passing metadata for a collection that already exists would change what it reports, not its index
+            return self.create_collection(collection_name)
+
+    def create_collection(self, collection_name: str, hnsw_config: HnswConfig = None, get_or_create: bool = True,
+                          compact_dimensions: int | None = None) -> Collection:
+        config: HnswConfig = self.hnsw_config if hnsw_config is None else self.hnsw_config.merged_with(hnsw_config)
+        metadata: dict = config.collection_metadata()
+        if compact_dimensions is None:
+            compact_dimensions = self.compact_dimensions
+        if compact_dimensions > 0:
+            if self.storage_backend is not StorageBackend.PERSISTENT:
+                # The full vectors of a compact collection are kept next to the app, not in Chroma
+                raise ValueError("Compact collections need the persistent storage backend")
+            metadata[COMPACT_DIMENSIONS_KEY] = compact_dimensions
+        try:
+            return self.client.create_collection(name=collection_name, metadata=metadata or None,
+                                                 embedding_function=self.embeddings_function,
+                                                 get_or_create=get_or_create)
+        except UniqueConstraintError as e:
+            raise CollectionExistsError(str(e)) from e
+
+    def index_stats(self, collection_name: str) -> IndexStats:
+        return index_stats(self.client, self.get_collection(collection_name))
+
+    def check_recall(self, collection_name: str, samples: int, top_k: int, search_efs: list[int]) -> RecallReport:
+        collection: Collection = self.get_collection(collection_name)
+        return check_recall(self.client, collection, samples, top_k, search_efs, 1 - self.recall_tolerance,
+                            self.compact_vectors if compact_dimensions(collection) is not None else None)
+
+    def lookup_embeddings(self, collection: Collection, ids: list[str]) -> dict:
+        if compact_dimensions(collection) is not None:
+            return self.compact_vectors.get(collection.name, ids)
+        stored: GetResult = collection.get(ids=ids, include=['embeddings'])
+        return dict(zip(stored['ids'], stored['embeddings']))
+
+    def collection_chunk_counts(self) -> dict[str, int]:
+        return {collection.name: collection.count() for collection in self.client.list_collections()}
+
+    def collection_stats(self, collection_name: str) -> CollectionStats:
+        collection: Collection = self.get_collection(collection_name)
+        self.registry.reconcile(collection)
+        loaded: dict[str, int] = self.indices.loaded()
+        return CollectionStats(name=collection.name, chunks=collection.count(),
+                               documents=self.registry.count_documents(collection.name),
+                               compact_dimensions=compact_dimensions(collection),
+                               index_loaded=collection.name in loaded,
+                               index_memory_bytes=loaded.get(collection.name))
+
+    def list_collections(self) -> list[CollectionStats]:
+        return [self.collection_stats(collection.name) for collection in self.client.list_collections()]
+
+    def delete_collection(self, collection_name: str) -> None:
+        try:
+            self.client.delete_collection(collection_name)
+        except Exception as e:
+            if not is_missing_collection(e):
+                raise
+            raise CollectionNotFoundError(f"Collection {collection_name} does not exist") from e
+        self.forget_collection(collection_name)
+
+    def forget_collection(self, collection_name: str) -> None:
+        # Drop everything built on top of a collection so a re-created collection isn't served stale state
+        self.indices.discard(collection_name)
+        self.registry.drop_collection(collection_name)
+        self.lexical_index.drop_collection(collection_name)
+        self.compact_vectors.drop_collection(collection_name)
+        self.query_engines.evict_collection(collection_name)
+        self.collection_changed(collection_name)
+        if collection_name == self.default_collection_name:
+            self.collection = self.get_or_create_collection(collection_name)
+            self.ingestor.collection = self.collection
+
+    def warm_query_engines(self) -> None:
+        for collection_name in self.warm_collections:
+            try:
+                self.get_collection(collection_name)
+            except CollectionNotFoundError:
+                logging.warning(f"Not warming collection {collection_name}, it does not exist")
+                continue
+            for response_mode in {self.response_mode, "refine", "no_text"}:
+                self.get_query_engine(response_mode, collection_name, retrieval_mode=self.retrieval_mode)
 
     def get_all_documents(self, collection_name: str = None) -> list[UniqueDocument]:
+        rows, _ = self.iter_documents(collection_name)
+        return [UniqueDocument(uuid=doc_uuid, source=source, size=size, chunks=chunks, ingested_at=ingested_at)
+                for doc_uuid, source, size, chunks, ingested_at in rows]
+
+    def iter_documents(self, collection_name: str = None, limit: int | None = None, offset: int = 0,
+                       cursor: str | None = None, source_prefix: str | None = None,
+                       ingested_after: float | None = None,
+                       ingested_before: float | None = None) -> tuple[Iterator[tuple], str | None]:
+        # Rows are (uuid, source, size, chunks, ingested_at), the cursor is set when another page follows
         if collection_name is None:
             target_collection = self.collection
         else:
-            target_collection = self.get_or_create_collection(collection_name)
-
-        if target_collection.count() > 0:
-            all_documents: GetResult = target_collection.get(include=['metadatas'], where={"chunk_idx": 0})
-            all_metadatas: list[Mapping] = all_documents['metadatas']
-            unique_documents: list[UniqueDocument] = []
-            for metadata in all_metadatas:
-                unique_documents.append(UniqueDocument(uuid=metadata['uuid'], source=metadata['source']))
-            return unique_documents
+            target_collection = self.get_collection(collection_name)
+
+        self.registry.reconcile(target_collection)
+        rows: Iterator[tuple] = self.registry.iter_documents(
+            target_collection.name, None if limit is None else limit + 1, offset,
+            None if cursor is None else decode_cursor(cursor), source_prefix, ingested_after, ingested_before)
+        if limit is None:
+            return rows, None
+
+        # One extra row is read to tell whether there is another page
+        page: list[tuple] = [row for _, row in zip(range(limit + 1), rows)]
+        rows.close()
+        if len(page) <= limit:
+            return iter(page), None
+        last_uuid, _, _, _, last_ingested_at = page[limit - 1]
+        return iter(page[:limit]), encode_cursor(last_ingested_at, last_uuid)
+
+    def count_documents(self, collection_name: str = None, source_prefix: str | None = None,
+                        ingested_after: float | None = None, ingested_before: float | None = None) -> int:
+        if collection_name is None:
+            target_collection = self.collection
         else:
-            return []
+            target_collection = self.get_collection(collection_name)
+
+        self.registry.reconcile(target_collection)
+        return self.registry.count_documents(target_collection.name, source_prefix, ingested_after, ingested_before)
 
     def delete_documents(self, uuids: List[str], collection_name: str = None):
         if collection_name is None:
             target_collection = self.collection
         else:
-            target_collection = self.get_or_create_collection(collection_name)
+            target_collection = self.get_collection(collection_name)
 
-        for uuid in uuids:
-            target_collection.delete(where={'uuid': uuid})
+        self.registry.reconcile(target_collection)
+        chunk_ids: list[str] = self.registry.chunk_ids(target_collection.name, uuids)
+        if len(chunk_ids) > 0:
+            self.ingestor.delete_chunks(target_collection, chunk_ids)
+        self.registry.remove_documents(target_collection.name, uuids)
 
-    def query_llamaindex(self, query_text: str, response_mode: str = None,
-                         collection_name: str = "default") -> str | None:
-        if response_mode is None:
-            response_mode = self.response_mode
+        self.collection_changed(target_collection.name)
+
+    def collection_changed(self, collection_name: str) -> None:
+        # Called after this process added or removed chunks, other processes see the new generation
+        if self.generations is not None:
+            generation: int = self.generations.bump(collection_name)
+            self.registry.changed(collection_name, generation)
+            self.lexical_index.changed(collection_name, generation)
+        self.query_cache.invalidate(collection_name)
+
+    def resolve_collection_name(self, collection_name: str | None) -> str:
+        if collection_name is None or collection_name.strip() == "":
+            return self.default_collection_name
+        return collection_name
+
+    def resolve_retrieval_mode(self, retrieval_mode: RetrievalMode | None) -> RetrievalMode:
+        return self.retrieval_mode if retrieval_mode is None else RetrievalMode(retrieval_mode)
+
+    def build_query_engine(self, collection_name: str, response_mode: str, top_k: int, streaming: bool,
+                           retrieval_mode: RetrievalMode = RetrievalMode.VECTOR) -> "BaseQueryEngine":
+        from llama_index.core.base_retriever import BaseRetriever
+        from llm import ThreadedRetrieverQueryEngine
+        from retrievers import HybridRetriever, LexicalRetriever
+
+        collection_index: VectorStoreIndex = self.indices.get(collection_name)
 
-        if collection_name is None or collection_name is self.default_collection_name or collection_name.strip() == "":
-            collection_index: VectorStoreIndex = self.index
+        # With a reranker more candidates are retrieved than are passed on to synthesis
+        candidates: int = top_k if self.reranker is Reranker.NONE else max(self.rerank_candidates, top_k)
+        if retrieval_mode is RetrievalMode.VECTOR:
+            retriever: BaseRetriever = collection_index.as_retriever(similarity_top_k=candidates)
         else:
-            collection_index: VectorStoreIndex = self.construct_index_for_collection(collection_name)
+            # Chunks stored before the lexical index existed are indexed the first time a collection needs them
+            collection: Collection = self.get_collection(collection_name)
+            self.lexical_index.reconcile(collection)
+            # Other processes add and remove chunks after the engine is built, their changes are picked up per query
+            reconcile: Callable[[], None] | None = None
+            if self.generations is not None:
+                reconcile = functools.partial(self.lexical_index.reconcile, collection)
+            retriever: BaseRetriever = LexicalRetriever(self.lexical_index, collection_name, candidates, reconcile)
+            if retrieval_mode is RetrievalMode.HYBRID:
+                retriever = HybridRetriever(collection_index.as_retriever(similarity_top_k=candidates), retriever,
+                                            candidates)
 
-        query_engine: BaseQueryEngine = collection_index.as_query_engine(response_mode=response_mode,
-                                                                         similarity_top_k=self.top_k)
-        query_result: Response = query_engine.query(query_text)
+        return ThreadedRetrieverQueryEngine.from_args(retriever, service_context=collection_index.service_context,
+                                                      node_postprocessors=self.build_rerankers(collection_name,
+                                                                                               collection_index,
+                                                                                               top_k),
+                                                      response_mode=response_mode, streaming=streaming)
+
+    def build_rerankers(self, collection_name: str, collection_index: "VectorStoreIndex",
+                        top_k: int) -> list["BaseNodePostprocessor"]:
+        from rerankers import MMRRerank
+
+        if self.reranker is Reranker.CROSS_ENCODER:
+            return [self.cross_encoder]
+        if self.reranker is Reranker.MMR:
+            return [MMRRerank(functools.partial(self.lookup_embeddings, self.get_collection(collection_name)),
+                              collection_index.service_context.embed_model, top_k, self.mmr_threshold)]
+        return []
 
+    def get_query_engine(self, response_mode: str, collection_name: str, streaming: bool = False,
+                         retrieval_mode: RetrievalMode | None = None) -> "BaseQueryEngine":
+        collection_name = self.resolve_collection_name(collection_name)
+        self.indices.touch(collection_name)
+        return self.query_engines.get(collection_name, response_mode, self.top_k, streaming,
+                                      self.resolve_retrieval_mode(retrieval_mode))
+
+    @staticmethod
+    def format_query_result(query_result: "Response", response_mode: str) -> str | None:
         if response_mode == "no_text":
-            query_response: str = query_result.get_formatted_sources(length=sys.maxsize)
-        else:
-            query_response: str = query_result.response
+            return query_result.get_formatted_sources(length=sys.maxsize)
+        return query_result.response
+
+    def query_llamaindex(self, query_text: str, response_mode: str = None, collection_name: str = "default",
+                         retrieval_mode: RetrievalMode | None = None) -> str | None:
+        if response_mode is None:
+            response_mode = self.response_mode
+
+        query_engine: BaseQueryEngine = self.get_query_engine(response_mode, collection_name,
+                                                              retrieval_mode=retrieval_mode)
+        query_result: Response = query_engine.query(query_text)
+
+        return self.format_query_result(query_result, response_mode)
+
+    async def aquery_llamaindex(self, query_text: str, response_mode: str = None, collection_name: str = "default",
+                                retrieval_mode: RetrievalMode | None = None) -> str | None:
+        if response_mode is None:
+            response_mode = self.response_mode
+
+        # Building an index for a collection seen for the first time touches Chroma synchronously
+        query_engine: BaseQueryEngine = await asyncio.to_thread(self.get_query_engine, response_mode,
+                                                                collection_name, False, retrieval_mode)
+        query_result: Response = await query_engine.aquery(query_text)
+
+        return self.format_query_result(query_result, response_mode)
+
+    async def aquery_with_cache(self, query_text: str, response_mode: str = None, collection_name: str = "default",
+                                retrieval_mode: RetrievalMode | None = None) -> tuple[str | None, bool]:
+        if response_mode is None:
+            response_mode = self.response_mode
+        retrieval_mode = self.resolve_retrieval_mode(retrieval_mode)
+
+        cache_key: tuple = self.query_cache.key(self.resolve_collection_name(collection_name), query_text,
+                                                response_mode, self.top_k, retrieval_mode.value)
+        cached_response: str | None = self.query_cache.get(cache_key)
+        if cached_response is not None:
+            return cached_response, True
+
+        query_response: str | None = await self.aquery_llamaindex(query_text, response_mode, collection_name,
+                                                                  retrieval_mode)
+        if query_response is not None:
+            self.query_cache.put(cache_key, query_response)
+        return query_response, False
+
+    async def astream_with_cache(self, query_text: str, response_mode: str = None, collection_name: str = "default",
+                                 retrieval_mode: RetrievalMode | None = None) -> tuple[Iterator[str], bool]:
+        if response_mode is None:
+            response_mode = self.response_mode
+        retrieval_mode = self.resolve_retrieval_mode(retrieval_mode)
+
+        cache_key: tuple = self.query_cache.key(self.resolve_collection_name(collection_name), query_text,
+                                                response_mode, self.top_k, retrieval_mode.value)
+        cached_response: str | None = self.query_cache.get(cache_key)
+        if cached_response is not None:
+            return iter([cached_response]), True
+
+        from llama_index.response.schema import StreamingResponse
+
+        # llama-index only streams from the synchronous query path, so retrieval and all but the last
+        # synthesis step run in a worker thread and the final LLM call is streamed as it is consumed
+        query_engine: BaseQueryEngine = await asyncio.to_thread(self.get_query_engine, response_mode,
+                                                                collection_name, True, retrieval_mode)
+        query_result: Response | StreamingResponse = await asyncio.to_thread(query_engine.query, query_text)
+
+        def tokens() -> Iterator[str]:
+            if not isinstance(query_result, StreamingResponse):
+                # Nothing was retrieved, so the synthesizer answered without calling the LLM
+                yield query_result.response
+                return
+            parts: list[str] = []
+            for token in query_result.response_gen:
+                parts.append(token)
+                yield token
+            self.query_cache.put(cache_key, "".join(parts))
+
+        return tokens(), False
+
+    def load_file(self, file_path: str, file_name: str, collection_name: str, incremental: bool = False,
+                  on_parsed: Callable[[], None] = None, job: IngestionJob = None) -> None:
+        active_collection: Collection = self.get_upload_collection(collection_name)
+        self.sync_registry(active_collection, incremental)
+        try:
+            self.ingestor.process_file(file_name, file_path, active_collection, job, incremental, on_parsed)
+        finally:
+            self.after_ingestion(active_collection)
+
+    def load_files(self, files: Iterable[tuple[str, str, Callable[[], None] | None]], collection_name: str,
+                   incremental: bool = False, job: IngestionJob = None) -> None:
+        active_collection: Collection = self.get_upload_collection(collection_name)
+        self.sync_registry(active_collection, incremental)
+        try:
+            self.ingestor.process_files(files, active_collection, job, incremental)
+        finally:
+            self.after_ingestion(active_collection)
+
+    def load_file_bytes(self, file_bytes: bytes, file_name: str, collection_name: str, incremental: bool = False,
+                        job: IngestionJob = None) -> None:
+        active_collection: Collection = self.get_upload_collection(collection_name)
+        self.sync_registry(active_collection, incremental)
+        try:
+            self.ingestor.load_file_bytes(file_bytes, file_name, active_collection, job, incremental)
+        finally:
+            self.after_ingestion(active_collection)
 
-        return query_response
+    def sync_registry(self, active_collection: Collection, incremental: bool) -> None:
+        # Incremental uploads look up earlier versions in the registry, which has to know what other processes
+        # ingested
+        if incremental and self.generations is not None:
+            self.registry.reconcile(active_collection)
 
-    def load_file_bytes(self, file_bytes: bytes, file_name: str, collection_name: str) -> None:
-        active_collection: Collection = self.get_or_create_collection(collection_name)
-        self.ingestor.load_file_bytes(file_bytes, file_name, active_collection)
+    def after_ingestion(self, active_collection: Collection) -> None:
+        self.collection_changed(active_collection.name)
+        # Adding chunks loads the collection's index, it counts towards the cache's budget like a queried one
+        self.indices.track(active_collection.name)
@@ -1,17 +1,181 @@
+import array
+import hashlib
+import os
+import sqlite3
+import threading
+import time
 from typing import List, Any
 
+import httpx
+from chromadb import EmbeddingFunction, Documents, Embeddings as ChromaEmbeddings
 from langchain_core.embeddings import Embeddings
 from pydantic import BaseModel
+from tenacity import Retrying, retry_if_exception, stop_after_attempt, wait_random_exponential
+
+from metrics import timed
 
 
 class PassThroughEmbeddings(BaseModel, Embeddings):
 
     embed_fn: Any = None
+    # Queries rarely repeat and the query cache already answers repeated ones, so they skip the embedding cache
+    query_embed_fn: Any = None
 
     def embed_documents(self, texts: List[str]) -> List[List[float]]:
         result = self.embed_fn(texts)
         return result
 
     def embed_query(self, text: str) -> List[float]:
-        result = self.embed_fn([text])[0]
+        with timed("query_embedding"):
+            result = (self.query_embed_fn or self.embed_fn)([text])[0]
         return result
+
+
+def is_retryable_error(error: BaseException) -> bool:
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code == 429 or error.response.status_code >= 500
+    return isinstance(error, httpx.TransportError)
+
+
+class PooledOpenAIEmbeddingFunction(EmbeddingFunction[Documents]):
+    """Calls an OpenAI-compatible /embeddings endpoint over a shared, pooled HTTP client.
+
+    Transient failures (connection errors, 429 and 5xx responses) are retried with jittered exponential backoff.
+    """
+
+    def __init__(
+            self,
+            api_base: str,
+            api_key: str,
+            model_name: str,
+            verify: bool = True,
+            max_connections: int = 8,
+            max_retries: int = 5,
+            timeout: float = 120.0
+    ):
+        self.model_name = model_name
+        self.max_retries = max_retries
+        self.http_client: httpx.Client = httpx.Client(
+            base_url=api_base,
+            headers={"Authorization": f"Bearer {api_key}"},
+            verify=verify,
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+        )
+
+    def __call__(self, input: Documents) -> ChromaEmbeddings:
+        for attempt in Retrying(stop=stop_after_attempt(self.max_retries),
+                                wait=wait_random_exponential(multiplier=0.5, max=30),
+                                retry=retry_if_exception(is_retryable_error),
+                                reraise=True):
+            with attempt:
+                response: httpx.Response = self.http_client.post("embeddings",
+                                                                 json={"model": self.model_name, "input": input})
+                response.raise_for_status()
+
+        # The API may return embeddings out of order, so restore the order of the inputs
+        data: list[dict] = sorted(response.json()["data"], key=lambda e: e["index"])
+        return [e["embedding"] for e in data]
+
+
+class EmbeddingCacheStats(BaseModel):
+    entries: int
+    max_entries: int
+    hits: int
+    misses: int
+    hit_ratio: float
+
+
+class CachedEmbeddingFunction(EmbeddingFunction[Documents]):
+    """Content-addressed embedding cache in front of another embedding function.
+
+    Vectors are stored in SQLite keyed by (model name, SHA-256 of the text) and the least recently used
+    entries are evicted once the cache holds more than ``max_entries`` vectors. Hits are only recorded in memory and
+    written with the next store, so lookups never write to the database.
+    """
+
+    # Pending hits are written anyway once there are this many, for caches that only see hits
+    max_pending_touches: int = 10000
+
+    def __init__(self, embed_fn: EmbeddingFunction, model_name: str, path: str, max_entries: int):
+        self.embed_fn = embed_fn
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.hits: int = 0
+        self.misses: int = 0
+        self.lock: threading.Lock = threading.Lock()
+        # Hashes found since last_used was last written, with when they were used
+        self.touched: dict[str, float] = {}
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.connection: sqlite3.Connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS embeddings (model TEXT NOT NULL, hash TEXT NOT NULL, "
+                                "vector BLOB NOT NULL, last_used REAL NOT NULL, PRIMARY KEY (model, hash))")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self.connection.commit()
+        self.entries: int = self.connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def __call__(self, input: Documents) -> ChromaEmbeddings:
+        hashes: list[str] = [hashlib.sha256(text.encode()).hexdigest() for text in input]
+        cached: dict[str, list[float]] = self.lookup(set(hashes))
+
+        missing: dict[str, str] = {h: text for h, text in zip(hashes, input) if h not in cached}
+        if len(missing) > 0:
+            vectors: ChromaEmbeddings = self.embed_fn(list(missing.values()))
+            computed: dict[str, list[float]] = dict(zip(missing.keys(), vectors))
+            self.store(computed)
+            cached.update(computed)
+
+        with self.lock:
+            self.hits += len(input) - len(missing)
+            self.misses += len(missing)
+
+        return [cached[h] for h in hashes]
+
+    def lookup(self, hashes: set[str]) -> dict[str, list[float]]:
+        found: dict[str, list[float]] = {}
+        keys: list[str] = list(hashes)
+        with self.lock:
+            # Stay under SQLite's bound parameter limit
+            for start in range(0, len(keys), 500):
+                batch: list[str] = keys[start:start + 500]
+                rows = self.connection.execute(
+                    f"SELECT hash, vector FROM embeddings WHERE model = ? AND hash IN ({','.join('?' * len(batch))})",
+                    [self.model_name, *batch]).fetchall()
+                for h, vector in rows:
+                    found[h] = array.array("f", vector).tolist()
+            now: float = time.time()
+            self.touched.update((h, now) for h in found)
+            if len(self.touched) >= self.max_pending_touches:
+                self.write_touches()
+                self.connection.commit()
+        return found
+
+    def write_touches(self) -> None:
+        # Called with the lock held, the caller commits
+        self.connection.executemany("UPDATE embeddings SET last_used = ? WHERE model = ? AND hash = ?",
+                                    [(used, self.model_name, h) for h, used in self.touched.items()])
+        self.touched.clear()
+
+    def store(self, vectors: dict[str, list[float]]) -> None:
+        now: float = time.time()
+        with self.lock:
+            # Eviction has to see which entries were used recently
+            self.write_touches()
+            cursor: sqlite3.Cursor = self.connection.executemany(
+                "INSERT OR IGNORE INTO embeddings (model, hash, vector, last_used) VALUES (?, ?, ?, ?)",
+                [(self.model_name, h, array.array("f", vector).tobytes(), now) for h, vector in vectors.items()])
+            self.entries += cursor.rowcount
+            if self.entries > self.max_entries:
+                self.connection.execute("DELETE FROM embeddings WHERE rowid IN "
+                                        "(SELECT rowid FROM embeddings ORDER BY last_used LIMIT ?)",
+                                        (self.entries - self.max_entries,))
+                self.entries = self.max_entries
+            self.connection.commit()
+
+    def stats(self) -> EmbeddingCacheStats:
+        with self.lock:
+            total: int = self.hits + self.misses
+            return EmbeddingCacheStats(entries=self.entries, max_entries=self.max_entries, hits=self.hits,
+                                       misses=self.misses, hit_ratio=self.hits / total if total > 0 else 0.0)
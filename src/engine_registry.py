@@ -0,0 +1,42 @@
+import threading
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Callable
+
+if TYPE_CHECKING:
+    from llama_index.core.base_query_engine import BaseQueryEngine
+
+
+class QueryEngineRegistry:
+    """LRU of built query engines keyed by (collection, response mode, top k, streaming, retrieval mode).
+
+    Building a query engine creates its retriever, response synthesizer and prompt helper, so engines are
+    reused across requests and dropped when their collection is deleted.
+    """
+
+    def __init__(self, build_engine: Callable[[str, str, int, bool, str], "BaseQueryEngine"], max_entries: int):
+        self.build_engine = build_engine
+        self.max_entries = max_entries
+        self.engines: OrderedDict[tuple[str, str, int, bool, str], BaseQueryEngine] = OrderedDict()
+        # Re-entrant, building an engine can unload another collection and evict its engines
+        self.lock: threading.RLock = threading.RLock()
+
+    def get(self, collection_name: str, response_mode: str, top_k: int, streaming: bool = False,
+            retrieval_mode: str = "vector") -> "BaseQueryEngine":
+        key: tuple[str, str, int, bool, str] = (collection_name, response_mode, top_k, streaming, retrieval_mode)
+        with self.lock:
+            engine: BaseQueryEngine | None = self.engines.get(key)
+            if engine is not None:
+                self.engines.move_to_end(key)
+                return engine
+
+            engine = self.build_engine(collection_name, response_mode, top_k, streaming, retrieval_mode)
+            if self.max_entries > 0:
+                self.engines[key] = engine
+                while len(self.engines) > self.max_entries:
+                    self.engines.popitem(last=False)
+            return engine
+
+    def evict_collection(self, collection_name: str) -> None:
+        with self.lock:
+            for key in [key for key in self.engines if key[0] == collection_name]:
+                del self.engines[key]
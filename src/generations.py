@@ -0,0 +1,38 @@
+import os
+import sqlite3
+import threading
+
+
+class CollectionGenerations:
+    """Per-collection change counters in a SQLite database that every process writing to Chroma can reach.
+
+    A process that changes a collection bumps its generation. Other processes compare it with the generation
+    their own caches were filled at, so uploads and deletes made by ingestion workers or other API replicas
+    reach them too.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock: threading.Lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.connection: sqlite3.Connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS generations (collection TEXT PRIMARY KEY, "
+                                "generation INTEGER NOT NULL)")
+        self.connection.commit()
+
+    def get(self, collection_name: str) -> int:
+        with self.lock:
+            row: tuple | None = self.connection.execute("SELECT generation FROM generations WHERE collection = ?",
+                                                        (collection_name,)).fetchone()
+        return 0 if row is None else row[0]
+
+    def bump(self, collection_name: str) -> int:
+        # Returns the new generation
+        with self.lock:
+            generation: int = self.connection.execute(
+                "INSERT INTO generations VALUES (?, 1) "
+                "ON CONFLICT (collection) DO UPDATE SET generation = generation + 1 RETURNING generation",
+                (collection_name,)).fetchone()[0]
+            self.connection.commit()
+        return generation
@@ -0,0 +1,246 @@
+import logging
+import os
+import random
+import time
+from typing import Iterable, Iterator
+
+import numpy as np
+from chromadb import ClientAPI, GetResult
+from chromadb.api.models import Collection
+from chromadb.segment import VectorReader
+from chromadb.types import SegmentScope
+from pydantic import BaseModel, Field
+
+from compact_vectors import CompactVectors, collection_space, distances
+
+# Collection metadata keys Chroma reads its HNSW parameters from, they only take effect when a collection is created
+HNSW_METADATA_KEYS: dict[str, str] = {
+    "space": "hnsw:space",
+    "M": "hnsw:M",
+    "construction_ef": "hnsw:construction_ef",
+    "search_ef": "hnsw:search_ef",
+    "batch_size": "hnsw:batch_size",
+    "sync_threshold": "hnsw:sync_threshold",
+}
+HNSW_ENV_VARS: dict[str, str] = {
+    "space": "HNSW_SPACE",
+    "M": "HNSW_M",
+    "construction_ef": "HNSW_CONSTRUCTION_EF",
+    "search_ef": "HNSW_SEARCH_EF",
+    "batch_size": "HNSW_BATCH_SIZE",
+    "sync_threshold": "HNSW_SYNC_THRESHOLD",
+}
+
+
+class HnswConfig(BaseModel):
+    space: str | None = Field(default=None, pattern="^(l2|cosine|ip)$", description="Distance function")
+    M: int | None = Field(default=None, ge=2, description="Links per node, more improves recall and costs memory")
+    construction_ef: int | None = Field(default=None, ge=1, description="Candidate list size while building")
+    search_ef: int | None = Field(default=None, ge=1, description="Candidate list size while searching")
+    batch_size: int | None = Field(default=None, gt=2, description="Embeddings buffered before they are indexed")
+    sync_threshold: int | None = Field(default=None, gt=2, description="Embeddings indexed before a sync to disk")
+
+    @staticmethod
+    def from_env() -> "HnswConfig":
+        values: dict[str, str] = {field: os.environ.get(env_var) for field, env_var in HNSW_ENV_VARS.items()}
+        return HnswConfig(**{field: value for field, value in values.items() if value})
+
+    def collection_metadata(self) -> dict:
+        return {HNSW_METADATA_KEYS[field]: value for field, value in self.model_dump().items() if value is not None}
+
+    def merged_with(self, overrides: "HnswConfig") -> "HnswConfig":
+        return HnswConfig(**{**self.model_dump(exclude_none=True), **overrides.model_dump(exclude_none=True)})
+
+
+class IndexStats(BaseModel):
+    collection_name: str
+    elements: int
+    indexed_elements: int | None = None
+    buffered_elements: int | None = None
+    max_elements: int | None = None
+    dimensions: int | None = None
+    space: str | None = None
+    M: int | None = None
+    construction_ef: int | None = None
+    search_ef: int | None = None
+    batch_size: int | None = None
+    sync_threshold: int | None = None
+    size_bytes: int | None = None
+    memory_bytes: int | None = None
+
+
+class RecallPoint(BaseModel):
+    search_ef: int
+    recall: float
+    latency_ms: float
+    meets_target: bool
+
+
+class RecallReport(BaseModel):
+    collection_name: str
+    samples: int
+    top_k: int
+    compact: bool
+    target_recall: float
+    brute_force_latency_ms: float
+    points: list[RecallPoint]
+
+
+# Chroma has no public API for its HNSW index, everything below reaches into the internals of the pinned chromadb
+# version. They only exist for a local (embedded) client, and where they are missing the index is left alone.
+
+def vector_segment(client: ClientAPI, collection: Collection):
+    manager = getattr(getattr(client, "_server", None), "_manager", None)
+    if manager is None:
+        return None
+    try:
+        return manager.get_segment(collection.id, VectorReader)
+    except AttributeError as e:
+        logging.warning(f"Can't reach the HNSW index of collection {collection.name} in this chromadb version.  {e}")
+        return None
+
+
+def unload_vector_segment(client: ClientAPI, collection: Collection) -> bool:
+    # Chroma never unloads an index by itself. The next read or write of the collection loads it from disk again and
+    # replays the writes made since it was last persisted, so nothing is lost.
+    manager = getattr(getattr(client, "_server", None), "_manager", None)
+    if manager is None:
+        return False
+    try:
+        with manager._lock:
+            segment = manager._segment_cache.get(collection.id, {}).get(SegmentScope.VECTOR)
+            instance = manager._instances.pop(segment["id"], None) if segment is not None else None
+            # The file handle LRU holds on to loaded segments too
+            file_handles = getattr(manager, "_vector_instances_file_handle_cache", None)
+            if file_handles is not None:
+                file_handles.cache.pop(collection.id, None)
+        if instance is None:
+            return False
+        instance.stop()
+        instance.close_persistent_index()
+    except AttributeError as e:
+        logging.warning(f"Can't unload the HNSW index of collection {collection.name} in this chromadb version.  {e}")
+        return False
+    return True
+
+
+def index_stats(client: ClientAPI, collection: Collection) -> IndexStats:
+    stats: IndexStats = IndexStats(collection_name=collection.name, elements=collection.count())
+    segment = vector_segment(client, collection)
+    if segment is None:
+        return stats
+    try:
+        hnsw_stats(stats, segment)
+    except AttributeError as e:
+        logging.warning(f"Can't read the HNSW index of collection {collection.name} in this chromadb version.  {e}")
+        return IndexStats(collection_name=collection.name, elements=stats.elements)
+    return stats
+
+
+def hnsw_stats(stats: IndexStats, segment) -> None:
+    params = segment._params
+    stats.space, stats.M, stats.construction_ef = params.space, params.M, params.construction_ef
+    stats.search_ef, stats.batch_size, stats.sync_threshold = params.search_ef, params.batch_size, \
+        params.sync_threshold
+    stats.buffered_elements = segment._curr_batch.add_count
+    folder: str = segment._get_storage_folder()
+    if os.path.isdir(folder):
+        stats.size_bytes = sum(os.path.getsize(os.path.join(folder, name)) for name in os.listdir(folder))
+
+    index = segment._index
+    if index is not None:
+        stats.indexed_elements = index.element_count
+        stats.max_elements = index.max_elements
+        stats.dimensions = index.dim
+        # hnswlib keeps every slot of level 0 (vector, 2M links and a label) in memory, upper levels are small
+        level0_bytes: int = index.dim * 4 + (2 * index.M + 1) * 4 + 8
+        link_lists_path: str = os.path.join(folder, "link_lists.bin")
+        link_lists_bytes: int = os.path.getsize(link_lists_path) if os.path.exists(link_lists_path) else 0
+        stats.memory_bytes = index.max_elements * level0_bytes + link_lists_bytes
+
+
+def chroma_pages(collection: Collection, page_size: int = 10000) -> Iterator[tuple[list[str], np.ndarray]]:
+    offset: int = 0
+    while True:
+        page: GetResult = collection.get(include=['embeddings'], limit=page_size, offset=offset)
+        if len(page['ids']) > 0:
+            yield page['ids'], np.array(page['embeddings'], dtype=np.float32)
+        if len(page['ids']) < page_size:
+            return
+        offset += page_size
+
+
+def brute_force_neighbours(pages: Iterable[tuple[list[str], np.ndarray]], space: str, queries: np.ndarray,
+                           top_k: int) -> list[list[str]]:
+    # Exact top k over every stored embedding, read a page at a time so large collections fit in memory
+    best_ids: list[np.ndarray] = [np.array([], dtype=object) for _ in queries]
+    best_distances: list[np.ndarray] = [np.array([]) for _ in queries]
+    for ids, vectors in pages:
+        page_ids: np.ndarray = np.array(ids, dtype=object)
+        page_distances: np.ndarray = distances(space, vectors, queries)
+        for idx in range(len(queries)):
+            candidates: np.ndarray = np.concatenate([best_distances[idx], page_distances[idx]])
+            candidate_ids: np.ndarray = np.concatenate([best_ids[idx], page_ids])
+            keep: np.ndarray = np.argsort(candidates, kind="stable")[:top_k]
+            best_distances[idx], best_ids[idx] = candidates[keep], candidate_ids[keep]
+    return [list(ids) for ids in best_ids]
+
+
+def check_recall(client: ClientAPI, collection: Collection, samples: int, top_k: int, search_efs: list[int],
+                 target_recall: float, compact_vectors: CompactVectors | None = None) -> RecallReport:
+    """Compares HNSW results with an exact search for stored embeddings used as queries.
+
+    For a compact collection both sides use the full vectors, so the report covers the projection and the
+    re-scoring as well as HNSW. Each ``search_ef`` is applied to the loaded index only while it is measured,
+    queries running at the same time use it too. The collection's configured ``search_ef`` is restored afterwards.
+    """
+    count: int = collection.count()
+    offsets: list[int] = sorted(random.sample(range(count), min(samples, count)))
+    sampled: list[GetResult] = [collection.get(include=['embeddings'], limit=1, offset=offset) for offset in offsets]
+    if compact_vectors is not None:
+        full_vectors: dict[str, np.ndarray] = compact_vectors.get(collection.name,
+                                                                  [sample['ids'][0] for sample in sampled])
+        queries: np.ndarray = np.array([full_vectors[sample['ids'][0]] for sample in sampled
+                                       if sample['ids'][0] in full_vectors])
+        pages: Iterable[tuple[list[str], np.ndarray]] = compact_vectors.iter_pages(collection.name)
+    else:
+        queries: np.ndarray = np.array([sample['embeddings'][0] for sample in sampled], dtype=np.float32)
+        pages: Iterable[tuple[list[str], np.ndarray]] = chroma_pages(collection)
+    report: RecallReport = RecallReport(collection_name=collection.name, samples=len(queries), top_k=top_k,
+                                        compact=compact_vectors is not None, target_recall=target_recall,
+                                        brute_force_latency_ms=0, points=[])
+    if len(queries) == 0:
+        return report
+
+    started: float = time.perf_counter()
+    exact: list[list[str]] = brute_force_neighbours(pages, collection_space(collection), queries, top_k)
+    report.brute_force_latency_ms = round((time.perf_counter() - started) * 1000 / len(queries), 3)
+
+    segment = vector_segment(client, collection)
+    index = getattr(segment, "_index", None)
+    configured_ef: int | None = getattr(getattr(segment, "_params", None), "search_ef", None)
+    try:
+        for search_ef in search_efs or [configured_ef or 10]:
+            if index is not None:
+                index.set_ef(search_ef)
+            found: int = 0
+            started = time.perf_counter()
+            for query, expected in zip(queries, exact):
+                if compact_vectors is not None:
+                    candidates: list[str] = collection.query(
+                        query_embeddings=[compact_vectors.project(collection, query).tolist()],
+                        n_results=top_k * compact_vectors.oversample, include=[])['ids'][0]
+                    ids: list[str] = [chunk_id for chunk_id, _ in
+                                      compact_vectors.rescore(collection, query.tolist(), candidates, top_k)]
+                else:
+                    ids: list[str] = collection.query(query_embeddings=[query.tolist()], n_results=top_k,
+                                                      include=[])['ids'][0]
+                found += len(set(ids) & set(expected))
+            latency_ms: float = (time.perf_counter() - started) * 1000 / len(queries)
+            recall: float = round(found / sum(map(len, exact)), 4)
+            report.points.append(RecallPoint(search_ef=search_ef, recall=recall, latency_ms=round(latency_ms, 3),
+                                             meets_target=recall >= target_recall))
+    finally:
+        if index is not None and configured_ef is not None:
+            index.set_ef(configured_ef)
+    return report
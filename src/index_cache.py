@@ -0,0 +1,82 @@
+import threading
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Callable
+
+if TYPE_CHECKING:
+    from llama_index import VectorStoreIndex
+
+
+class IndexCache:
+    """LRU of collections whose vector index is loaded in memory, bounded by the indices' estimated size.
+
+    Loading a collection that takes the total over ``max_bytes`` unloads the least recently used others, they are
+    loaded again the next time they are queried. Sizes are measured outside the lock, only for the collection being
+    loaded or ingested into, so a collection that grew through ingestion is accounted at its current size without
+    touching Chroma for the others.
+    """
+
+    def __init__(self, build_index: Callable[[str], "VectorStoreIndex"], measure: Callable[[str], int],
+                 unload: Callable[[str], None], max_bytes: int):
+        self.build_index = build_index
+        self.measure = measure
+        self.unload = unload
+        self.max_bytes = max_bytes
+        self.indices: dict[str, VectorStoreIndex] = {}
+        # Collections whose index is in memory, least recently used first, with their estimated size in bytes.
+        # Collections loaded by ingestion are tracked without a VectorStoreIndex until they are queried.
+        self.sizes: OrderedDict[str, int] = OrderedDict()
+        self.lock: threading.Lock = threading.Lock()
+
+    def get(self, collection_name: str) -> "VectorStoreIndex":
+        with self.lock:
+            index: VectorStoreIndex | None = self.indices.get(collection_name)
+            if index is not None:
+                self.sizes.move_to_end(collection_name)
+                return index
+        # Loading a large index from disk must not hold up queries of collections that are already loaded
+        index = self.build_index(collection_name)
+        self.track(collection_name, index)
+        return index
+
+    def track(self, collection_name: str, index: "VectorStoreIndex | None" = None) -> None:
+        size: int = self.measure(collection_name)
+        with self.lock:
+            if index is not None:
+                self.indices.setdefault(collection_name, index)
+            victims: list[str] = self.admit(collection_name, size)
+        # Unloading drops the collections' query engines, which must not happen under this lock
+        for victim in victims:
+            self.unload(victim)
+
+    def touch(self, collection_name: str) -> None:
+        with self.lock:
+            if collection_name in self.sizes:
+                self.sizes.move_to_end(collection_name)
+
+    def discard(self, collection_name: str) -> None:
+        with self.lock:
+            self.indices.pop(collection_name, None)
+            self.sizes.pop(collection_name, None)
+
+    def loaded(self) -> dict[str, int]:
+        with self.lock:
+            return dict(self.sizes)
+
+    def admit(self, collection_name: str, size: int) -> list[str]:
+        # Called with the lock held, returns the collections to unload to get back under max_bytes
+        self.sizes[collection_name] = size
+        self.sizes.move_to_end(collection_name)
+        if self.max_bytes <= 0:
+            return []
+
+        victims: list[str] = []
+        total: int = sum(self.sizes.values())
+        for name in list(self.sizes):
+            if total <= self.max_bytes:
+                break
+            if name == collection_name:
+                continue
+            total -= self.sizes.pop(name)
+            self.indices.pop(name, None)
+            victims.append(name)
+        return victims
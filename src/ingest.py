@@ -1,53 +1,71 @@
+import hashlib
+import multiprocessing
 import os
 import tempfile
+import threading
+import time
 import uuid
-from typing import List
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import TYPE_CHECKING, Callable, Iterable, List
 import logging
 
+from chromadb import GetResult
 from chromadb.api.models import Collection
-from langchain.docstore.document import Document
-from langchain.text_splitter import TokenTextSplitter
-from langchain_community.document_loaders import (CSVLoader, Docx2txtLoader,
-                                                  TextLoader,
-                                                  UnstructuredFileLoader,
-                                                  UnstructuredHTMLLoader,
-                                                  UnstructuredMarkdownLoader,
-                                                  UnstructuredPowerPointLoader,
-                                                  UnstructuredExcelLoader)
-from langchain_community.document_loaders import PyPDFLoader
+
+from chunking import ChunkingStrategy, TextChunker
+from compact_vectors import CompactVectors, compact_dimensions
+from document_registry import DocumentRegistry
+from jobs import IngestionJob, JobStatus
+from lexical_index import LexicalIndex
+from metrics import observe_stage, timed
+
+if TYPE_CHECKING:
+    from langchain.docstore.document import Document
 
 
 # Chroma
 
-def load_file(file_path) -> List[Document]:
+def load_file(file_path) -> List["Document"]:
+    # Loaders are imported for the first file of their type, most deployments only ever see a few types
     _, file_extension = os.path.splitext(file_path)
     data: List[Document]
     if file_extension.lower() == '.txt':
+        from langchain_community.document_loaders import TextLoader
         loader = TextLoader(file_path)
         return loader.load()
     elif file_extension.lower() == '.pdf':
+        from langchain_community.document_loaders import PyPDFLoader
         loader = PyPDFLoader(file_path)
         return loader.load()
     elif file_extension.lower() == '.html':
+        from langchain_community.document_loaders import UnstructuredHTMLLoader
         loader = UnstructuredHTMLLoader(file_path)
         return loader.load()
     elif file_extension.lower() == '.md':
+        from langchain_community.document_loaders import UnstructuredMarkdownLoader
         loader = UnstructuredMarkdownLoader(file_path)
         return loader.load()
     elif file_extension.lower() == '.csv':
+        from langchain_community.document_loaders import CSVLoader
         loader = CSVLoader(file_path)
         return loader.load()
     elif file_extension.lower() == '.pptx':
+        from langchain_community.document_loaders import UnstructuredPowerPointLoader
         loader = UnstructuredPowerPointLoader(file_path)
         return loader.load()
     elif file_extension.lower() == '.docx':
+        from langchain_community.document_loaders import Docx2txtLoader
         loader = Docx2txtLoader(file_path)
         return loader.load()
     elif file_extension.lower() == '.xls' or file_extension.lower() == '.xlsx':
+        from langchain_community.document_loaders import UnstructuredExcelLoader
         loader = UnstructuredExcelLoader(file_path, mode="elements")
         return loader.load()
     else:
         # Perform action for other files or skip
+        from langchain_community.document_loaders import UnstructuredFileLoader
         return UnstructuredFileLoader(file_path).load()
 
 
@@ -58,37 +76,374 @@ def update_metadata(file_name: str, doc_uuid: str, idx: int, metadata: dict) ->
     return metadata
 
 
-def get_uuids_for_document_texts(texts: list[Document]) -> list[str]:
+def get_uuids_for_document_texts(texts: list[str]) -> list[str]:
     return [str(uuid.uuid4()) for idx in enumerate(texts)]
 
 
+def get_content_ids_for_document_texts(file_name: str, texts: list[str]) -> list[str]:
+    # Deterministic IDs so an unchanged chunk keeps its ID across uploads, repeated chunks are told apart
+    # by how many times the same text has already appeared in the document
+    occurrences: dict[str, int] = {}
+    ids: list[str] = []
+    for text in texts:
+        text_hash: str = hashlib.sha256(text.encode()).hexdigest()
+        occurrence: int = occurrences.get(text_hash, 0)
+        occurrences[text_hash] = occurrence + 1
+        ids.append(hashlib.sha256(f"{file_name}\0{text_hash}\0{occurrence}".encode()).hexdigest())
+    return ids
+
+
+def prepare_chunks(file_name: str, doc_uuid: str, contents: list[str], metadatas: list[dict],
+                   incremental: bool) -> tuple[list[dict], list[str]]:
+    all_metadata: list[dict] = [update_metadata(file_name, doc_uuid, idx, metadata)
+                                for idx, metadata in enumerate(metadatas)]
+    if incremental:
+        return all_metadata, get_content_ids_for_document_texts(file_name, contents)
+    return all_metadata, get_uuids_for_document_texts(contents)
+
+
+def hash_file(file_path: str) -> str:
+    file_hash = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        while len(block := f.read(1024 * 1024)) > 0:
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+# Parsing
+
+# One chunker per process and setting, so the tokenizer is loaded once and shared by every file
+_chunkers: dict[tuple[int, int, ChunkingStrategy], TextChunker] = {}
+
+
+def warm_parser(chunk_size: int, chunk_overlap: int,
+                strategy: ChunkingStrategy = ChunkingStrategy.TOKEN) -> TextChunker:
+    key: tuple[int, int, ChunkingStrategy] = (chunk_size, chunk_overlap, strategy)
+    if key not in _chunkers:
+        os.environ["TIKTOKEN_CACHE_DIR"] = "tokenizer-cache"
+        _chunkers[key] = TextChunker(chunk_size, chunk_overlap, strategy)
+    return _chunkers[key]
+
+
+def split_file(file_path: str, chunk_size: int, chunk_overlap: int,
+               strategy: ChunkingStrategy = ChunkingStrategy.TOKEN) -> tuple[list[str], list[dict], dict[str, float]]:
+    # Returns only plain chunk text, metadata and stage timings so results are cheap to send back from a parser
+    # process, which can't record metrics itself
+    chunker: TextChunker = warm_parser(chunk_size, chunk_overlap, strategy)
+    started: float = time.perf_counter()
+    data: list[Document] = load_file(file_path=file_path)
+    loaded: float = time.perf_counter()
+    contents, metadatas = chunker.split_documents(data)
+    timings: dict[str, float] = {"load_file": loaded - started, "split_documents": time.perf_counter() - loaded}
+    return contents, metadatas, timings
+
+
 class Ingest:
-    def __init__(self, collection: Collection, chunk_size: int, chunk_overlap: int):
+    def __init__(self, collection: Collection, chunk_size: int, chunk_overlap: int, registry: DocumentRegistry,
+                 parser_workers: int = 0, embedding_batch_size: int = 64, embedding_concurrency: int = 4,
+                 lexical_index: LexicalIndex | None = None, compact_vectors: CompactVectors | None = None,
+                 chunking_strategy: ChunkingStrategy = ChunkingStrategy.TOKEN):
         self.collection = collection
+        self.registry = registry
+        self.lexical_index = lexical_index
+        self.compact_vectors = compact_vectors
         self.chunk_size = chunk_size
         self.chunk_overlap = chunk_overlap
+        self.chunking_strategy = chunking_strategy
+        self.embedding_batch_size = embedding_batch_size
+        self.embedding_concurrency = embedding_concurrency
+        # Shared by every ingestion job so the total number of in-flight embedding requests stays bounded
+        self.embedding_pool: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=embedding_concurrency,
+                                                                     thread_name_prefix="embed")
+        self.parser_workers = parser_workers
+        self.parser_pool: ProcessPoolExecutor | None = None
+        self.parser_pool_lock: threading.Lock = threading.Lock()
 
-    def process_file(self, file_name: str, file_path: str, active_collection: Collection) -> None:
-        os.environ["TIKTOKEN_CACHE_DIR"] = "tokenizer-cache"
-        # disallowed_special is set so that technical documents that contain special tokens can be loaded
-        text_splitter = TokenTextSplitter(chunk_size=self.chunk_size, chunk_overlap=self.chunk_overlap,
-                                          disallowed_special=())
+    def parser(self) -> ProcessPoolExecutor:
+        # Started on first use rather than on import: fork server children import the script that started the app
+        # again (python main.py), and must not start pools of their own
+        with self.parser_pool_lock:
+            if self.parser_pool is None:
+                self.parser_pool = self.start_parser_pool()
+            return self.parser_pool
+
+    def start_parser_pool(self) -> ProcessPoolExecutor:
+        # Forking a process that already runs executor threads and holds SQLite connections can copy held locks
+        # into the children, the fork server starts them from a clean process instead
+        pool: ProcessPoolExecutor = ProcessPoolExecutor(max_workers=self.parser_workers, initializer=warm_parser,
+                                                        initargs=(self.chunk_size, self.chunk_overlap,
+                                                                  self.chunking_strategy),
+                                                        mp_context=multiprocessing.get_context("forkserver"))
+        # Start the workers now so the first upload does not pay for process startup
+        for _ in range(self.parser_workers):
+            pool.submit(time.sleep, 0)
+        return pool
+
+    def restart_parser_pool(self, broken: ProcessPoolExecutor) -> None:
+        with self.parser_pool_lock:
+            # Every file that was being parsed sees the pool break, only the first one replaces it
+            if self.parser_pool is not broken:
+                return
+            self.parser_pool = self.start_parser_pool()
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    def parse_file(self, file_path: str) -> tuple[list[str], list[dict]]:
+        if self.parser_workers == 0:
+            contents, metadatas, timings = split_file(file_path, self.chunk_size, self.chunk_overlap,
+                                                      self.chunking_strategy)
+        else:
+            pool: ProcessPoolExecutor = self.parser()
+            try:
+                contents, metadatas, timings = pool.submit(split_file, file_path, self.chunk_size, self.chunk_overlap,
+                                                           self.chunking_strategy).result()
+            except BrokenProcessPool:
+                # A parser process died (e.g. a crashing native loader), replace the pool so later uploads still
+                # work
+                logging.error(f"parse_file: Parser pool broke while parsing {file_path}, restarting it")
+                self.restart_parser_pool(pool)
+                raise
+        for stage, seconds in timings.items():
+            observe_stage(stage, seconds)
+        return contents, metadatas
+
+    def add_chunks(self, active_collection: Collection, contents: list[str], metadatas: list[dict],
+                   ids: list[str]) -> None:
+        # Embedded here rather than by Chroma so embedding and storage are timed apart
+        with timed("embedding"):
+            embeddings: list[list[float]] = active_collection._embedding_function(contents)
+        with timed("collection_add"):
+            if self.compact_vectors is not None and compact_dimensions(active_collection) is not None:
+                self.compact_vectors.add(active_collection, contents, metadatas, ids, embeddings)
+            else:
+                active_collection.add(documents=contents, metadatas=metadatas, ids=ids, embeddings=embeddings)
+            if self.lexical_index is not None:
+                self.lexical_index.add(active_collection.name, ids, contents, metadatas)
+
+    def update_chunks(self, active_collection: Collection, metadatas: list[dict], ids: list[str]) -> None:
+        active_collection.update(ids=ids, metadatas=metadatas)
+        if self.lexical_index is not None:
+            self.lexical_index.update_metadata(active_collection.name, ids, metadatas)
+
+    def delete_chunks(self, active_collection: Collection, ids: list[str]) -> None:
+        active_collection.delete(ids=ids)
+        if self.lexical_index is not None:
+            self.lexical_index.delete(active_collection.name, ids)
+        if self.compact_vectors is not None and compact_dimensions(active_collection) is not None:
+            self.compact_vectors.delete(active_collection.name, ids)
+
+    def add_in_batches(self, contents: list[str], metadatas: list[dict], ids: list[str],
+                       active_collection: Collection, job: IngestionJob = None) -> None:
+        futures: dict[Future, int] = {}
+        if job is not None:
+            job.batches += -(-len(contents) // self.embedding_batch_size)
+        for start in range(0, len(contents), self.embedding_batch_size):
+            end: int = start + self.embedding_batch_size
+            future: Future = self.embedding_pool.submit(self.add_chunks, active_collection, contents[start:end],
+                                                        metadatas[start:end], ids[start:end])
+            futures[future] = len(contents[start:end])
+
+        try:
+            for future in as_completed(futures):
+                future.result()
+                if job is not None:
+                    job.embedded_chunks += futures[future]
+                    job.batches_done += 1
+                logging.debug(f"Embedded batch of {futures[future]} parts into collection {active_collection.name}")
+        except Exception:
+            for future in futures:
+                future.cancel()
+            # Batches that already started can't be cancelled, deleting before they land would leave their chunks
+            # behind
+            wait(futures)
+            # Don't leave a partially embedded document behind in the collection
+            self.delete_chunks(active_collection, ids)
+            raise
+
+    def update_document(self, existing: tuple[str, str | None, int], file_name: str, file_size: int,
+                        file_hash: str, contents: list[str], metadatas: list[dict], ids: list[str],
+                        active_collection: Collection, job: IngestionJob = None) -> None:
+        doc_uuid, previous_hash, previous_size = existing
+        previous_ids: list[str] = self.registry.chunk_ids(active_collection.name, [doc_uuid])
+        previous_id_set: set[str] = set(previous_ids)
+        added: list[int] = [idx for idx, chunk_id in enumerate(ids) if chunk_id not in previous_id_set]
+        if previous_hash is None:
+            # The previous ingestion never finished, some of its chunks may be missing from the collection. All
+            # chunks are added again, Chroma skips the ones it already has.
+            added = list(range(len(ids)))
+        kept: list[int] = [idx for idx, chunk_id in enumerate(ids) if chunk_id in previous_id_set]
+        stale: list[str] = list(previous_id_set - set(ids))
+        logging.debug(f"File {file_name} changed: {len(added)} parts added, {len(stale)} removed, {len(kept)} kept")
+
+        # Register old and new chunks together while both are in the collection
+        self.registry.add_document(active_collection.name, doc_uuid, file_name, previous_size,
+                                   previous_ids + [ids[idx] for idx in added], previous_hash)
         try:
-            data: list[Document] = load_file(file_path=file_path)
-            texts: list[Document] = text_splitter.split_documents(data)
-            contents: list[str] = [d.page_content for d in texts]
-            doc_uuid: str = str(uuid.uuid4())
-            all_metadata: list[dict] = [update_metadata(file_name, doc_uuid, idx, d.metadata)
-                                        for idx, d in enumerate(texts)]
-            ids: list[str] = get_uuids_for_document_texts(texts)
+            self.add_in_batches([contents[idx] for idx in added], [metadatas[idx] for idx in added],
+                                [ids[idx] for idx in added], active_collection, job)
+        except Exception:
+            self.registry.add_document(active_collection.name, doc_uuid, file_name, previous_size, previous_ids,
+                                       previous_hash)
+            raise
+
+        if len(kept) > 0:
+            # Positions may have shifted, metadata-only updates don't re-embed
+            self.update_chunks(active_collection, [metadatas[idx] for idx in kept], [ids[idx] for idx in kept])
+        if len(stale) > 0:
+            self.delete_chunks(active_collection, stale)
+        self.registry.add_document(active_collection.name, doc_uuid, file_name, file_size, ids, file_hash)
+        if job is not None:
+            job.chunks_removed += len(stale)
+
+    def process_file(self, file_name: str, file_path: str, active_collection: Collection,
+                     job: IngestionJob = None, incremental: bool = False,
+                     on_parsed: Callable[[], None] = None) -> None:
+        try:
+            if self.resume_file(file_name, active_collection, job):
+                return
+            file_hash: str = hash_file(file_path)
+            file_size: int = os.path.getsize(file_path)
+            existing: tuple[str, str | None, int] | None = None
+            if incremental:
+                existing = self.registry.find_document(active_collection.name, file_name)
+            if existing is not None and existing[1] == file_hash:
+                logging.debug(f"File {file_name} is unchanged in collection {active_collection.name}, skipping")
+                if job is not None:
+                    job.unchanged = True
+                return
+
+            if job is not None:
+                job.set_status(JobStatus.PARSING)
+            started: float = time.time()
+            contents, metadatas = self.parse_file(file_path)
+            if on_parsed is not None:
+                on_parsed()
+            if job is not None:
+                job.record_timing("parsing", started)
+                job.chunks = len(contents)
+            doc_uuid: str = str(uuid.uuid4()) if existing is None else existing[0]
+            all_metadata, ids = prepare_chunks(file_name, doc_uuid, contents, metadatas, incremental)
             logging.debug(f"Found {len(contents)} parts in file {file_path}")
-            active_collection.add(documents=contents, metadatas=all_metadata, ids=ids)
+            if job is not None:
+                job.set_status(JobStatus.EMBEDDING)
+            started = time.time()
+            if existing is not None:
+                self.update_document(existing, file_name, file_size, file_hash, contents, all_metadata, ids,
+                                     active_collection, job)
+            else:
+                if job is not None:
+                    job.start_document(file_name, doc_uuid)
+                self.registry.add_document(active_collection.name, doc_uuid, file_name, file_size, ids)
+                try:
+                    self.add_in_batches(contents, all_metadata, ids, active_collection, job)
+                except Exception:
+                    self.registry.remove_documents(active_collection.name, [doc_uuid])
+                    if job is not None:
+                        job.pending_documents.pop(file_name, None)
+                    raise
+                self.registry.add_document(active_collection.name, doc_uuid, file_name, file_size, ids, file_hash)
+            if job is not None:
+                job.complete_document(file_name, doc_uuid)
+                job.record_timing("embedding", started)
             # split and load into vector db
             logging.debug(f"File {file_name} loaded into collection {active_collection.name}")
         except Exception as e:
             logging.error(f"process_file: Error parsing file {file_path}.  {e}")
+            if job is not None:
+                job.error = str(e)
+                job.set_status(JobStatus.FAILED)
+
+    def process_files(self, files: Iterable[tuple[str, str, Callable[[], None] | None]],
+                      active_collection: Collection, job: IngestionJob = None, incremental: bool = False) -> None:
+        # files yields (file name, file path, called once the file has been parsed)
+        batches: SharedBatches = SharedBatches(self, active_collection, job)
+        if job is not None:
+            job.set_status(JobStatus.PARSING)
+        try:
+            for file_name, file_path, on_parsed in files:
+                if job is not None:
+                    job.files += 1
+                try:
+                    self.queue_file(batches, file_name, file_path, active_collection, job, incremental, on_parsed)
+                except Exception as e:
+                    logging.error(f"process_files: Error parsing file {file_path}.  {e}")
+                    if job is not None:
+                        job.failed_files[file_name] = str(e)
+                finally:
+                    if on_parsed is not None:
+                        on_parsed()
+        finally:
+            if job is not None:
+                job.set_status(JobStatus.EMBEDDING)
+            started: float = time.time()
+            batches.finish()
+            if job is not None:
+                job.record_timing("embedding", started)
+
+        if job is not None and len(job.failed_files) == job.files:
+            job.error = "No files were ingested" if job.files == 0 else "Every file failed to ingest"
+            job.set_status(JobStatus.FAILED)
+        logging.debug(f"Batch of files loaded into collection {active_collection.name}")
+
+    def queue_file(self, batches: "SharedBatches", file_name: str, file_path: str, active_collection: Collection,
+                   job: IngestionJob = None, incremental: bool = False,
+                   on_parsed: Callable[[], None] = None) -> None:
+        if self.resume_file(file_name, active_collection, job):
+            job.files_done += 1
+            return
+
+        file_hash: str = hash_file(file_path)
+        file_size: int = os.path.getsize(file_path)
+        existing: tuple[str, str | None, int] | None = None
+        if incremental:
+            existing = self.registry.find_document(active_collection.name, file_name)
+        if existing is not None and existing[1] == file_hash:
+            logging.debug(f"File {file_name} is unchanged in collection {active_collection.name}, skipping")
+            if job is not None:
+                job.files_unchanged += 1
+                job.files_done += 1
+            return
+
+        started: float = time.time()
+        contents, metadatas = self.parse_file(file_path)
+        if on_parsed is not None:
+            on_parsed()
+        if job is not None:
+            job.record_timing("parsing", started)
+            job.chunks += len(contents)
+        doc_uuid: str = str(uuid.uuid4()) if existing is None else existing[0]
+        all_metadata, ids = prepare_chunks(file_name, doc_uuid, contents, metadatas, incremental)
+        logging.debug(f"Found {len(contents)} parts in file {file_path}")
+        if existing is not None:
+            # Changed documents are diffed against their previous chunks on their own
+            self.update_document(existing, file_name, file_size, file_hash, contents, all_metadata, ids,
+                                 active_collection, job)
+            if job is not None:
+                job.complete_document(file_name, doc_uuid)
+                job.files_done += 1
+        else:
+            batches.add_document(doc_uuid, file_name, file_size, file_hash, contents, all_metadata, ids)
+
+    def resume_file(self, file_name: str, active_collection: Collection, job: IngestionJob = None) -> bool:
+        # Returns whether an earlier attempt of the job already ingested the file. A new document an attempt was
+        # still adding when it was cut off (its worker died) is removed, the file is ingested again from scratch.
+        if job is None:
+            return False
+        if file_name in job.documents:
+            logging.debug(f"File {file_name} was ingested by an earlier attempt of job {job.id}, skipping")
+            return True
+        doc_uuid: str | None = job.pending_documents.pop(file_name, None)
+        if doc_uuid is not None:
+            logging.warning(f"Removing document {doc_uuid} of {file_name} left behind by an interrupted attempt of "
+                            f"job {job.id}")
+            # This worker's registry may not know the document, its chunks are found by their metadata
+            stored: GetResult = active_collection.get(where={"uuid": doc_uuid}, include=[])
+            if len(stored['ids']) > 0:
+                self.delete_chunks(active_collection, stored['ids'])
+            self.registry.remove_documents(active_collection.name, [doc_uuid])
+        return False
 
-    def load_file_bytes(self, file_bytes: bytes, file_name: str, active_collection: Collection = None) -> None:
+    def load_file_bytes(self, file_bytes: bytes, file_name: str, active_collection: Collection = None,
+                        job: IngestionJob = None, incremental: bool = False) -> None:
         # If not specified, use the default collection
         if active_collection is None:
             active_collection = self.collection
@@ -97,4 +452,103 @@ class Ingest:
         with tempfile.NamedTemporaryFile(delete=False, suffix=file_extension, prefix=file_name) as fp:
             fp.write(file_bytes)
             fp.close()
-            self.process_file(file_name, fp.name, active_collection)
+            try:
+                self.process_file(file_name, fp.name, active_collection, job, incremental)
+            finally:
+                os.remove(fp.name)
+
+
+class SharedBatches:
+    """Embeds the chunks of many documents in shared batches of ``embedding_batch_size``, one Chroma add each.
+
+    A document is registered before its first chunk is queued and only gets its file hash once its last batch
+    has been added. A document with a failed batch is removed as a whole once every batch has finished.
+    """
+
+    def __init__(self, ingestor: Ingest, active_collection: Collection, job: IngestionJob = None):
+        self.ingestor = ingestor
+        self.active_collection = active_collection
+        self.job = job
+        # Enough batches in flight to keep every embedding worker busy without buffering a whole corpus
+        self.max_inflight_batches: int = max(ingestor.embedding_concurrency, 1) * 2
+        self.contents: list[str] = []
+        self.metadatas: list[dict] = []
+        self.ids: list[str] = []
+        self.owners: list[str] = []
+        self.futures: dict[Future, list[str]] = {}
+        self.documents: dict[str, tuple[str, int, str, list[str]]] = {}
+        self.remaining: dict[str, int] = {}
+        self.failed: dict[str, str] = {}
+
+    def add_document(self, doc_uuid: str, file_name: str, file_size: int, file_hash: str, contents: list[str],
+                     metadatas: list[dict], ids: list[str]) -> None:
+        if self.job is not None:
+            self.job.start_document(file_name, doc_uuid)
+        self.ingestor.registry.add_document(self.active_collection.name, doc_uuid, file_name, file_size, ids)
+        self.documents[doc_uuid] = (file_name, file_size, file_hash, ids)
+        self.remaining[doc_uuid] = len(ids)
+        if len(ids) == 0:
+            self.complete(doc_uuid)
+            return
+
+        self.contents.extend(contents)
+        self.metadatas.extend(metadatas)
+        self.ids.extend(ids)
+        self.owners.extend([doc_uuid] * len(ids))
+        while len(self.ids) >= self.ingestor.embedding_batch_size:
+            self.flush(self.ingestor.embedding_batch_size)
+
+    def flush(self, size: int) -> None:
+        future: Future = self.ingestor.embedding_pool.submit(self.ingestor.add_chunks, self.active_collection,
+                                                             self.contents[:size], self.metadatas[:size],
+                                                             self.ids[:size])
+        self.futures[future] = self.owners[:size]
+        del self.contents[:size], self.metadatas[:size], self.ids[:size], self.owners[:size]
+        if self.job is not None:
+            self.job.batches += 1
+
+        while len(self.futures) > self.max_inflight_batches:
+            done, _ = wait(self.futures, return_when=FIRST_COMPLETED)
+            self.collect(done)
+
+    def collect(self, done: Iterable[Future]) -> None:
+        for future in done:
+            owners: list[str] = self.futures.pop(future)
+            try:
+                future.result()
+            except Exception as e:
+                logging.error(f"Embedding batch for collection {self.active_collection.name} failed.  {e}")
+                for doc_uuid in set(owners):
+                    self.failed.setdefault(doc_uuid, str(e))
+                continue
+
+            if self.job is not None:
+                self.job.embedded_chunks += len(owners)
+                self.job.batches_done += 1
+            logging.debug(f"Embedded batch of {len(owners)} parts into collection {self.active_collection.name}")
+            for doc_uuid, count in Counter(owners).items():
+                self.remaining[doc_uuid] -= count
+                if self.remaining[doc_uuid] == 0 and doc_uuid not in self.failed:
+                    self.complete(doc_uuid)
+
+    def complete(self, doc_uuid: str) -> None:
+        file_name, file_size, file_hash, ids = self.documents[doc_uuid]
+        self.ingestor.registry.add_document(self.active_collection.name, doc_uuid, file_name, file_size, ids,
+                                            file_hash)
+        if self.job is not None:
+            self.job.complete_document(file_name, doc_uuid)
+            self.job.files_done += 1
+
+    def finish(self) -> None:
+        if len(self.ids) > 0:
+            self.flush(len(self.ids))
+        self.collect(list(self.futures))
+
+        for doc_uuid, error in self.failed.items():
+            file_name, _, _, ids = self.documents[doc_uuid]
+            # Don't leave a partially embedded document behind in the collection
+            self.ingestor.delete_chunks(self.active_collection, ids)
+            self.ingestor.registry.remove_documents(self.active_collection.name, [doc_uuid])
+            if self.job is not None:
+                self.job.pending_documents.pop(file_name, None)
+                self.job.failed_files[file_name] = error
@@ -0,0 +1,451 @@
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+from typing import Callable
+
+from pydantic import BaseModel, Field, PrivateAttr
+
+
+class JobStatus(str, Enum):
+    QUEUED = "queued"
+    PARSING = "parsing"
+    EMBEDDING = "embedding"
+    DONE = "done"
+    FAILED = "failed"
+
+
+class IngestionJob(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    filename: str
+    collection_name: str
+    status: JobStatus = JobStatus.QUEUED
+    chunks: int = 0
+    embedded_chunks: int = 0
+    batches: int = 0
+    batches_done: int = 0
+    chunks_removed: int = 0
+    unchanged: bool = False
+    files: int = 0
+    files_done: int = 0
+    files_unchanged: int = 0
+    failed_files: dict[str, str] = Field(default_factory=dict)
+    # UUID of each file's document once it is in the collection, and of the new documents whose chunks are being
+    # added. Both are kept across attempts, an attempt that was cut off leaves its pending documents to the next one.
+    documents: dict[str, str] = Field(default_factory=dict)
+    pending_documents: dict[str, str] = Field(default_factory=dict)
+    error: str | None = None
+    attempts: int = 0
+    created_at: float = Field(default_factory=time.time)
+    started_at: float | None = None
+    finished_at: float | None = None
+    timings: dict[str, float] = Field(default_factory=dict)
+    # Set by a durable queue to write the job before chunks are added, not part of the job itself
+    _checkpoint: Callable[["IngestionJob"], None] | None = PrivateAttr(default=None)
+
+    def start_document(self, file_name: str, doc_uuid: str) -> None:
+        self.pending_documents[file_name] = doc_uuid
+        if self._checkpoint is not None:
+            self._checkpoint(self)
+
+    def complete_document(self, file_name: str, doc_uuid: str) -> None:
+        self.pending_documents.pop(file_name, None)
+        self.documents[file_name] = doc_uuid
+        if self._checkpoint is not None:
+            self._checkpoint(self)
+
+    def set_status(self, status: JobStatus) -> None:
+        now: float = time.time()
+        if self.started_at is None and status is not JobStatus.QUEUED:
+            self.started_at = now
+        if status in (JobStatus.DONE, JobStatus.FAILED):
+            self.finished_at = now
+        self.status = status
+
+    def record_timing(self, stage: str, started: float) -> None:
+        self.timings[stage] = round(self.timings.get(stage, 0) + time.time() - started, 4)
+
+
+FINISHED_STATUSES: tuple[JobStatus, ...] = (JobStatus.DONE, JobStatus.FAILED)
+
+
+def failed_files(job: IngestionJob) -> dict[str, str]:
+    # The files a job couldn't ingest with their errors, a failed single upload has no failed_files of its own
+    if len(job.failed_files) > 0:
+        return dict(job.failed_files)
+    if job.status is JobStatus.FAILED:
+        return {job.filename: job.error or "Ingestion failed"}
+    return {}
+
+
+def restart_job(job: IngestionJob) -> IngestionJob:
+    # Progress starts over, files whose documents an earlier attempt ingested are skipped and the documents it was
+    # still adding are removed first
+    return IngestionJob(id=job.id, filename=job.filename, collection_name=job.collection_name,
+                        created_at=job.created_at, attempts=job.attempts, error=job.error, documents=job.documents,
+                        pending_documents=job.pending_documents)
+
+
+class DeadLetter(BaseModel):
+    job_id: str
+    collection_name: str
+    # File name and the error it failed with on the last attempt
+    files: dict[str, str]
+    attempts: int
+    failed_at: float
+
+
+class IngestionTask(BaseModel):
+    # (file name, spooled path) of each uploaded file, archives are expanded when they are ingested
+    files: list[tuple[str, str]]
+    collection_name: str
+    incremental: bool = False
+    # Files uploaded together share embedding batches, a single upload reports its own chunk counts
+    batch: bool = False
+
+
+class IngestionQueueType(str, Enum):
+    MEMORY = "memory"
+    SQLITE = "sqlite"
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class IngestionScheduler:
+    """Runs ingestion tasks in this process on a fixed number of workers with a bounded backlog.
+
+    Submissions beyond ``workers + max_queued`` outstanding jobs are rejected with
+    a ``QueueFullError`` rather than queued without limit.
+    """
+
+    def __init__(self, workers: int, max_queued: int, run_task: Callable[[IngestionTask, IngestionJob], None],
+                 max_retained_jobs: int = 1000):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.run_task = run_task
+        self.max_retained_jobs = max_retained_jobs
+        self.executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=workers,
+                                                               thread_name_prefix="ingest")
+        self.slots: threading.BoundedSemaphore = threading.BoundedSemaphore(workers + max_queued)
+        self.jobs: OrderedDict[str, IngestionJob] = OrderedDict()
+        self.lock: threading.Lock = threading.Lock()
+
+    def submit(self, job: IngestionJob, task: IngestionTask) -> IngestionJob:
+        if not self.slots.acquire(blocking=False):
+            raise QueueFullError(f"Ingestion queue is full ({self.workers + self.max_queued} outstanding jobs)")
+
+        with self.lock:
+            self.jobs[job.id] = job
+            self._trim_jobs()
+
+        try:
+            self.executor.submit(self._run, job, task)
+        except RuntimeError:
+            self.slots.release()
+            raise
+
+        return job
+
+    def get_job(self, job_id: str) -> IngestionJob | None:
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def outstanding(self) -> int:
+        with self.lock:
+            return sum(1 for job in self.jobs.values() if job.status not in FINISHED_STATUSES)
+
+    def queued(self) -> int:
+        with self.lock:
+            return sum(1 for job in self.jobs.values() if job.status is JobStatus.QUEUED)
+
+    def dead_letters(self, collection_name: str | None = None, limit: int = 100) -> list[DeadLetter]:
+        # Jobs aren't retried in memory, every finished job with failed files is a dead letter while it is retained
+        with self.lock:
+            jobs: list[IngestionJob] = [job for job in reversed(self.jobs.values())
+                                        if job.status in FINISHED_STATUSES and
+                                        (collection_name is None or job.collection_name == collection_name)]
+        letters: list[DeadLetter] = [DeadLetter(job_id=job.id, collection_name=job.collection_name,
+                                                files=failed_files(job), attempts=job.attempts,
+                                                failed_at=job.finished_at) for job in jobs]
+        return [letter for letter in letters if len(letter.files) > 0][:limit]
+
+    def start(self) -> None:
+        # The executor starts its threads as tasks are submitted
+        pass
+
+    def shutdown(self, wait: bool = True) -> None:
+        self.executor.shutdown(wait=wait)
+
+    def _run(self, job: IngestionJob, task: IngestionTask) -> None:
+        job.attempts = 1
+        try:
+            self.run_task(task, job)
+            if job.status is not JobStatus.FAILED:
+                job.set_status(JobStatus.DONE)
+        except Exception as e:
+            logging.error(f"Ingestion job {job.id} for {job.filename} failed.  {e}")
+            job.error = str(e)
+            job.set_status(JobStatus.FAILED)
+        finally:
+            self.slots.release()
+
+    def _trim_jobs(self) -> None:
+        # Only finished jobs are dropped, oldest first, so in-flight status is never lost
+        excess: int = len(self.jobs) - self.max_retained_jobs
+        if excess <= 0:
+            return
+        for job_id in [job_id for job_id, job in self.jobs.items()
+                       if job.status in FINISHED_STATUSES][:excess]:
+            del self.jobs[job_id]
+
+
+class SqliteIngestionQueue:
+    """Durable ingestion queue in a SQLite database, which API replicas and ingestion workers can share.
+
+    Every accepted upload is journaled with its spooled files until it has been ingested, so work that was queued or
+    running when a process stopped is picked up again when it restarts. Processes with ``workers > 0`` claim queued
+    tasks and run them, holding a lease they renew while the task runs, together with the job's progress. A task
+    whose lease ran out, because its worker died or was restarted, is claimed again by the next free worker.
+
+    A task that fails, or that has files which failed, is retried incrementally after a back-off, so files that made
+    it into the collection are skipped. After ``max_attempts`` its failures are kept as a dead letter, and
+    ``release_task`` is called with the task once it is done either way. Submissions are rejected with a
+    ``QueueFullError`` once ``max_queued`` tasks are waiting for a worker.
+    """
+
+    def __init__(self, path: str, workers: int, max_queued: int,
+                 run_task: Callable[[IngestionTask, IngestionJob], None],
+                 release_task: Callable[[IngestionTask], None] | None = None, max_attempts: int = 3,
+                 retry_seconds: float = 30, lease_seconds: float = 60, poll_seconds: float = 1,
+                 max_retained_jobs: int = 1000):
+        self.path = path
+        self.workers = workers
+        self.max_queued = max_queued
+        self.run_task = run_task
+        self.release_task = release_task
+        self.max_attempts = max_attempts
+        self.retry_seconds = retry_seconds
+        self.lease_seconds = lease_seconds
+        self.poll_seconds = poll_seconds
+        self.max_retained_jobs = max_retained_jobs
+        self.worker_id: str = f"{socket.gethostname()}-{os.getpid()}"
+        # Jobs running in this process, their progress is newer than the database's
+        self.running: dict[str, IngestionJob] = {}
+        self.stopping: threading.Event = threading.Event()
+        # Set when this process submits a task, so its own workers don't wait for the next poll
+        self.submitted: threading.Event = threading.Event()
+        self.threads: list[threading.Thread] = []
+        self.lock: threading.Lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # Other processes hold the database's write lock for short transactions, wait for them
+        self.connection: sqlite3.Connection = sqlite3.connect(path, check_same_thread=False, timeout=30,
+                                                              isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, status TEXT NOT NULL, "
+                                "task TEXT NOT NULL, job TEXT NOT NULL, created_at REAL NOT NULL, "
+                                "worker TEXT, lease_expires_at REAL, available_at REAL NOT NULL DEFAULT 0)")
+        if "available_at" not in [column[1] for column in self.connection.execute("PRAGMA table_info(jobs)")]:
+            self.connection.execute("ALTER TABLE jobs ADD COLUMN available_at REAL NOT NULL DEFAULT 0")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS dead_letters (job_id TEXT PRIMARY KEY, "
+                                "collection TEXT NOT NULL, letter TEXT NOT NULL, failed_at REAL NOT NULL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS dead_letters_failed_at "
+                                "ON dead_letters (collection, failed_at)")
+
+    def submit(self, job: IngestionJob, task: IngestionTask) -> IngestionJob:
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                if self.connection.execute("SELECT COUNT(*) FROM jobs WHERE status = ?",
+                                           (JobStatus.QUEUED.value,)).fetchone()[0] >= self.max_queued:
+                    raise QueueFullError(f"Ingestion queue is full ({self.max_queued} queued jobs)")
+                self.connection.execute("INSERT INTO jobs (id, status, task, job, created_at) VALUES (?, ?, ?, ?, ?)",
+                                        (job.id, job.status.value, task.model_dump_json(), job.model_dump_json(),
+                                         job.created_at))
+                self.connection.execute("COMMIT")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+        self.submitted.set()
+        return job
+
+    def get_job(self, job_id: str) -> IngestionJob | None:
+        with self.lock:
+            job: IngestionJob | None = self.running.get(job_id)
+            if job is not None:
+                return job
+            row: tuple | None = self.connection.execute("SELECT job FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return None if row is None else IngestionJob.model_validate_json(row[0])
+
+    def outstanding(self) -> int:
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM jobs WHERE status NOT IN (?, ?)",
+                                           [status.value for status in FINISHED_STATUSES]).fetchone()[0]
+
+    def queued(self) -> int:
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM jobs WHERE status = ?",
+                                           (JobStatus.QUEUED.value,)).fetchone()[0]
+
+    def pending_files(self) -> set[str]:
+        # Spooled paths of every task that hasn't finished, they must stay in the spool
+        with self.lock:
+            rows: list[tuple] = self.connection.execute("SELECT task FROM jobs WHERE status NOT IN (?, ?)",
+                                                        [status.value for status in FINISHED_STATUSES]).fetchall()
+        return {file_path for row in rows for _, file_path in IngestionTask.model_validate_json(row[0]).files}
+
+    def dead_letters(self, collection_name: str | None = None, limit: int = 100) -> list[DeadLetter]:
+        with self.lock:
+            if collection_name is None:
+                rows: list[tuple] = self.connection.execute(
+                    "SELECT letter FROM dead_letters ORDER BY failed_at DESC LIMIT ?", (limit,)).fetchall()
+            else:
+                rows = self.connection.execute(
+                    "SELECT letter FROM dead_letters WHERE collection = ? ORDER BY failed_at DESC LIMIT ?",
+                    (collection_name, limit)).fetchall()
+        return [DeadLetter.model_validate_json(row[0]) for row in rows]
+
+    def start(self) -> None:
+        if self.threads:
+            return
+        if self.workers > 0:
+            with self.lock:
+                # A container restarted in place comes back with the same worker ID, whatever that ID was running
+                # died with the previous process and doesn't have to wait for its lease to run out
+                self.connection.execute("UPDATE jobs SET lease_expires_at = 0 WHERE worker = ? AND status NOT IN "
+                                        "(?, ?)", (self.worker_id, *[status.value for status in FINISHED_STATUSES]))
+        for idx in range(self.workers):
+            thread: threading.Thread = threading.Thread(target=self._work, name=f"ingest-{idx}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def shutdown(self, wait: bool = True) -> None:
+        # Running tasks are finished, an interrupted one would be claimed again once its lease runs out
+        self.stopping.set()
+        self.submitted.set()
+        if wait:
+            for thread in self.threads:
+                thread.join()
+
+    def claim(self) -> tuple[IngestionJob, IngestionTask] | None:
+        now: float = time.time()
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                row: tuple | None = self.connection.execute(
+                    "SELECT id, task, job FROM jobs WHERE (status = ? AND available_at <= ?) "
+                    "OR (status NOT IN (?, ?) AND lease_expires_at < ?) ORDER BY created_at LIMIT 1",
+                    (JobStatus.QUEUED.value, now, *[status.value for status in FINISHED_STATUSES], now)).fetchone()
+                if row is None:
+                    self.connection.execute("COMMIT")
+                    return None
+                job: IngestionJob = IngestionJob.model_validate_json(row[2])
+                if job.status is not JobStatus.QUEUED:
+                    logging.warning(f"Ingestion job {job.id} lost its worker, running it again")
+                    job = restart_job(job)
+                job.attempts += 1
+                job.set_status(JobStatus.PARSING)
+                self.connection.execute("UPDATE jobs SET status = ?, job = ?, worker = ?, lease_expires_at = ? "
+                                        "WHERE id = ?", (job.status.value, job.model_dump_json(), self.worker_id,
+                                                         now + self.lease_seconds, job.id))
+                self.connection.execute("COMMIT")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.running[job.id] = job
+        return job, IngestionTask.model_validate_json(row[1])
+
+    def save(self, job: IngestionJob) -> None:
+        # Writes the job's progress and extends its lease, unless another worker has taken it over
+        with self.lock:
+            self.connection.execute("UPDATE jobs SET status = ?, job = ?, lease_expires_at = ? "
+                                    "WHERE id = ? AND worker = ?",
+                                    (job.status.value, job.model_dump_json(), time.time() + self.lease_seconds,
+                                     job.id, self.worker_id))
+            if job.status in FINISHED_STATUSES:
+                self.running.pop(job.id, None)
+                self._trim_jobs()
+
+    def retry(self, job: IngestionJob, task: IngestionTask) -> None:
+        retried: IngestionJob = restart_job(job)
+        delay: float = self.retry_seconds * 2 ** (job.attempts - 1)
+        logging.warning(f"Ingestion job {job.id} failed attempt {job.attempts} of {self.max_attempts}, "
+                        f"retrying in {delay}s")
+        with self.lock:
+            self.connection.execute("UPDATE jobs SET status = ?, task = ?, job = ?, worker = NULL, "
+                                    "lease_expires_at = NULL, available_at = ? WHERE id = ? AND worker = ?",
+                                    (retried.status.value, task.model_dump_json(), retried.model_dump_json(),
+                                     time.time() + delay, job.id, self.worker_id))
+            self.running.pop(job.id, None)
+
+    def finish(self, job: IngestionJob, task: IngestionTask) -> None:
+        failures: dict[str, str] = failed_files(job)
+        if len(failures) > 0 and job.attempts < self.max_attempts:
+            self.retry(job, task)
+            return
+
+        if self.release_task is not None:
+            try:
+                self.release_task(task)
+            except Exception as e:
+                logging.error(f"Could not release the files of ingestion job {job.id}.  {e}")
+        if job.status is not JobStatus.FAILED:
+            job.set_status(JobStatus.DONE)
+        if len(failures) > 0:
+            logging.error(f"Ingestion job {job.id} gave up on {len(failures)} files after {job.attempts} attempts")
+            letter: DeadLetter = DeadLetter(job_id=job.id, collection_name=job.collection_name, files=failures,
+                                            attempts=job.attempts, failed_at=job.finished_at or time.time())
+            with self.lock:
+                self.connection.execute("INSERT OR REPLACE INTO dead_letters VALUES (?, ?, ?, ?)",
+                                        (job.id, job.collection_name, letter.model_dump_json(), letter.failed_at))
+        self.save(job)
+
+    def _work(self) -> None:
+        while not self.stopping.is_set():
+            try:
+                claimed: tuple[IngestionJob, IngestionTask] | None = self.claim()
+            except sqlite3.Error as e:
+                logging.error(f"Could not claim an ingestion job.  {e}")
+                claimed = None
+            if claimed is None:
+                self.submitted.wait(self.poll_seconds)
+                self.submitted.clear()
+                continue
+            self._run(*claimed)
+
+    def _run(self, job: IngestionJob, task: IngestionTask) -> None:
+        finished: threading.Event = threading.Event()
+
+        def renew_lease() -> None:
+            while not finished.wait(self.lease_seconds / 3):
+                self.save(job)
+
+        renewer: threading.Thread = threading.Thread(target=renew_lease, name=f"lease-{job.id}", daemon=True)
+        renewer.start()
+        job._checkpoint = self.save
+        try:
+            self.run_task(task, job)
+        except Exception as e:
+            logging.error(f"Ingestion job {job.id} for {job.filename} failed.  {e}")
+            job.error = str(e)
+            job.set_status(JobStatus.FAILED)
+        finally:
+            finished.set()
+            renewer.join()
+        self.finish(job, task)
+
+    def _trim_jobs(self) -> None:
+        # Called with the lock held, only finished jobs are dropped, oldest first
+        self.connection.execute("DELETE FROM jobs WHERE id IN (SELECT id FROM jobs WHERE status IN (?, ?) "
+                                "ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                                (*[status.value for status in FINISHED_STATUSES], self.max_retained_jobs))
+        self.connection.execute("DELETE FROM dead_letters WHERE job_id IN (SELECT job_id FROM dead_letters "
+                                "ORDER BY failed_at DESC LIMIT -1 OFFSET ?)", (self.max_retained_jobs,))
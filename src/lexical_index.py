@@ -0,0 +1,160 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+
+from chromadb import GetResult
+from chromadb.api.models import Collection
+
+from generations import CollectionGenerations
+
+
+def match_expression(query_text: str) -> str | None:
+    # Every term is quoted so identifiers like "AB-1234" or "v2.1" can't be read as FTS5 query syntax
+    terms: list[str] = [term.strip(".-/") for term in re.findall(r"[\w.\-/]+", query_text)]
+    terms = [term for term in terms if term != ""]
+    if len(terms) == 0:
+        return None
+    return " OR ".join('"' + term.replace('"', '""') + '"' for term in dict.fromkeys(terms))
+
+
+class LexicalIndex:
+    """SQLite FTS5 index of chunk text, one table per collection, ranked with BM25.
+
+    Chunks are added and removed together with their Chroma embeddings, so lexical search needs no
+    embedding call. Collections with chunks the index hasn't seen are re-indexed from Chroma. With ``generations``
+    set, other processes write to the same Chroma server too, and a collection is re-indexed when another process
+    bumped its generation since the index last matched it.
+    """
+
+    def __init__(self, path: str, generations: CollectionGenerations | None = None):
+        self.path = path
+        self.generations = generations
+        self.synced: dict[str, int] = {}
+        self.lock: threading.Lock = threading.Lock()
+        self.tables: set[str] = set()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.connection: sqlite3.Connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+
+    @staticmethod
+    def table(collection_name: str) -> str:
+        return "lexical_" + hashlib.sha256(collection_name.encode()).hexdigest()[:32]
+
+    def ensure_table(self, collection_name: str) -> str:
+        # Called with the lock held
+        table: str = self.table(collection_name)
+        if table in self.tables:
+            return table
+        self.connection.execute(f"CREATE TABLE IF NOT EXISTS {table}_chunks (rowid INTEGER PRIMARY KEY, "
+                                f"chunk_id TEXT NOT NULL UNIQUE, text TEXT NOT NULL, metadata TEXT NOT NULL)")
+        self.connection.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {table} USING fts5("
+                                f"text, content='{table}_chunks', content_rowid='rowid')")
+        # Keep the FTS index in step with the chunk table it is built from
+        self.connection.execute(f"CREATE TRIGGER IF NOT EXISTS {table}_insert AFTER INSERT ON {table}_chunks BEGIN "
+                                f"INSERT INTO {table} (rowid, text) VALUES (new.rowid, new.text); END")
+        self.connection.execute(f"CREATE TRIGGER IF NOT EXISTS {table}_delete AFTER DELETE ON {table}_chunks BEGIN "
+                                f"INSERT INTO {table} ({table}, rowid, text) VALUES ('delete', old.rowid, old.text); "
+                                f"END")
+        self.connection.commit()
+        self.tables.add(table)
+        return table
+
+    def add(self, collection_name: str, ids: list[str], contents: list[str], metadatas: list[dict]) -> None:
+        with self.lock:
+            table: str = self.ensure_table(collection_name)
+            # Replacing has to go through a delete so the trigger removes the old text from the FTS index
+            self.connection.executemany(f"DELETE FROM {table}_chunks WHERE chunk_id = ?",
+                                        [(chunk_id,) for chunk_id in ids])
+            self.connection.executemany(f"INSERT INTO {table}_chunks (chunk_id, text, metadata) VALUES (?, ?, ?)",
+                                        [(chunk_id, text, json.dumps(metadata))
+                                         for chunk_id, text, metadata in zip(ids, contents, metadatas)])
+            self.connection.commit()
+
+    def update_metadata(self, collection_name: str, ids: list[str], metadatas: list[dict]) -> None:
+        with self.lock:
+            table: str = self.ensure_table(collection_name)
+            self.connection.executemany(f"UPDATE {table}_chunks SET metadata = ? WHERE chunk_id = ?",
+                                        [(json.dumps(metadata), chunk_id)
+                                         for chunk_id, metadata in zip(ids, metadatas)])
+            self.connection.commit()
+
+    def delete(self, collection_name: str, ids: list[str]) -> None:
+        with self.lock:
+            table: str = self.ensure_table(collection_name)
+            self.connection.executemany(f"DELETE FROM {table}_chunks WHERE chunk_id = ?",
+                                        [(chunk_id,) for chunk_id in ids])
+            self.connection.commit()
+
+    def search(self, collection_name: str, query_text: str, top_k: int) -> list[tuple[str, str, dict, float]]:
+        # Returns (chunk id, text, metadata, score) with the best match first, higher scores are better
+        expression: str | None = match_expression(query_text)
+        if expression is None:
+            return []
+        with self.lock:
+            table: str = self.ensure_table(collection_name)
+            rows: list[tuple] = self.connection.execute(
+                f"SELECT c.chunk_id, c.text, c.metadata, bm25({table}) AS rank FROM {table} "
+                f"JOIN {table}_chunks c ON c.rowid = {table}.rowid WHERE {table} MATCH ? ORDER BY rank LIMIT ?",
+                (expression, top_k)).fetchall()
+        # FTS5 reports BM25 as a negative number where lower is better
+        return [(chunk_id, text, json.loads(metadata), -rank) for chunk_id, text, metadata, rank in rows]
+
+    def count(self, collection_name: str) -> int:
+        with self.lock:
+            table: str = self.ensure_table(collection_name)
+            return self.connection.execute(f"SELECT COUNT(*) FROM {table}_chunks").fetchone()[0]
+
+    def drop_collection(self, collection_name: str) -> None:
+        table: str = self.table(collection_name)
+        with self.lock:
+            self.connection.execute(f"DROP TABLE IF EXISTS {table}")
+            self.connection.execute(f"DROP TABLE IF EXISTS {table}_chunks")
+            self.connection.commit()
+            self.tables.discard(table)
+
+    def changed(self, collection_name: str, generation: int) -> None:
+        # Called once this process changed the collection and bumped it to generation, the index is still in step
+        # unless another process bumped it in between
+        with self.lock:
+            if self.synced.get(collection_name) == generation - 1:
+                self.synced[collection_name] = generation
+
+    def reconcile(self, collection: Collection, page_size: int = 5000) -> None:
+        generation: int | None = None
+        if self.generations is None:
+            if collection.count() <= self.count(collection.name):
+                return
+        else:
+            generation = self.generations.get(collection.name)
+            if self.synced.get(collection.name) == generation:
+                return
+            if collection.name not in self.synced and collection.count() == self.count(collection.name):
+                # First look at the collection since this process started
+                self.synced[collection.name] = generation
+                return
+
+        logging.info(f"Updating the lexical index of collection {collection.name} from Chroma")
+        with self.lock:
+            table: str = self.ensure_table(collection.name)
+            indexed: set[str] = {row[0] for row in self.connection.execute(f"SELECT chunk_id FROM {table}_chunks")}
+        present: set[str] = set()
+        offset: int = 0
+        while True:
+            page: GetResult = collection.get(include=['documents', 'metadatas'], limit=page_size, offset=offset)
+            present.update(page['ids'])
+            missing: list[int] = [idx for idx, chunk_id in enumerate(page['ids']) if chunk_id not in indexed]
+            self.add(collection.name, [page['ids'][idx] for idx in missing],
+                     [page['documents'][idx] or "" for idx in missing],
+                     [page['metadatas'][idx] or {} for idx in missing])
+            if len(page['ids']) < page_size:
+                break
+            offset += page_size
+        # Chunks this process adds while Chroma is being read were not indexed before and are not dropped
+        self.delete(collection.name, list(indexed - present))
+        if generation is not None:
+            with self.lock:
+                self.synced[collection.name] = generation
@@ -0,0 +1,109 @@
+import asyncio
+import dataclasses
+import math
+from typing import Any, List, Optional
+
+import httpx
+import numpy as np
+from llama_index.bridge.pydantic import PrivateAttr
+from llama_index.callbacks.schema import CBEventType, EventPayload
+from llama_index.llms import OpenAILike
+from llama_index.query_engine import RetrieverQueryEngine
+from llama_index.response.schema import RESPONSE_TYPE
+from llama_index.schema import NodeWithScore, QueryBundle
+from llama_index.vector_stores import ChromaVectorStore
+from llama_index.vector_stores.types import VectorStoreQuery, VectorStoreQueryResult
+from openai import AsyncOpenAI
+
+from compact_vectors import CompactVectors
+from metrics import timed
+
+
+class PooledOpenAILike(OpenAILike):
+    """OpenAILike that gives its async OpenAI client a pooled ``httpx.AsyncClient``.
+
+    OpenAILike hands the same ``http_client`` to both its sync and async OpenAI clients, but the async client
+    only accepts an ``httpx.AsyncClient``.
+    """
+
+    _async_http_client: Optional[httpx.AsyncClient] = PrivateAttr()
+
+    def __init__(self, async_http_client: Optional[httpx.AsyncClient] = None, **kwargs: Any):
+        super().__init__(**kwargs)
+        self._async_http_client = async_http_client
+
+    def _get_aclient(self) -> AsyncOpenAI:
+        if self._aclient is None:
+            credential_kwargs: dict = self._get_credential_kwargs()
+            credential_kwargs["http_client"] = self._async_http_client
+            self._aclient = AsyncOpenAI(**credential_kwargs)
+        return self._aclient
+
+
+class ThreadedChromaVectorStore(ChromaVectorStore):
+    """ChromaVectorStore whose async query runs the blocking Chroma search in a worker thread."""
+
+    async def aquery(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        return await asyncio.to_thread(self.query, query, **kwargs)
+
+    async def async_add(self, nodes: List[Any], **add_kwargs: Any) -> List[str]:
+        return await asyncio.to_thread(self.add, nodes, **add_kwargs)
+
+
+class CompactChromaVectorStore(ThreadedChromaVectorStore):
+    """Vector store for a compact collection: searches the projected index, then re-scores with full vectors."""
+
+    _compact_vectors: CompactVectors = PrivateAttr()
+
+    def __init__(self, compact_vectors: CompactVectors, **kwargs: Any):
+        super().__init__(**kwargs)
+        self._compact_vectors = compact_vectors
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        if query.query_embedding is None:
+            return super().query(query, **kwargs)
+
+        projected: List[float] = self._compact_vectors.project(self._collection,
+                                                               np.array(query.query_embedding)).tolist()
+        candidates: VectorStoreQueryResult = super().query(dataclasses.replace(
+            query, query_embedding=projected,
+            similarity_top_k=query.similarity_top_k * self._compact_vectors.oversample), **kwargs)
+        nodes: dict[str, Any] = dict(zip(candidates.ids, candidates.nodes))
+        rescored: list[tuple[str, float]] = self._compact_vectors.rescore(self._collection, query.query_embedding,
+                                                                          candidates.ids, query.similarity_top_k)
+        return VectorStoreQueryResult(nodes=[nodes[chunk_id] for chunk_id, _ in rescored],
+                                      similarities=[math.exp(-distance) for _, distance in rescored],
+                                      ids=[chunk_id for chunk_id, _ in rescored])
+
+
+class ThreadedRetrieverQueryEngine(RetrieverQueryEngine):
+    """RetrieverQueryEngine whose async path runs the node postprocessors (e.g. a cross-encoder) in a worker thread.
+
+    Retrieval and synthesis are timed as separate stages. A streaming synthesis is only timed until its first
+    token is ready to be streamed.
+    """
+
+    async def aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        nodes: List[NodeWithScore] = await self._retriever.aretrieve(query_bundle)
+        return await asyncio.to_thread(self._apply_node_postprocessors, nodes, query_bundle=query_bundle)
+
+    def _query(self, query_bundle: QueryBundle) -> RESPONSE_TYPE:
+        with self.callback_manager.event(CBEventType.QUERY,
+                                         payload={EventPayload.QUERY_STR: query_bundle.query_str}) as query_event:
+            with timed("retrieval"):
+                nodes: List[NodeWithScore] = self.retrieve(query_bundle)
+            with timed("synthesis"):
+                response: RESPONSE_TYPE = self._response_synthesizer.synthesize(query=query_bundle, nodes=nodes)
+            query_event.on_end(payload={EventPayload.RESPONSE: response})
+        return response
+
+    async def _aquery(self, query_bundle: QueryBundle) -> RESPONSE_TYPE:
+        with self.callback_manager.event(CBEventType.QUERY,
+                                         payload={EventPayload.QUERY_STR: query_bundle.query_str}) as query_event:
+            with timed("retrieval"):
+                nodes: List[NodeWithScore] = await self.aretrieve(query_bundle)
+            with timed("synthesis"):
+                response: RESPONSE_TYPE = await self._response_synthesizer.asynthesize(query=query_bundle,
+                                                                                       nodes=nodes)
+            query_event.on_end(payload={EventPayload.RESPONSE: response})
+        return response
@@ -1,16 +1,29 @@
+import functools
+import json
 import logging
 import os
 import sys
 import threading
-from typing import List
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable, Iterator, List
 
 import uvicorn
 from dotenv import load_dotenv
-from fastapi import FastAPI, UploadFile, HTTPException, Query
+from fastapi import FastAPI, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, generate_latest
 from pydantic import BaseModel, Field
 
-from document_store import DocumentStore, UniqueDocument
+from document_store import CollectionExistsError, CollectionNotFoundError, CollectionStats, DocumentStore, \
+    RetrievalMode, UniqueDocument
+from embeddings import EmbeddingCacheStats
+from hnsw import HnswConfig, IndexStats, RecallReport
+from jobs import DeadLetter, IngestionJob, IngestionQueueType, IngestionScheduler, IngestionTask, QueueFullError, \
+    SqliteIngestionQueue
+from metrics import STARTUP_SECONDS, StateCollector, process_started_at, request_timings, server_timing_header
+from spool import MalformedUploadError, SpoolFullError, UploadSpool, is_archive
 
 path = os.getcwd()
 path = os.path.join(path, ".env")
@@ -18,11 +31,88 @@ load_dotenv(path)
 
 debug = False
 
+# Startup is timed from process start where the platform reports it, so imports are included
+started_at: float = process_started_at() or time.time()
+startup_seconds: dict[str, float] = {}
+
+
+def warm_up() -> None:
+    try:
+        doc_store.warm_up()
+    except Exception as e:
+        logging.error(f"Warm-up failed, the app will not report ready.  {e}")
+        return
+    startup_seconds["ready"] = round(time.time() - started_at, 3)
+    STARTUP_SECONDS.labels(phase="ready").set(startup_seconds["ready"])
+    logging.info(f"Ready to serve queries {startup_seconds['ready']}s after the process started")
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI) -> AsyncIterator[None]:
+    # Query engines are built in the background so /healthz answers while they are
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+    if ingestion_queue_type is IngestionQueueType.SQLITE:
+        removed: int = upload_spool.remove_stale(ingestion_scheduler.pending_files(), max_age_seconds=3600)
+        if removed > 0:
+            logging.info(f"Removed {removed} spooled uploads that were never queued")
+    ingestion_scheduler.start()
+    yield
+
+
 prefix: str = os.environ['PREFIX'] or ""
-app = FastAPI(root_path=prefix)
+app = FastAPI(root_path=prefix, lifespan=lifespan)
 
 doc_store = DocumentStore()
 
+ingestion_queue_type: IngestionQueueType = IngestionQueueType(os.environ.get('INGESTION_QUEUE') or "sqlite")
+
+server_timing: bool = (os.environ.get('SERVER_TIMING') or "False").lower() == "true"
+
+# With the sqlite queue uploads left in the spool are still queued, and the directory may be shared with the
+# ingestion workers. It defaults to a directory next to the queue so the two are kept on the same volume.
+upload_spool = UploadSpool(
+    directory=os.environ.get('SPOOL_DIRECTORY') or "db/spool",
+    max_inflight_bytes=int(os.environ.get('MAX_INFLIGHT_UPLOAD_BYTES') or 1024 ** 3),
+    shared=ingestion_queue_type is IngestionQueueType.SQLITE,
+    max_archive_expanded_bytes=int(os.environ.get('MAX_ARCHIVE_EXPANDED_BYTES') or 4 * 1024 ** 3),
+    max_archive_members=int(os.environ.get('MAX_ARCHIVE_MEMBERS') or 10000))
+
+
+def keep_spooled(_: str) -> None:
+    # The durable queue keeps uploads in the spool until they won't be retried, then releases them itself
+    pass
+
+
+def release_task(task: IngestionTask) -> None:
+    for _, file_path in task.files:
+        upload_spool.release(file_path)
+
+
+def run_ingestion_task(task: IngestionTask, job: IngestionJob) -> None:
+    release: Callable[[str], None] = \
+        upload_spool.release if ingestion_queue_type is IngestionQueueType.MEMORY else keep_spooled
+    if task.batch:
+        ingest_spooled_files(task.files, task.collection_name, task.incremental, job, release)
+    else:
+        filename, file_path = task.files[0]
+        ingest_spooled_file(file_path, filename, task.collection_name, task.incremental, job, release)
+
+
+def create_ingestion_queue() -> IngestionScheduler | SqliteIngestionQueue:
+    workers: int = int(os.environ.get('INGESTION_WORKERS') or 2)
+    max_queued: int = int(os.environ.get('INGESTION_QUEUE_SIZE') or 100)
+    if ingestion_queue_type is IngestionQueueType.SQLITE:
+        return SqliteIngestionQueue(path=os.environ.get('INGESTION_QUEUE_PATH') or "db/ingestion-queue.sqlite3",
+                                    workers=workers, max_queued=max_queued, run_task=run_ingestion_task,
+                                    release_task=release_task,
+                                    max_attempts=int(os.environ.get('INGESTION_MAX_ATTEMPTS') or 3),
+                                    retry_seconds=int(os.environ.get('INGESTION_RETRY_SECONDS') or 30),
+                                    lease_seconds=int(os.environ.get('INGESTION_LEASE_SECONDS') or 60))
+    return IngestionScheduler(workers=workers, max_queued=max_queued, run_task=run_ingestion_task)
+
+
+ingestion_scheduler: IngestionScheduler | SqliteIngestionQueue = create_ingestion_queue()
+
 origins: list[str] = [
     "http://localhost",
     "http://localhost:3000",
@@ -38,14 +128,63 @@ app.add_middleware(
 )
 
 
+@app.middleware("http")
+async def add_server_timing(request: Request, call_next: Callable) -> Response:
+    if not server_timing:
+        return await call_next(request)
+    timings: List[tuple[str, float]] = []
+    token = request_timings.set(timings)
+    started: float = time.perf_counter()
+    try:
+        response: Response = await call_next(request)
+    finally:
+        request_timings.reset(token)
+    # A streamed response only reports the stages that finished before its headers were sent
+    response.headers["Server-Timing"] = server_timing_header(timings, time.perf_counter() - started)
+    return response
+
+
+def metrics_state() -> dict:
+    queued: int = ingestion_scheduler.queued()
+    cache_hit_ratios: dict[str, float] = {}
+    lookups: int = doc_store.query_cache.hits + doc_store.query_cache.misses
+    cache_hit_ratios["query"] = doc_store.query_cache.hits / lookups if lookups > 0 else 0.0
+    if doc_store.embedding_cache is not None:
+        cache_hit_ratios["embedding"] = doc_store.embedding_cache.stats().hit_ratio
+    return {
+        "queued_ingestions": queued,
+        "running_ingestions": ingestion_scheduler.outstanding() - queued,
+        "cache_hit_ratios": cache_hit_ratios,
+        "collection_chunks": doc_store.collection_chunk_counts(),
+        "loaded_index_bytes": doc_store.indices.loaded(),
+    }
+
+
+REGISTRY.register(StateCollector(metrics_state))
+startup_seconds["import"] = round(time.time() - started_at, 3)
+STARTUP_SECONDS.labels(phase="import").set(startup_seconds["import"])
+
+
 class QueryModel(BaseModel):
     input: str = Field(default=None, examples=["List some key points from the documents."])
     collection_name: str = Field(default="default")
+    compact: bool = Field(default=False, description="Pack the retrieved chunks into as few LLM calls as possible "
+                                                     "instead of refining the answer once per chunk")
+    retrieval_mode: RetrievalMode | None = Field(default=None, description="vector, hybrid or lexical (BM25 only, "
+                                                                           "no embedding call), defaults to "
+                                                                           "RETRIEVAL_MODE")
 
 
 class UploadResponse(BaseModel):
     filename: str
     succeed: bool
+    job_id: str | None = None
+
+
+class BatchUploadResponse(BaseModel):
+    filenames: List[str]
+    succeed: bool
+    job_id: str | None = None
 
 
 class QueryResponse(BaseModel):
@@ -56,34 +195,135 @@ class HealthResponse(BaseModel):
     status: str
 
 
-@app.post("/upload/")
-async def upload(file: UploadFile, collection_name: str = "default") -> UploadResponse:
+class ReadinessResponse(BaseModel):
+    status: str
+    startup_seconds: dict[str, float]
+
+
+def ingest_spooled_file(file_path: str, filename: str, collection_name: str, incremental: bool,
+                        job: IngestionJob, release: Callable[[str], None] = upload_spool.release) -> None:
+    on_parsed: Callable[[], None] = functools.partial(release, file_path)
+    try:
+        # The spooled copy is released as soon as it has been parsed, and in any case once ingestion ends
+        doc_store.load_file(file_path, filename, collection_name, incremental, on_parsed, job=job)
+    finally:
+        on_parsed()
+
+
+def expand_uploads(spooled: List[tuple[str, str]], release: Callable[[str], None],
+                   job: IngestionJob) -> Iterator[tuple[str, str, Callable[[], None]]]:
+    for filename, file_path in spooled:
+        if not is_archive(filename):
+            yield filename, file_path, functools.partial(release, file_path)
+            continue
+        # Members are extracted again if the archive is retried
+        try:
+            for member_name, member_path in upload_spool.expand_archive(file_path, filename):
+                yield member_name, member_path, functools.partial(upload_spool.release, member_path)
+        except Exception as e:
+            # The members it yielded so far are ingested, the archive fails like a file that couldn't be parsed
+            logging.error(f"expand_uploads: Error expanding archive {file_path}.  {e}")
+            job.files += 1
+            job.failed_files[filename] = str(e)
+        release(file_path)
+
+
+def ingest_spooled_files(spooled: List[tuple[str, str]], collection_name: str, incremental: bool,
+                         job: IngestionJob, release: Callable[[str], None] = upload_spool.release) -> None:
+    try:
+        doc_store.load_files(expand_uploads(spooled, release, job), collection_name, incremental, job=job)
+    finally:
+        for _, file_path in spooled:
+            release(file_path)
+
+
+def submit_ingestion(job: IngestionJob, task: IngestionTask) -> IngestionJob:
+    try:
+        job = ingestion_scheduler.submit(job, task)
+    except QueueFullError as e:
+        for _, file_path in task.files:
+            upload_spool.release(file_path)
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "30"})
+    if ingestion_queue_type is not IngestionQueueType.MEMORY:
+        # Any worker may ingest the files, it removes them from the shared spool when it is done
+        for _, file_path in task.files:
+            upload_spool.hand_off(file_path)
+    return job
+
+
+def check_upload_collection(collection_name: str) -> None:
+    # Rejected before the upload is spooled, ingestion creates the collection if AUTO_CREATE_COLLECTIONS is on
+    if not doc_store.auto_create_collections:
+        try:
+            doc_store.get_collection(collection_name)
+        except CollectionNotFoundError as e:
+            raise HTTPException(status_code=404, detail=str(e))
+
+
+def schedule_ingestion(file_path: str, filename: str, collection_name: str, incremental: bool) -> IngestionJob:
+    job: IngestionJob = IngestionJob(filename=filename, collection_name=collection_name)
+    return submit_ingestion(job, IngestionTask(files=[(filename, file_path)], collection_name=collection_name,
+                                               incremental=incremental))
+
+
+def multipart_files_body(field_name: str, multiple: bool) -> dict:
+    # The upload endpoints stream the form into the spool themselves, it is only described for the docs
+    file_schema: dict = {"type": "string", "format": "binary"}
+    return {"requestBody": {"required": True, "content": {"multipart/form-data": {"schema": {
+        "type": "object",
+        "required": [field_name],
+        "properties": {field_name: {"type": "array", "items": file_schema} if multiple else file_schema},
+    }}}}}
+
+
+async def spool_request_files(request: Request, field_name: str) -> List[tuple[str, str]]:
+    try:
+        spooled: List[tuple[str, str]] = await upload_spool.spool_form(request, field_name)
+    except SpoolFullError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "30"})
+    except MalformedUploadError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if len(spooled) == 0:
+        raise HTTPException(status_code=422, detail=f"No file was sent as {field_name}")
+    return spooled
+
+
+@app.post("/upload/", openapi_extra=multipart_files_body("file", multiple=False))
+async def upload(request: Request, collection_name: str = "default", incremental: bool = False) -> UploadResponse:
     try:
-        logging.debug("Received file: " + file.filename)
-        contents: bytes = await file.read()
-        thread = threading.Thread(target=doc_store.load_file_bytes, args=(contents, file.filename, collection_name))
-        thread.start()
-        logging.debug("File load started")
+        check_upload_collection(collection_name)
+        spooled: List[tuple[str, str]] = await spool_request_files(request, "file")
+        if len(spooled) > 1:
+            for _, file_path in spooled:
+                upload_spool.release(file_path)
+            raise HTTPException(status_code=422, detail="Send one file, or use /upload/batch for several")
+        filename, file_path = spooled[0]
+        logging.debug("Received file: " + filename)
+        job: IngestionJob = schedule_ingestion(file_path, filename, collection_name, incremental)
+        logging.debug("File load queued as job " + job.id)
     except HTTPException as e:
         raise HTTPException(
             status_code=e.status_code,
             detail=e.detail,
+            headers=e.headers,
         )
     except Exception as e:
         raise Exception(e)
-    finally:
-        await file.close()
 
-    return UploadResponse(filename=file.filename, succeed=True)
+    return UploadResponse(filename=filename, succeed=True, job_id=job.id)
 
 @app.post("/upload/raw")
-async def upload_raw(data: str, filename: str, collection_name: str = "default") -> UploadResponse:
+async def upload_raw(data: str, filename: str, collection_name: str = "default",
+                     incremental: bool = False) -> UploadResponse:
     try:
         logging.debug("Received raw data: " + filename)
-        contents: bytes = str.encode(data)
-        thread = threading.Thread(target=doc_store.load_file_bytes, args=(contents, filename, collection_name))
-        thread.start()
-        logging.debug("Raw data load started")
+        check_upload_collection(collection_name)
+        try:
+            file_path: str = upload_spool.spool_bytes(str.encode(data), filename)
+        except SpoolFullError as e:
+            raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "30"})
+        job: IngestionJob = schedule_ingestion(file_path, filename, collection_name, incremental)
+        logging.debug("Raw data load queued as job " + job.id)
     except HTTPException as e:
         raise HTTPException(
             status_code=e.status_code,
@@ -92,35 +332,211 @@ async def upload_raw(data: str, filename: str, collection_name: str = "default")
     except Exception as e:
         raise Exception(e)
 
-    return UploadResponse(filename=filename, succeed=True)
+    return UploadResponse(filename=filename, succeed=True, job_id=job.id)
+
+
+@app.post("/upload/batch", openapi_extra=multipart_files_body("files", multiple=True))
+async def upload_batch(request: Request, collection_name: str = "default",
+                       incremental: bool = False) -> BatchUploadResponse:
+    check_upload_collection(collection_name)
+    spooled: List[tuple[str, str]] = await spool_request_files(request, "files")
+    for filename, _ in spooled:
+        logging.debug("Received file: " + filename)
 
+    # Every file, and every file inside an archive, goes through one job so their chunks share embedding batches
+    job: IngestionJob = IngestionJob(filename=spooled[0][0] if len(spooled) == 1 else f"{len(spooled)} files",
+                                     collection_name=collection_name)
+    job = submit_ingestion(job, IngestionTask(files=spooled, collection_name=collection_name,
+                                              incremental=incremental, batch=True))
+    logging.debug("Batch load queued as job " + job.id)
 
-def query_index(value: str, response_mode: str, collection_name: str) -> QueryResponse:
+    return BatchUploadResponse(filenames=[filename for filename, _ in spooled], succeed=True, job_id=job.id)
+
+
+async def query_index(query_data: QueryModel, response_mode: str, response: Response) -> QueryResponse:
     logging.debug("Query received")
-    outside_context = doc_store.query_llamaindex(value, response_mode, collection_name)
-    logging.debug("The returned context is: " + str(outside_context))
+    try:
+        outside_context, cache_hit = await doc_store.aquery_with_cache(query_data.input, response_mode,
+                                                                       query_data.collection_name,
+                                                                       query_data.retrieval_mode)
+    except CollectionNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    response.headers["X-Cache"] = "HIT" if cache_hit else "MISS"
+    logging.debug(f"Returned {len(outside_context or '')} characters of context")
     return QueryResponse(results=outside_context)
 
 
+def refined_response_mode(query_data: QueryModel) -> str:
+    return "compact" if query_data.compact else "refine"
+
+
+def server_sent_events(tokens: Iterator[str]) -> Iterator[str]:
+    for token in tokens:
+        yield f"data: {json.dumps({'token': token})}\n\n"
+    yield "data: [DONE]\n\n"
+
+
 @app.post("/query/refined")
-def query_refined(query_data: QueryModel) -> QueryResponse:
-    return query_index(query_data.input, "refine", query_data.collection_name)
+async def query_refined(query_data: QueryModel, response: Response) -> QueryResponse:
+    return await query_index(query_data, refined_response_mode(query_data), response)
+
+
+@app.post("/query/refined/stream")
+async def query_refined_stream(query_data: QueryModel) -> StreamingResponse:
+    logging.debug("Streaming query received")
+    try:
+        tokens, cache_hit = await doc_store.astream_with_cache(query_data.input, refined_response_mode(query_data),
+                                                               query_data.collection_name, query_data.retrieval_mode)
+    except CollectionNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return StreamingResponse(server_sent_events(tokens), media_type="text/event-stream",
+                             headers={"X-Cache": "HIT" if cache_hit else "MISS"})
 
 
 @app.post("/query/raw")
-def query_raw(query_data: QueryModel) -> QueryResponse:
-    return query_index(query_data.input, "no_text", query_data.collection_name)
+async def query_raw(query_data: QueryModel, response: Response) -> QueryResponse:
+    return await query_index(query_data, "no_text", response)
 
 
 @app.post("/delete/")
 def delete(doc_ids: List[str] = Query(None), collection_name: str = "default") -> None:
     if len(doc_ids) > 0:
-        doc_store.delete_documents(doc_ids, collection_name)
+        try:
+            doc_store.delete_documents(doc_ids, collection_name)
+        except CollectionNotFoundError as e:
+            raise HTTPException(status_code=404, detail=str(e))
+
+
+class CountResponse(BaseModel):
+    count: int
+
+
+def json_array(documents: Iterator[tuple]) -> Iterator[str]:
+    yield "["
+    for idx, (doc_uuid, source, size, chunks, ingested_at) in enumerate(documents):
+        yield ("," if idx > 0 else "") + json.dumps({"uuid": doc_uuid, "source": source, "size": size,
+                                                     "chunks": chunks, "ingested_at": ingested_at})
+    yield "]"
+
+
+@app.get("/list/", response_class=StreamingResponse, responses={
+    200: {
+        "model": List[UniqueDocument],
+        "description": "The documents, streamed as a JSON array",
+        "headers": {
+            "X-Next-Cursor": {
+                "description": "Cursor of the next page, only set when limit is given and another page follows",
+                "schema": {"type": "string"},
+            },
+        },
+    },
+})
+def list(collection_name: str = "default", limit: int | None = Query(None, ge=1), offset: int = Query(0, ge=0),
+         cursor: str | None = None, source_prefix: str | None = None, ingested_after: float | None = None,
+         ingested_before: float | None = None) -> StreamingResponse:
+    try:
+        documents, next_cursor = doc_store.iter_documents(collection_name, limit, offset, cursor, source_prefix,
+                                                          ingested_after, ingested_before)
+    except CollectionNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    headers: dict[str, str] = {} if next_cursor is None else {"X-Next-Cursor": next_cursor}
+    return StreamingResponse(json_array(documents), media_type="application/json", headers=headers)
+
+
+@app.get("/list/count")
+def list_count(collection_name: str = "default", source_prefix: str | None = None,
+               ingested_after: float | None = None, ingested_before: float | None = None) -> CountResponse:
+    try:
+        return CountResponse(count=doc_store.count_documents(collection_name, source_prefix, ingested_after,
+                                                             ingested_before))
+    except CollectionNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+
+@app.get("/jobs/dead-letters")
+def get_dead_letters(collection_name: str | None = None,
+                     limit: int = Query(100, ge=1, le=1000)) -> List[DeadLetter]:
+    # Files that still failed after every attempt, most recent first
+    return ingestion_scheduler.dead_letters(collection_name, limit)
+
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str) -> IngestionJob:
+    job: IngestionJob | None = ingestion_scheduler.get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return job
 
 
-@app.get("/list/")
-def list(collection_name: str = "default") -> list[UniqueDocument]:
-    return doc_store.get_all_documents(collection_name)
+@app.get("/embedding-cache/stats")
+def embedding_cache_stats() -> EmbeddingCacheStats:
+    if doc_store.embedding_cache is None:
+        raise HTTPException(status_code=404, detail="The embedding cache is disabled")
+    return doc_store.embedding_cache.stats()
+
+
+@app.post("/admin/collections/{collection_name}", status_code=201)
+def create_collection(collection_name: str, hnsw_config: HnswConfig | None = None,
+                      compact_dimensions: int | None = Query(None, ge=0)) -> IndexStats:
+    # Index parameters can only be chosen when a collection is created, unset ones fall back to the HNSW_* settings
+    # and COMPACT_DIMENSIONS (0 keeps full vectors in memory)
+    try:
+        doc_store.create_collection(collection_name, hnsw_config, get_or_create=False,
+                                    compact_dimensions=compact_dimensions)
+    except CollectionExistsError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return doc_store.index_stats(collection_name)
+
+
+@app.get("/admin/collections")
+def list_collections() -> List[CollectionStats]:
+    return doc_store.list_collections()
+
+
+@app.get("/admin/collections/{collection_name}")
+def get_collection_stats(collection_name: str) -> CollectionStats:
+    try:
+        return doc_store.collection_stats(collection_name)
+    except CollectionNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+
+@app.delete("/admin/collections/{collection_name}", status_code=204)
+def delete_collection(collection_name: str) -> None:
+    # Drops the collection with its documents, indices, cached engines and cached responses
+    try:
+        doc_store.delete_collection(collection_name)
+    except CollectionNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+
+@app.get("/admin/collections/{collection_name}/index")
+def get_index_stats(collection_name: str) -> IndexStats:
+    try:
+        return doc_store.index_stats(collection_name)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+
+@app.post("/admin/collections/{collection_name}/index/recall")
+def check_index_recall(collection_name: str, samples: int = Query(20, ge=1, le=1000),
+                       top_k: int = Query(10, ge=1, le=1000),
+                       search_ef: List[int] = Query(None, description="search_ef values to measure, defaults to "
+                                                                      "the collection's own")) -> RecallReport:
+    try:
+        return doc_store.check_recall(collection_name, samples, top_k, search_ef or [])
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+
+@app.get("/metrics")
+def metrics() -> Response:
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
 
 
 @app.get("/healthz", status_code=200)
@@ -128,6 +544,15 @@ def healthz() -> HealthResponse:
     return HealthResponse(status="ok")
 
 
+@app.get("/readyz", status_code=200)
+def readyz(response: Response) -> ReadinessResponse:
+    # Queries work before the warm-up finishes, the first ones just wait for what it would have built
+    if not doc_store.ready.is_set():
+        response.status_code = 503
+        return ReadinessResponse(status="starting", startup_seconds=startup_seconds)
+    return ReadinessResponse(status="ready", startup_seconds=startup_seconds)
+
+
 if __name__ == '__main__':
     args = sys.argv[1:]
 
@@ -136,4 +561,6 @@ if __name__ == '__main__':
         
     logging.basicConfig(level=logging.DEBUG)
 
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=False, log_level="debug")
+    # Passing the app itself rather than "main:app" keeps uvicorn from importing this module a second time, which
+    # would register the metrics collector twice
+    uvicorn.run(app, host="0.0.0.0", port=8000, reload=False, log_level="debug")
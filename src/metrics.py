@@ -0,0 +1,82 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Iterator
+
+from prometheus_client import PROCESS_COLLECTOR, Gauge, Histogram
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.registry import Collector
+
+STAGE_SECONDS: Histogram = Histogram(
+    "rag_stage_duration_seconds", "Time spent in each stage of the ingestion and query pipelines", ["stage"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120))
+
+STARTUP_SECONDS: Gauge = Gauge("rag_startup_seconds", "Seconds from process start until the app was imported and "
+                                                     "until it was ready to serve queries", ["phase"])
+
+# Stage timings of the request being handled, set by the Server-Timing middleware. The list is shared by every
+# task and worker thread the request starts, since they run in copies of its context.
+request_timings: ContextVar[list[tuple[str, float]] | None] = ContextVar("request_timings", default=None)
+
+
+def observe_stage(stage: str, seconds: float) -> None:
+    STAGE_SECONDS.labels(stage=stage).observe(seconds)
+    timings: list[tuple[str, float]] | None = request_timings.get()
+    if timings is not None:
+        timings.append((stage, seconds))
+
+
+@contextmanager
+def timed(stage: str) -> Iterator[None]:
+    started: float = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - started)
+
+
+def process_started_at() -> float | None:
+    # Read from /proc by the process collector, so it is only known on Linux
+    for family in PROCESS_COLLECTOR.collect():
+        if family.name == "process_start_time_seconds":
+            return family.samples[0].value
+    return None
+
+
+def server_timing_header(timings: list[tuple[str, float]], total: float) -> str:
+    # Stages that ran more than once in a request (e.g. embedding batches) are summed
+    durations: dict[str, float] = {}
+    for stage, seconds in timings:
+        durations[stage] = durations.get(stage, 0) + seconds
+    durations["total"] = total
+    return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in durations.items())
+
+
+class StateCollector(Collector):
+    """Reports gauges read from the running app at scrape time: ingestion backlog, cache hit ratios and the
+    number of chunks and loaded index size of each collection."""
+
+    def __init__(self, read_state: Callable[[], dict]):
+        self.read_state = read_state
+
+    def collect(self) -> Iterator[GaugeMetricFamily]:
+        state: dict = self.read_state()
+        yield GaugeMetricFamily("rag_ingestion_queue_depth", "Ingestion jobs waiting for a worker",
+                                value=state["queued_ingestions"])
+        yield GaugeMetricFamily("rag_ingestions_in_flight", "Ingestion jobs being parsed or embedded",
+                                value=state["running_ingestions"])
+        cache_ratios: GaugeMetricFamily = GaugeMetricFamily("rag_cache_hit_ratio", "Hits over lookups of each cache",
+                                                            labels=["cache"])
+        for cache, ratio in state["cache_hit_ratios"].items():
+            cache_ratios.add_metric([cache], ratio)
+        yield cache_ratios
+        chunks: GaugeMetricFamily = GaugeMetricFamily("rag_collection_chunks", "Chunks stored in each collection",
+                                                      labels=["collection"])
+        for collection_name, count in state["collection_chunks"].items():
+            chunks.add_metric([collection_name], count)
+        yield chunks
+        loaded: GaugeMetricFamily = GaugeMetricFamily("rag_loaded_index_bytes", "Estimated memory of each collection "
+                                                      "index loaded in memory", labels=["collection"])
+        for collection_name, size in state["loaded_index_bytes"].items():
+            loaded.add_metric([collection_name], size)
+        yield loaded
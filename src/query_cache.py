@@ -0,0 +1,71 @@
+import threading
+import time
+from collections import OrderedDict
+
+from generations import CollectionGenerations
+
+
+def normalize_query(query_text: str) -> str:
+    return " ".join(query_text.split()).casefold()
+
+
+class QueryCache:
+    """LRU cache of query responses with a TTL, invalidated per collection.
+
+    Each collection has a generation counter that is part of every key. Invalidating a collection bumps
+    its generation, so a query that started before an upload or delete can't store a stale response. With
+    ``shared_generations`` set, keys use the counters every process that changes a collection bumps, read on
+    each lookup.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float, shared_generations: CollectionGenerations | None = None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.shared_generations = shared_generations
+        self.entries: OrderedDict[tuple, tuple[float, str]] = OrderedDict()
+        self.generations: dict[str, int] = {}
+        self.hits: int = 0
+        self.misses: int = 0
+        self.lock: threading.Lock = threading.Lock()
+
+    def key(self, collection_name: str, query_text: str, response_mode: str, top_k: int,
+            retrieval_mode: str = "vector") -> tuple:
+        generation: int = self.generation(collection_name)
+        return collection_name, generation, response_mode, top_k, retrieval_mode, normalize_query(query_text)
+
+    def generation(self, collection_name: str) -> int:
+        if self.shared_generations is not None:
+            return self.shared_generations.get(collection_name)
+        with self.lock:
+            return self.generations.get(collection_name, 0)
+
+    def get(self, key: tuple) -> str | None:
+        with self.lock:
+            entry: tuple[float, str] | None = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: tuple, response: str) -> None:
+        if self.max_entries <= 0:
+            return
+        collection_name, generation = key[0], key[1]
+        if generation != self.generation(collection_name):
+            return
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl_seconds, response)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, collection_name: str) -> None:
+        # With shared generations, the caller bumps the shared one before invalidating
+        with self.lock:
+            self.generations[collection_name] = self.generations.get(collection_name, 0) + 1
+            for key in [key for key in self.entries if key[0] == collection_name]:
+                del self.entries[key]
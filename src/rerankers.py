@@ -0,0 +1,50 @@
+from typing import Callable, List, Optional
+
+from llama_index.bridge.pydantic import Field, PrivateAttr
+from llama_index.embeddings.base import BaseEmbedding
+from llama_index.indices.query.embedding_utils import get_top_k_mmr_embeddings
+from llama_index.postprocessor.types import BaseNodePostprocessor
+from llama_index.schema import NodeWithScore, QueryBundle
+
+
+class MMRRerank(BaseNodePostprocessor):
+    """Keeps the ``top_n`` candidates chosen by maximal marginal relevance, trading relevance for diversity.
+
+    Candidate embeddings are looked up by node ID, the query embedding is the one the vector retriever already
+    computed and is only embedded here when retrieval was lexical.
+    """
+
+    top_n: int = Field(description="Number of nodes to keep")
+    mmr_threshold: float = Field(description="Weight of relevance against diversity, 1 ignores diversity")
+    _lookup_embeddings: Callable[[List[str]], dict] = PrivateAttr()
+    _embed_model: BaseEmbedding = PrivateAttr()
+
+    def __init__(self, lookup_embeddings: Callable[[List[str]], dict], embed_model: BaseEmbedding, top_n: int,
+                 mmr_threshold: float):
+        super().__init__(top_n=top_n, mmr_threshold=mmr_threshold)
+        self._lookup_embeddings = lookup_embeddings
+        self._embed_model = embed_model
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "MMRRerank"
+
+    def _postprocess_nodes(self, nodes: List[NodeWithScore],
+                           query_bundle: Optional[QueryBundle] = None) -> List[NodeWithScore]:
+        if query_bundle is None:
+            raise ValueError("Missing query bundle in extra info.")
+        if len(nodes) == 0:
+            return []
+
+        query_embedding: List[float] = query_bundle.embedding
+        if query_embedding is None:
+            query_embedding = self._embed_model.get_query_embedding(query_bundle.query_str)
+        embeddings: dict = self._lookup_embeddings([node.node.node_id for node in nodes])
+        candidates: List[NodeWithScore] = [node for node in nodes if node.node.node_id in embeddings]
+
+        scores, selected = get_top_k_mmr_embeddings(query_embedding,
+                                                     [list(embeddings[node.node.node_id]) for node in candidates],
+                                                     similarity_top_k=self.top_n,
+                                                     embedding_ids=list(range(len(candidates))),
+                                                     mmr_threshold=self.mmr_threshold)
+        return [NodeWithScore(node=candidates[idx].node, score=score) for score, idx in zip(scores, selected)]
@@ -0,0 +1,62 @@
+import asyncio
+from typing import Callable, List
+
+from llama_index.core.base_retriever import BaseRetriever
+from llama_index.schema import NodeWithScore, QueryBundle, TextNode
+
+from lexical_index import LexicalIndex
+
+# Damps the weight of top ranks in reciprocal rank fusion, 60 is the value from the original paper
+RRF_K: int = 60
+
+
+class LexicalRetriever(BaseRetriever):
+    """Retrieves chunks by BM25 over the collection's lexical index, without embedding the query."""
+
+    def __init__(self, lexical_index: LexicalIndex, collection_name: str, top_k: int,
+                 reconcile: Callable[[], None] | None = None):
+        super().__init__()
+        self.lexical_index = lexical_index
+        self.collection_name = collection_name
+        self.top_k = top_k
+        self.reconcile = reconcile
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        if self.reconcile is not None:
+            self.reconcile()
+        return [NodeWithScore(node=TextNode(id_=chunk_id, text=text, metadata=metadata), score=score)
+                for chunk_id, text, metadata, score in
+                self.lexical_index.search(self.collection_name, query_bundle.query_str, self.top_k)]
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        return await asyncio.to_thread(self._retrieve, query_bundle)
+
+
+def reciprocal_rank_fusion(results: list[List[NodeWithScore]], top_k: int) -> List[NodeWithScore]:
+    scores: dict[str, float] = {}
+    nodes: dict[str, NodeWithScore] = {}
+    for ranked in results:
+        for rank, node in enumerate(ranked):
+            scores[node.node.node_id] = scores.get(node.node.node_id, 0) + 1 / (RRF_K + rank + 1)
+            nodes.setdefault(node.node.node_id, node)
+    fused: list[str] = sorted(scores, key=scores.get, reverse=True)[:top_k]
+    return [NodeWithScore(node=nodes[node_id].node, score=scores[node_id]) for node_id in fused]
+
+
+class HybridRetriever(BaseRetriever):
+    """Fuses vector and lexical results by reciprocal rank, so neither score scale has to be calibrated."""
+
+    def __init__(self, vector_retriever: BaseRetriever, lexical_retriever: LexicalRetriever, top_k: int):
+        super().__init__()
+        self.vector_retriever = vector_retriever
+        self.lexical_retriever = lexical_retriever
+        self.top_k = top_k
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        return reciprocal_rank_fusion([self.vector_retriever.retrieve(query_bundle),
+                                       self.lexical_retriever.retrieve(query_bundle)], self.top_k)
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        results: list[List[NodeWithScore]] = await asyncio.gather(self.vector_retriever.aretrieve(query_bundle),
+                                                                  self.lexical_retriever.aretrieve(query_bundle))
+        return reciprocal_rank_fusion(results, self.top_k)
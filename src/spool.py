@@ -0,0 +1,236 @@
+import asyncio
+import logging
+import os
+import shutil
+import tarfile
+import threading
+import time
+import uuid
+import zipfile
+from typing import BinaryIO, Callable, Iterator
+
+from fastapi import Request
+from multipart.multipart import MultipartParser, parse_options_header
+
+SPOOL_BLOCK_SIZE: int = 1024 * 1024
+ARCHIVE_EXTENSIONS: tuple[str, ...] = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz")
+
+
+def is_archive(file_name: str) -> bool:
+    return file_name.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+def is_archive_metadata(member_name: str) -> bool:
+    # Resource forks and folders that archivers on macOS add next to the real files
+    return member_name.startswith("__MACOSX/") or os.path.basename(member_name).startswith("._")
+
+
+def archive_members(archive_path: str, archive_name: str) -> Iterator[tuple[str, BinaryIO]]:
+    if archive_name.lower().endswith(".zip"):
+        with zipfile.ZipFile(archive_path) as archive:
+            for info in archive.infolist():
+                if info.is_dir() or is_archive_metadata(info.filename):
+                    continue
+                with archive.open(info) as member:
+                    yield info.filename, member
+    else:
+        # Stream mode reads the archive front to back without seeking, whatever its compression
+        with tarfile.open(archive_path, mode="r|*") as archive:
+            for info in archive:
+                if not info.isfile() or is_archive_metadata(info.name):
+                    continue
+                yield info.name, archive.extractfile(info)
+
+
+class SpoolFullError(Exception):
+    pass
+
+
+class MalformedUploadError(Exception):
+    pass
+
+
+class ArchiveTooLargeError(Exception):
+    pass
+
+
+class UploadSpool:
+    """Directory that uploads are streamed into, block by block, until ingestion has parsed them.
+
+    The total size of the files this process spooled that haven't been released yet is capped by
+    ``max_inflight_bytes``. With a shared ingestion queue the directory is shared too and files are handed off to
+    whichever worker ingests them, their bytes stay counted until the file has been removed from the spool.
+    Archives are expanded into the spool too, up to ``max_archive_expanded_bytes`` and ``max_archive_members``.
+    """
+
+    def __init__(self, directory: str, max_inflight_bytes: int, shared: bool = False,
+                 max_archive_expanded_bytes: int = 4 * 1024 ** 3, max_archive_members: int = 10000):
+        self.directory = directory
+        self.max_inflight_bytes = max_inflight_bytes
+        self.max_archive_expanded_bytes = max_archive_expanded_bytes
+        self.max_archive_members = max_archive_members
+        self.inflight_bytes: int = 0
+        self.reserved: dict[str, int] = {}
+        self.handed_off: set[str] = set()
+        self.lock: threading.Lock = threading.Lock()
+
+        if not shared:
+            # Anything left behind belongs to uploads from a previous process that will never be ingested
+            shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory, exist_ok=True)
+
+    def new_path(self, file_name: str) -> str:
+        _, file_extension = os.path.splitext(file_name)
+        return os.path.join(self.directory, f"{uuid.uuid4()}{file_extension}")
+
+    def reserve(self, path: str, size: int) -> None:
+        with self.lock:
+            if self.inflight_bytes + size > self.max_inflight_bytes:
+                self.forget_removed()
+            if self.inflight_bytes + size > self.max_inflight_bytes:
+                raise SpoolFullError(f"Too many upload bytes waiting for ingestion "
+                                     f"({self.inflight_bytes} of {self.max_inflight_bytes})")
+            self.inflight_bytes += size
+            self.reserved[path] = self.reserved.get(path, 0) + size
+
+    def forget_removed(self) -> None:
+        # Another process may have ingested and removed a handed off file, its bytes aren't waiting anymore
+        for path in [path for path in self.handed_off if not os.path.exists(path)]:
+            self.handed_off.discard(path)
+            self.inflight_bytes -= self.reserved.pop(path, 0)
+
+    async def spool_form(self, request: Request, field_name: str) -> list[tuple[str, str]]:
+        """Streams the files sent as ``field_name`` in a multipart/form-data request body into the spool.
+
+        Returns (file name, spooled path) for each of them. The body is parsed as it arrives, so each file is
+        written once, straight into the spool directory and against ``max_inflight_bytes``. Other fields are
+        skipped.
+        """
+        content_type, params = parse_options_header(request.headers.get("content-type", ""))
+        if content_type != b"multipart/form-data" or b"boundary" not in params:
+            raise MalformedUploadError("Expected a multipart/form-data body")
+
+        # The parser calls back synchronously, the events it produced are written out after each chunk
+        events: list[tuple[str, bytes | dict[bytes, bytes]]] = []
+        header_field: bytearray = bytearray()
+        header_value: bytearray = bytearray()
+        headers: dict[bytes, bytes] = {}
+
+        def on_header_end() -> None:
+            headers[bytes(header_field).lower()] = bytes(header_value)
+            header_field.clear()
+            header_value.clear()
+
+        def on_headers_finished() -> None:
+            events.append(("begin", dict(headers)))
+            headers.clear()
+
+        callbacks: dict[str, Callable] = {
+            "on_header_field": lambda data, start, end: header_field.extend(data[start:end]),
+            "on_header_value": lambda data, start, end: header_value.extend(data[start:end]),
+            "on_header_end": on_header_end,
+            "on_headers_finished": on_headers_finished,
+            "on_part_data": lambda data, start, end: events.append(("data", data[start:end])),
+            "on_part_end": lambda: events.append(("end", b"")),
+        }
+        parser: MultipartParser = MultipartParser(params[b"boundary"], callbacks)
+        spooled: list[tuple[str, str]] = []
+        spooled_file: BinaryIO | None = None
+        try:
+            async for chunk in request.stream():
+                try:
+                    parser.write(chunk)
+                except ValueError as e:
+                    raise MalformedUploadError(f"Malformed multipart/form-data body.  {e}")
+                for event, data in events:
+                    if event == "begin":
+                        _, options = parse_options_header(data.get(b"content-disposition", b""))
+                        if options.get(b"name") == field_name.encode() and options.get(b"filename"):
+                            filename: str = options[b"filename"].decode("utf-8", errors="replace")
+                            spooled.append((filename, self.new_path(filename)))
+                            spooled_file = open(spooled[-1][1], "wb")
+                    elif event == "data" and spooled_file is not None:
+                        self.reserve(spooled[-1][1], len(data))
+                        await asyncio.to_thread(spooled_file.write, data)
+                    elif event == "end" and spooled_file is not None:
+                        spooled_file.close()
+                        spooled_file = None
+                events.clear()
+            if spooled_file is not None:
+                raise MalformedUploadError("The multipart/form-data body ended in the middle of a file")
+        except BaseException:
+            if spooled_file is not None:
+                spooled_file.close()
+            for _, path in spooled:
+                self.release(path)
+            raise
+        return spooled
+
+    def spool_bytes(self, contents: bytes, file_name: str) -> str:
+        path: str = self.new_path(file_name)
+        try:
+            self.reserve(path, len(contents))
+            with open(path, "wb") as spooled_file:
+                spooled_file.write(contents)
+        except BaseException:
+            self.release(path)
+            raise
+        return path
+
+    def expand_archive(self, archive_path: str, archive_name: str) -> Iterator[tuple[str, str]]:
+        """Yields (member name, spooled path) for each file in a zip or tar archive, one member at a time.
+
+        Each member is copied out in blocks and removed once the caller moves on to the next one, so at most one
+        member is on disk next to the archive. Its bytes are reserved against ``max_inflight_bytes`` as they are
+        copied, and the expansion stops with an ``ArchiveTooLargeError`` once the archive has more members or
+        expands to more bytes than allowed, whatever sizes its headers claim.
+        """
+        members: int = 0
+        expanded_bytes: int = 0
+        for member_name, member in archive_members(archive_path, archive_name):
+            members += 1
+            if members > self.max_archive_members:
+                raise ArchiveTooLargeError(f"{archive_name} has more than {self.max_archive_members} files")
+            path: str = self.new_path(member_name)
+            try:
+                with open(path, "wb") as spooled_file:
+                    while len(block := member.read(SPOOL_BLOCK_SIZE)) > 0:
+                        expanded_bytes += len(block)
+                        if expanded_bytes > self.max_archive_expanded_bytes:
+                            raise ArchiveTooLargeError(f"{archive_name} expands to more than "
+                                                       f"{self.max_archive_expanded_bytes} bytes")
+                        self.reserve(path, len(block))
+                        spooled_file.write(block)
+                yield member_name, path
+            finally:
+                self.release(path)
+
+    def hand_off(self, path: str) -> None:
+        # The file stays until the worker that ingests it releases it, its bytes are counted until then
+        with self.lock:
+            self.handed_off.add(path)
+
+    def remove_stale(self, keep: set[str], max_age_seconds: float) -> int:
+        # Removes files no queued task refers to, left behind by uploads interrupted before they were queued
+        cutoff: float = time.time() - max_age_seconds
+        removed: int = 0
+        for entry in os.scandir(self.directory):
+            try:
+                if entry.path in keep or not entry.is_file() or entry.stat().st_mtime > cutoff:
+                    continue
+                os.remove(entry.path)
+                removed += 1
+            except OSError as e:
+                logging.error(f"Could not remove stale spooled upload {entry.path}.  {e}")
+        return removed
+
+    def release(self, path: str) -> None:
+        with self.lock:
+            self.handed_off.discard(path)
+            self.inflight_bytes -= self.reserved.pop(path, 0)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logging.error(f"Could not remove spooled upload {path}.  {e}")
@@ -0,0 +1,35 @@
+import logging
+import signal
+import sys
+import threading
+
+from document_store import StorageBackend
+from jobs import IngestionQueueType
+
+
+def run() -> None:
+    # Ingests uploads that API replicas put on the shared queue, without serving the API itself. Parser processes
+    # import this script again, so the app (and its parser pool) is only created here
+    import main
+
+    if main.ingestion_queue_type is IngestionQueueType.MEMORY:
+        sys.exit("An ingestion worker needs a queue it shares with the API, set INGESTION_QUEUE=sqlite")
+    if main.doc_store.storage_backend is not StorageBackend.HTTP:
+        # A persistent client keeps its own copy of the index in memory, the API would never see ingested chunks
+        sys.exit("An ingestion worker needs a Chroma server it shares with the API, set CHROMA_BACKEND=http")
+
+    stopping: threading.Event = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: stopping.set())
+
+    main.ingestion_scheduler.start()
+    logging.info(f"Ingestion worker {main.ingestion_scheduler.worker_id} started with "
+                 f"{main.ingestion_scheduler.workers} workers")
+    stopping.wait()
+    logging.info("Stopping, waiting for running ingestion jobs to finish")
+    main.ingestion_scheduler.shutdown(wait=True)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    run()
@@ -0,0 +1,283 @@
+"""Ingestion and query benchmarks against the app, with a mock OpenAI-compatible server standing in for the LLM
+and the embedding model, so runs are repeatable on any machine.
+
+    python tests/benchmark.py --output benchmark.json --compare previous.json
+
+Every run starts from an empty database in a temporary directory. The results are a flat map of metric names to
+numbers, e.g. ``query.raw.n1000.c8.p95_ms``, which ``--compare`` diffs against an earlier run. Each chunking
+strategy ingests the same documents into a collection of its own, queries run against the first strategy's.
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+from typing import TYPE_CHECKING
+
+import httpx
+from dotenv import dotenv_values
+
+from mock_llm import MockOpenAIServer
+
+if TYPE_CHECKING:
+    from chunking import TextChunker
+
+REPO_ROOT: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_ints(value: str) -> list[int]:
+    return [int(item) for item in value.split(",") if item.strip() != ""]
+
+
+def max_rss_mb() -> float:
+    # ru_maxrss is the high-water mark of the resident set of this process, in kilobytes on Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def percentile(values: list[float], pct: float) -> float:
+    ordered: list[float] = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered) + 0.5) - 1))]
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Corpus:
+    """Deterministic text documents drawn from a fixed vocabulary, so every run ingests the same bytes."""
+
+    def __init__(self, seed: int, words_per_document: int, vocabulary_size: int = 5000):
+        self.rng: random.Random = random.Random(seed)
+        letters: str = "abcdefghijklmnopqrstuvwxyz"
+        self.vocabulary: list[str] = ["".join(self.rng.choices(letters, k=self.rng.randint(3, 10)))
+                                      for _ in range(vocabulary_size)]
+        self.words_per_document = words_per_document
+
+    def document(self) -> str:
+        words: list[str] = self.rng.choices(self.vocabulary, k=self.words_per_document)
+        return ". ".join(" ".join(words[start:start + 12]) for start in range(0, len(words), 12)) + "."
+
+    def documents(self, documents: int) -> list[str]:
+        return [self.document() for _ in range(documents)]
+
+    @staticmethod
+    def archive(documents: list[str]) -> bytes:
+        buffer: io.BytesIO = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode="w:gz") as archive:
+            for idx, document in enumerate(documents):
+                data: bytes = document.encode()
+                member: tarfile.TarInfo = tarfile.TarInfo(f"doc-{idx:06d}.txt")
+                member.size = len(data)
+                archive.addfile(member, io.BytesIO(data))
+        return buffer.getvalue()
+
+    def query(self) -> str:
+        return " ".join(self.rng.choices(self.vocabulary, k=8))
+
+
+async def wait_for_job(client: httpx.AsyncClient, job_id: str, timeout: float) -> dict:
+    deadline: float = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        job: dict = (await client.get(f"/jobs/{job_id}")).json()
+        if job["status"] in ("done", "failed"):
+            return job
+        await asyncio.sleep(0.05)
+    raise TimeoutError(f"Ingestion job {job_id} did not finish within {timeout} seconds")
+
+
+def bench_chunking(chunker: "TextChunker", documents: list[str]) -> dict[str, float]:
+    from langchain.docstore.document import Document
+
+    pages: list[Document] = [Document(page_content=document, metadata={}) for document in documents]
+    started: float = time.perf_counter()
+    contents, _ = chunker.split_documents(pages)
+    elapsed: float = time.perf_counter() - started
+    return {
+        "seconds": round(elapsed, 4),
+        "chunks": len(contents),
+        "docs_per_sec": round(len(documents) / elapsed, 2),
+        "mean_chunk_chars": round(statistics.fmean(map(len, contents)), 1),
+    }
+
+
+async def bench_ingestion(client: httpx.AsyncClient, documents: list[str], collection_name: str,
+                          timeout: float) -> dict[str, float]:
+    archive: bytes = Corpus.archive(documents)
+    started: float = time.perf_counter()
+    response: httpx.Response = await client.post("/upload/batch", params={"collection_name": collection_name},
+                                                 files=[("files", ("corpus.tar.gz", archive))])
+    response.raise_for_status()
+    job: dict = await wait_for_job(client, response.json()["job_id"], timeout)
+    elapsed: float = time.perf_counter() - started
+    if job["status"] != "done" or job["failed_files"]:
+        raise RuntimeError(f"Ingestion of {len(documents)} documents failed: "
+                           f"{job['error'] or job['failed_files']}")
+    metrics: dict[str, float] = {
+        "seconds": round(elapsed, 3),
+        "chunks": job["chunks"],
+        "docs_per_sec": round(len(documents) / elapsed, 2),
+        "chunks_per_sec": round(job["chunks"] / elapsed, 2),
+    }
+    metrics.update({f"stage.{stage}_seconds": seconds for stage, seconds in job["timings"].items()})
+    return metrics
+
+
+async def bench_queries(client: httpx.AsyncClient, corpus: Corpus, endpoint: str, collection_name: str,
+                        concurrency: int, requests: int) -> dict[str, float]:
+    semaphore: asyncio.Semaphore = asyncio.Semaphore(concurrency)
+    latencies: list[float] = []
+
+    async def query(text: str) -> None:
+        async with semaphore:
+            started: float = time.perf_counter()
+            response: httpx.Response = await client.post(endpoint, json={"input": text,
+                                                                         "collection_name": collection_name})
+            response.raise_for_status()
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    started: float = time.perf_counter()
+    await asyncio.gather(*[query(corpus.query()) for _ in range(requests)])
+    elapsed: float = time.perf_counter() - started
+    return {
+        "p50_ms": round(percentile(latencies, 50), 2),
+        "p95_ms": round(percentile(latencies, 95), 2),
+        "p99_ms": round(percentile(latencies, 99), 2),
+        "mean_ms": round(statistics.fmean(latencies), 2),
+        "requests_per_sec": round(requests / elapsed, 2),
+    }
+
+
+async def run(args: argparse.Namespace, metrics: dict[str, float]) -> None:
+    # Imported here, after the environment and working directory are set up, because importing main starts the app
+    import main
+    from chunking import ChunkingStrategy
+    from ingest import warm_parser
+    metrics["startup.import_max_rss_mb"] = max_rss_mb()
+
+    corpus: Corpus = Corpus(args.seed, args.words_per_document)
+    transport: httpx.ASGITransport = httpx.ASGITransport(app=main.app)
+    async with main.app.router.lifespan_context(main.app), \
+            httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+        while (readiness := await client.get("/readyz")).status_code == 503:
+            await asyncio.sleep(0.05)
+        readiness.raise_for_status()
+        # Both are measured by the app from the start of this process
+        metrics["startup.import_seconds"] = readiness.json()["startup_seconds"]["import"]
+        metrics["startup.ready_seconds"] = readiness.json()["startup_seconds"]["ready"]
+        metrics["startup.max_rss_mb"] = max_rss_mb()
+
+        for documents in args.sizes:
+            texts: list[str] = corpus.documents(documents)
+            for strategy in args.chunking:
+                chunker: TextChunker = warm_parser(main.doc_store.chunk_size, main.doc_store.overlap_size,
+                                                   ChunkingStrategy(strategy))
+                chunking: dict[str, float] = bench_chunking(chunker, texts)
+                metrics.update({f"chunking.{strategy}.n{documents}.{name}": value for name, value in chunking.items()})
+
+                main.doc_store.ingestor.chunking_strategy = ChunkingStrategy(strategy)
+                ingestion: dict[str, float] = await bench_ingestion(client, texts, f"bench-{strategy}-{documents}",
+                                                                    args.ingest_timeout)
+                metrics.update({f"ingest.{strategy}.n{documents}.{name}": value for name, value in ingestion.items()})
+                metrics[f"ingest.{strategy}.n{documents}.max_rss_mb"] = max_rss_mb()
+                print(f"ingested {documents} documents with {strategy} chunking in {ingestion['seconds']}s",
+                      file=sys.stderr)
+
+            collection_name: str = f"bench-{args.chunking[0]}-{documents}"
+            for name, endpoint in (("raw", "/query/raw"), ("refined", "/query/refined")):
+                # The first query builds the collection's query engine, so it is reported on its own
+                first: dict[str, float] = await bench_queries(client, corpus, endpoint, collection_name, 1, 1)
+                metrics[f"query.{name}.n{documents}.first_ms"] = first["p50_ms"]
+                for concurrency in args.concurrency:
+                    results: dict[str, float] = await bench_queries(client, corpus, endpoint, collection_name,
+                                                                    concurrency, args.requests)
+                    metrics.update({f"query.{name}.n{documents}.c{concurrency}.{metric}": value
+                                    for metric, value in results.items()})
+                    print(f"{endpoint} n={documents} c={concurrency}: p50 {results['p50_ms']}ms "
+                          f"p95 {results['p95_ms']}ms p99 {results['p99_ms']}ms", file=sys.stderr)
+            metrics[f"query.n{documents}.max_rss_mb"] = max_rss_mb()
+    metrics["max_rss_mb"] = max_rss_mb()
+
+
+def compare(previous: dict[str, float], current: dict[str, float]) -> str:
+    lines: list[str] = [f"{'metric':<48} {'previous':>12} {'current':>12} {'change':>8}"]
+    for name in sorted(set(previous) | set(current)):
+        before, after = previous.get(name), current.get(name)
+        change: str = f"{(after - before) / before * 100:+.1f}%" if before and after is not None else ""
+        lines.append(f"{name:<48} {'' if before is None else before:>12} {'' if after is None else after:>12} "
+                     f"{change:>8}")
+    return "\n".join(lines)
+
+
+def main() -> None:
+    parser: argparse.ArgumentParser = argparse.ArgumentParser(description=__doc__,
+                                                              formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=parse_ints, default=[100, 1000], help="Documents per collection")
+    parser.add_argument("--concurrency", type=parse_ints, default=[1, 8, 32], help="Concurrent queries")
+    parser.add_argument("--requests", type=int, default=50, help="Queries per endpoint, size and concurrency")
+    parser.add_argument("--chunking", type=lambda value: value.split(","), default=["token", "sentence"],
+                        help="Chunking strategies to ingest with")
+    parser.add_argument("--words-per-document", type=int, default=400)
+    parser.add_argument("--llm-latency", type=float, default=0.02, help="Seconds the mock LLM takes to answer")
+    parser.add_argument("--embedding-dimensions", type=int, default=384)
+    parser.add_argument("--ingest-timeout", type=float, default=1800)
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--compare", help="Results of an earlier run to compare with")
+    args: argparse.Namespace = parser.parse_args()
+
+    server: MockOpenAIServer = MockOpenAIServer(latency=args.llm_latency,
+                                                dimensions=args.embedding_dimensions).start()
+    # Settings the benchmark doesn't pin come from the environment, then .env.example
+    for name, value in dotenv_values(os.path.join(REPO_ROOT, ".env.example")).items():
+        os.environ.setdefault(name, value or "")
+    os.environ.update({
+        "OPENAI_API_BASE": server.api_base,
+        "SSL_VERIFICATION": "False",
+        # Caches would turn repeated work into lookups, the benchmark measures the work itself
+        "EMBEDDING_CACHE_MAX_ENTRIES": "0",
+        "QUERY_CACHE_MAX_ENTRIES": "0",
+        "WARM_COLLECTIONS": "",
+    })
+
+    metrics: dict[str, float] = {}
+    with tempfile.TemporaryDirectory(prefix="rag-benchmark-") as workdir:
+        # The app keeps its database and spool under the working directory, the tokenizer cache is shared
+        tokenizer_cache: str = os.path.join(REPO_ROOT, "tokenizer-cache")
+        if os.path.isdir(tokenizer_cache):
+            os.symlink(tokenizer_cache, os.path.join(workdir, "tokenizer-cache"))
+        os.chdir(workdir)
+        sys.path.insert(0, os.path.join(REPO_ROOT, "src"))
+        asyncio.run(run(args, metrics))
+    server.shutdown()
+
+    results: dict = {
+        "git_commit": git_commit(),
+        "timestamp": time.time(),
+        "python": sys.version.split()[0],
+        "config": {name: value for name, value in vars(args).items() if name not in ("output", "compare")},
+        "metrics": metrics,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+    if args.compare:
+        with open(args.compare) as f:
+            print(compare(json.load(f)["metrics"], metrics))
+
+
+if __name__ == "__main__":
+    main()
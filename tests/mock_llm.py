@@ -0,0 +1,81 @@
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+
+def hash_embedding(text: str, dimensions: int) -> list[float]:
+    # Bag of hashed words, so texts that share words are close without any model
+    vector = np.zeros(dimensions, dtype=np.float32)
+    for word in text.lower().split():
+        digest: bytes = hashlib.sha256(word.encode()).digest()
+        vector[int.from_bytes(digest[:4], "little") % dimensions] += 1 if digest[4] % 2 == 0 else -1
+    norm: float = float(np.linalg.norm(vector))
+    return (vector / norm if norm > 0 else vector).tolist()
+
+
+class MockOpenAIHandler(BaseHTTPRequestHandler):
+    server: "MockOpenAIServer"
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+    def do_POST(self) -> None:
+        body: dict = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if self.path.endswith("/embeddings"):
+            time.sleep(self.server.embedding_latency)
+            inputs: list[str] = body["input"] if isinstance(body["input"], list) else [body["input"]]
+            self.send_json({"object": "list", "model": body.get("model"), "data": [
+                {"object": "embedding", "index": idx, "embedding": hash_embedding(text, self.server.dimensions)}
+                for idx, text in enumerate(inputs)]})
+            return
+
+        time.sleep(self.server.latency)
+        if body.get("stream"):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.end_headers()
+            for token in self.server.answer.split(" "):
+                chunk: dict = {"id": "mock", "object": "chat.completion.chunk", "created": 0, "model": body["model"],
+                               "choices": [{"index": 0, "delta": {"role": "assistant", "content": token + " "},
+                                            "finish_reason": None}]}
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            self.wfile.write(b"data: [DONE]\n\n")
+            return
+        self.send_json({"id": "mock", "object": "chat.completion", "created": 0, "model": body["model"],
+                        "choices": [{"index": 0, "message": {"role": "assistant", "content": self.server.answer},
+                                     "finish_reason": "stop"}],
+                        "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}})
+
+    def send_json(self, payload: dict) -> None:
+        data: bytes = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class MockOpenAIServer(ThreadingHTTPServer):
+    """OpenAI-compatible chat completions and embeddings that answer after a fixed delay, for benchmarks."""
+
+    daemon_threads = True
+
+    def __init__(self, latency: float = 0.0, dimensions: int = 384, answer: str = "This is a mock answer.",
+                 embedding_latency: float = 0.0):
+        super().__init__(("127.0.0.1", 0), MockOpenAIHandler)
+        self.latency = latency
+        self.embedding_latency = embedding_latency
+        self.dimensions = dimensions
+        self.answer = answer
+
+    @property
+    def api_base(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/v1/"
+
+    def start(self) -> "MockOpenAIServer":
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
@@ -1,11 +1,22 @@
+import io
 import logging
 import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
 import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from time import sleep
 
-from chromadb import Collection, GetResult
+import chromadb
+from chromadb import Collection, EphemeralClient, GetResult
 import pytest as pytest
 from fastapi.testclient import TestClient
+from langchain.docstore.document import Document
+from langchain.text_splitter import TokenTextSplitter
 from langchain_community.embeddings import SentenceTransformerEmbeddings
 from langchain_community.vectorstores.chroma import Chroma
 from llama_index import ServiceContext
@@ -13,7 +24,21 @@ from tenacity import retry, wait_random_exponential, stop_after_attempt, stop_af
 
 import main
 from embedding_functions import PassThroughEmbeddingsFunction
-from ingest import update_metadata
+from embeddings import CachedEmbeddingFunction
+from document_registry import DocumentRegistry
+from document_store import CollectionNotFoundError
+from engine_registry import QueryEngineRegistry
+from generations import CollectionGenerations
+from hnsw import HnswConfig, index_stats, unload_vector_segment
+from index_cache import IndexCache
+from jobs import FINISHED_STATUSES, IngestionJob, IngestionTask, JobStatus, QueueFullError, SqliteIngestionQueue
+from chunking import ChunkingStrategy
+from ingest import update_metadata, warm_parser
+from lexical_index import LexicalIndex
+from metrics import server_timing_header
+from mock_llm import MockOpenAIServer
+from query_cache import QueryCache
+from spool import ArchiveTooLargeError, SpoolFullError, UploadSpool
 from main import app
 
 TEST_COLLECTION_NAME = "test"
@@ -69,20 +94,33 @@ def collection():
                                                                   chunk_overlap=main.doc_store.overlap_size)
 
     try:
-        main.doc_store.client.delete_collection(TEST_COLLECTION_NAME)
-    except ValueError:
+        main.doc_store.delete_collection(TEST_COLLECTION_NAME)
+    except CollectionNotFoundError:
         logging.debug("Collection does not exist, so it cannot be deleted.")
+    main.doc_store.create_collection(TEST_COLLECTION_NAME)
 
 
 def test_routes():
     expected_routes = {
         "/docs": ['GET', 'HEAD'],
         "/upload/": ['POST'],
+        "/upload/batch": ['POST'],
         "/query/refined": ['POST'],
+        "/query/refined/stream": ['POST'],
         "/query/raw": ['POST'],
         "/delete/": ['POST'],
         "/list/": ['GET'],
+        "/list/count": ['GET'],
+        "/jobs/{job_id}": ['GET'],
+        "/jobs/dead-letters": ['GET'],
+        "/embedding-cache/stats": ['GET'],
+        "/admin/collections": ['GET'],
+        "/admin/collections/{collection_name}": ['POST'],
+        "/admin/collections/{collection_name}/index": ['GET'],
+        "/admin/collections/{collection_name}/index/recall": ['POST'],
         "/healthz": ['GET'],
+        "/metrics": ['GET'],
+        "/readyz": ['GET'],
     }
 
     actual_routes = app.routes
@@ -101,6 +139,27 @@ def test_healthz():
         assert response.json() == {"status": "ok"}
 
 
+def test_readyz():
+    with TestClient(app) as client:
+        # Warm-up runs in the background from startup
+        assert main.doc_store.ready.wait(timeout=20)
+        response = client.get("/readyz")
+        assert response.status_code == 200
+        assert response.json()["status"] == "ready"
+        assert response.json()["startup_seconds"]["ready"] >= response.json()["startup_seconds"]["import"]
+
+
+def test_metrics():
+    with TestClient(app) as client:
+        response = client.get("/metrics")
+        assert response.status_code == 200
+        assert "rag_ingestion_queue_depth" in response.text
+        assert "rag_cache_hit_ratio{cache=\"query\"}" in response.text
+
+    assert server_timing_header([("embedding", 0.01), ("retrieval", 0.002), ("embedding", 0.02)], 0.05) == \
+        "embedding;dur=30.0, retrieval;dur=2.0, total;dur=50.0"
+
+
 def test_list(collection):
     with TestClient(app) as client:
         response = http_get_list_from_collection(client)
@@ -116,6 +175,73 @@ def test_list(collection):
         assert response.json()[0]["source"] == "test"
 
 
+def test_list_paginated(collection):
+    with TestClient(app) as client:
+        for idx in range(3):
+            add_files_to_collection([f"some-uuid-{idx}"], [15031, 12, 17566],
+                                    update_metadata(f"test-{idx}", f"some-uuid-{idx}", 0, {}))
+
+        response = client.get("/list/", params={"collection_name": TEST_COLLECTION_NAME, "limit": 2})
+        assert response.status_code == 200
+        first_page = response.json()
+        next_cursor = response.headers["X-Next-Cursor"]
+        assert len(first_page) == 2
+
+        response = client.get("/list/", params={"collection_name": TEST_COLLECTION_NAME, "limit": 2, "offset": 2})
+        assert response.status_code == 200
+        assert len(response.json()) == 1
+        assert response.json()[0] not in first_page
+
+        response = client.get("/list/", params={"collection_name": TEST_COLLECTION_NAME, "limit": 2,
+                                                "cursor": next_cursor})
+        assert response.status_code == 200
+        assert len(response.json()) == 1
+        assert response.json()[0] not in first_page
+        assert "X-Next-Cursor" not in response.headers
+
+        response = client.get("/list/", params={"collection_name": TEST_COLLECTION_NAME, "cursor": "not-a-cursor"})
+        assert response.status_code == 400
+
+
+def test_list_many_documents():
+    main.doc_store.get_or_create_collection("list-many")
+    try:
+        # More documents than the registry reads per page, the stream may move between threads in between
+        for idx in range(1200):
+            main.doc_store.registry.add_document("list-many", f"uuid-{idx}", f"doc-{idx}.txt", 10, [], "hash")
+        with TestClient(app) as client:
+            response = client.get("/list/", params={"collection_name": "list-many"})
+            assert response.status_code == 200
+            assert len(response.json()) == 1200
+
+        # Starlette runs each step of a sync stream on whichever worker thread is free
+        rows = main.doc_store.registry.iter_documents("list-many")
+        read = [next(rows) for _ in range(600)]
+        with ThreadPoolExecutor(max_workers=1) as reader:
+            read.extend(reader.submit(lambda: list(rows)).result())
+        assert len(read) == 1200
+    finally:
+        main.doc_store.delete_collection("list-many")
+
+
+def test_list_filtered(collection):
+    with TestClient(app) as client:
+        for source in ["reports/a.pdf", "reports/b.pdf", "notes/c.txt"]:
+            add_files_to_collection([source], [15031, 12, 17566], update_metadata(source, source, 0, {}))
+
+        response = client.get("/list/", params={"collection_name": TEST_COLLECTION_NAME, "source_prefix": "reports/"})
+        assert response.status_code == 200
+        assert sorted(d["source"] for d in response.json()) == ["reports/a.pdf", "reports/b.pdf"]
+
+        response = client.get("/list/count", params={"collection_name": TEST_COLLECTION_NAME})
+        assert response.status_code == 200
+        assert response.json() == {"count": 3}
+
+        response = client.get("/list/count", params={"collection_name": TEST_COLLECTION_NAME,
+                                                     "ingested_after": time.time() + 60})
+        assert response.json() == {"count": 0}
+
+
 def test_delete(collection):
     with TestClient(app) as client:
         add_files_to_collection(["some-uuid"], [15031, 12, 17566],
@@ -144,14 +270,520 @@ def test_upload(collection):
 
             response = http_upload_files_to_collection(client, files)
             assert response.status_code == 200
+            job_id = response.json()["job_id"]
+            assert job_id is not None
 
             sleep(60)
 
+            response = client.get(f"/jobs/{job_id}")
+            assert response.status_code == 200
+            assert response.json()["status"] == "done"
+            assert response.json()["chunks"] > 0
+            assert os.listdir(main.upload_spool.directory) == []
+            assert main.upload_spool.inflight_bytes == 0
+
             response = http_get_list_from_collection(client)
             assert response.status_code == 200
             assert len(response.json()) == 1
 
 
+def test_upload_in_batches(collection):
+    main.doc_store.ingestor.embedding_batch_size = 1
+    try:
+        with open("tests/resources/lorem-ipsum.pdf", "rb") as f:
+            files = {'file': f}
+
+            with TestClient(app) as client:
+                response = http_upload_files_to_collection(client, files)
+                assert response.status_code == 200
+                job_id = response.json()["job_id"]
+
+                sleep(60)
+
+                job = client.get(f"/jobs/{job_id}").json()
+                assert job["status"] == "done"
+                assert job["batches"] == job["chunks"]
+                assert job["batches_done"] == job["batches"]
+                assert job["embedded_chunks"] == job["chunks"]
+    finally:
+        main.doc_store.ingestor.embedding_batch_size = main.doc_store.embedding_batch_size
+
+
+def test_upload_batch(collection):
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w") as zf:
+        zf.writestr("docs/lorem.txt", "Lorem ipsum dolor sit amet.")
+        zf.writestr("docs/ipsum.txt", "Consectetur adipiscing elit.")
+        zf.writestr("__MACOSX/docs/._lorem.txt", "")
+
+    with open("tests/resources/lorem-ipsum.pdf", "rb") as f:
+        files = [("files", ("lorem-ipsum.pdf", f)), ("files", ("docs.zip", archive.getvalue()))]
+
+        with TestClient(app) as client:
+            response = client.post("/upload/batch", files=files, params={"collection_name": TEST_COLLECTION_NAME})
+            assert response.status_code == 200
+            job_id = response.json()["job_id"]
+
+            sleep(60)
+
+            job = client.get(f"/jobs/{job_id}").json()
+            assert job["status"] == "done"
+            assert job["files"] == 3
+            assert job["files_done"] == 3
+            assert job["embedded_chunks"] == job["chunks"]
+            assert os.listdir(main.upload_spool.directory) == []
+
+            response = http_get_list_from_collection(client)
+            assert sorted(doc["source"] for doc in response.json()) == ["docs/ipsum.txt", "docs/lorem.txt",
+                                                                         "lorem-ipsum.pdf"]
+
+
+def test_embedding_cache():
+    cache = CachedEmbeddingFunction(embed_fn=lambda texts: [[float(len(t)), 1.0] for t in texts],
+                                    model_name="test-model", path=os.path.join(tempfile.mkdtemp(), "cache.sqlite3"),
+                                    max_entries=2)
+
+    assert cache(["a", "bb"]) == [[1.0, 1.0], [2.0, 1.0]]
+    assert cache(["bb", "a"]) == [[2.0, 1.0], [1.0, 1.0]]
+    assert cache.stats().hits == 2
+    assert cache.stats().misses == 2
+
+    cache(["ccc"])
+    assert cache.stats().entries == 2
+
+
+def test_query_cache_invalidation():
+    cache = QueryCache(max_entries=10, ttl_seconds=60)
+    key = cache.key(TEST_COLLECTION_NAME, "What is lorem ipsum?", "no_text", 10)
+    cache.put(key, "cached")
+    assert cache.get(cache.key(TEST_COLLECTION_NAME, " what is  LOREM ipsum? ", "no_text", 10)) == "cached"
+    assert cache.get(cache.key(TEST_COLLECTION_NAME, "What is lorem ipsum?", "refine", 10)) is None
+
+    cache.invalidate(TEST_COLLECTION_NAME)
+    assert cache.get(cache.key(TEST_COLLECTION_NAME, "What is lorem ipsum?", "no_text", 10)) is None
+
+    # A response computed before the invalidation must not be stored afterwards
+    cache.put(key, "stale")
+    assert cache.get(cache.key(TEST_COLLECTION_NAME, "What is lorem ipsum?", "no_text", 10)) is None
+
+
+def test_query_cache_shared_invalidation():
+    with tempfile.TemporaryDirectory() as directory:
+        # An upload handled by another process bumps the collection's generation, which invalidates this cache
+        api = QueryCache(max_entries=10, ttl_seconds=60,
+                         shared_generations=CollectionGenerations(os.path.join(directory, "queue.sqlite3")))
+        worker_generations = CollectionGenerations(os.path.join(directory, "queue.sqlite3"))
+        api.put(api.key(TEST_COLLECTION_NAME, "What is lorem ipsum?", "no_text", 10), "cached")
+        assert api.get(api.key(TEST_COLLECTION_NAME, "What is lorem ipsum?", "no_text", 10)) == "cached"
+
+        assert worker_generations.bump(TEST_COLLECTION_NAME) == 1
+        assert api.get(api.key(TEST_COLLECTION_NAME, "What is lorem ipsum?", "no_text", 10)) is None
+
+
+def test_query_engine_registry():
+    built = []
+    registry = QueryEngineRegistry(build_engine=lambda *key: built.append(key) or key, max_entries=2)
+
+    assert registry.get(TEST_COLLECTION_NAME, "refine", 10) is registry.get(TEST_COLLECTION_NAME, "refine", 10)
+    registry.get(TEST_COLLECTION_NAME, "no_text", 10)
+    registry.get("other", "refine", 10)
+    assert len(built) == 3
+
+    # The least recently used engine was evicted and is rebuilt on demand
+    registry.get(TEST_COLLECTION_NAME, "refine", 10)
+    assert len(built) == 4
+
+    registry.evict_collection(TEST_COLLECTION_NAME)
+    registry.get("other", "refine", 10)
+    registry.get(TEST_COLLECTION_NAME, "refine", 10)
+    assert len(built) == 5
+
+
+def test_lexical_index():
+    index = LexicalIndex(path=os.path.join(tempfile.mkdtemp(), "lexical.sqlite3"))
+    index.add(TEST_COLLECTION_NAME, ["a", "b"], ["Replace pump PN-4471 yearly.", "The pump runs quietly."],
+              [{"source": "a.txt"}, {"source": "b.txt"}])
+
+    results = index.search(TEST_COLLECTION_NAME, "Where is PN-4471?", 10)
+    assert [chunk_id for chunk_id, _, _, _ in results] == ["a"]
+    assert results[0][2] == {"source": "a.txt"}
+    assert index.search("other", "pump", 10) == []
+
+    index.delete(TEST_COLLECTION_NAME, ["a"])
+    assert [chunk_id for chunk_id, _, _, _ in index.search(TEST_COLLECTION_NAME, "pump", 10)] == ["b"]
+
+    index.drop_collection(TEST_COLLECTION_NAME)
+    assert index.count(TEST_COLLECTION_NAME) == 0
+
+
+def test_document_registry_shared_reconcile():
+    directory = tempfile.mkdtemp()
+    generations = CollectionGenerations(os.path.join(directory, "queue.sqlite3"))
+    registry = DocumentRegistry(os.path.join(directory, "documents.sqlite3"), generations=generations)
+    shared_collection: Collection = EphemeralClient().get_or_create_collection("shared-registry")
+
+    # A document this process is still ingesting, none of its chunks are in Chroma yet
+    registry.add_document(shared_collection.name, "local", "local.txt", 10, ["local-0"])
+    registry.reconcile(shared_collection)
+    assert registry.count_documents(shared_collection.name) == 1
+
+    # Another process ingests a document, Chroma is only read again once it bumped the generation
+    shared_collection.add(ids=["other-0"], embeddings=[[0.0, 1.0]],
+                          metadatas=[{"uuid": "other", "source": "other.txt"}])
+    registry.reconcile(shared_collection)
+    assert registry.count_documents(shared_collection.name) == 1
+    generations.bump(shared_collection.name)
+    registry.reconcile(shared_collection)
+    assert sorted(row[0] for row in registry.iter_documents(shared_collection.name)) == ["local", "other"]
+
+    # Changes made by this process don't need another read
+    registry.changed(shared_collection.name, generations.bump(shared_collection.name))
+    assert registry.synced[shared_collection.name] == 2
+
+
+def test_chunking():
+    pages = [Document(page_content="Replace pump PN-4471 yearly. " * 40, metadata={"page": 1}),
+             Document(page_content="", metadata={"page": 2}),
+             Document(page_content="# Pumps\nThe pump runs quietly. It is serviced in spring.", metadata={"page": 3})]
+
+    contents, metadatas = warm_parser(50, 10).split_documents(pages)
+    expected = TokenTextSplitter(chunk_size=50, chunk_overlap=10, disallowed_special=()).split_documents(pages)
+    assert contents == [d.page_content for d in expected]
+    assert metadatas == [d.metadata for d in expected]
+
+    contents, metadatas = warm_parser(50, 10, ChunkingStrategy.SENTENCE).split_documents(pages)
+    assert all(content.endswith(".") for content in contents)
+    assert contents[-1] == "# Pumps\nThe pump runs quietly. It is serviced in spring."
+    assert metadatas[-1] == {"page": 3}
+
+
+def test_hnsw_config():
+    defaults = HnswConfig(space="l2", M=16, search_ef=10)
+    config = defaults.merged_with(HnswConfig(space="cosine", search_ef=64))
+    assert config.collection_metadata() == {"hnsw:space": "cosine", "hnsw:M": 16, "hnsw:search_ef": 64}
+    assert HnswConfig().collection_metadata() == {}
+
+
+def test_index_stats_without_internals():
+    # A chromadb version whose internals moved must not break the admin endpoints or index eviction
+    class Segment:
+        pass
+
+    class Collection:
+        id, name = "id", TEST_COLLECTION_NAME
+
+        def count(self):
+            return 3
+
+    class Manager:
+        def get_segment(self, collection_id, scope):
+            return Segment()
+
+    class Server:
+        _manager = Manager()
+
+    class Client:
+        _server = Server()
+
+    assert index_stats(Client(), Collection()).model_dump(exclude_none=True) == {
+        "collection_name": TEST_COLLECTION_NAME, "elements": 3}
+    assert unload_vector_segment(Client(), Collection()) is False
+
+
+def test_index_cache():
+    sizes = {"a": 60, "b": 30, "c": 20}
+    unloaded = []
+    cache = IndexCache(build_index=lambda name: f"index-{name}", measure=sizes.get, unload=unloaded.append,
+                       max_bytes=100)
+
+    assert cache.get("a") == "index-a"
+    assert cache.get("b") == "index-b"
+    cache.touch("a")
+    assert cache.get("c") == "index-c"
+    assert unloaded == ["b"]
+    assert cache.loaded() == {"a": 60, "c": 20}
+
+    cache.discard("c")
+    cache.track("b")
+    assert cache.loaded() == {"a": 60, "b": 30}
+
+
+def test_sqlite_ingestion_queue():
+    path = os.path.join(tempfile.mkdtemp(), "queue.sqlite3")
+    ran = []
+    producer = SqliteIngestionQueue(path=path, workers=0, max_queued=1, run_task=None)
+    worker = SqliteIngestionQueue(path=path, workers=0, max_queued=1, run_task=lambda task, job: ran.append(task))
+    task = IngestionTask(files=[("lorem.txt", "spool/lorem.txt")], collection_name=TEST_COLLECTION_NAME)
+
+    job = producer.submit(IngestionJob(filename="lorem.txt", collection_name=TEST_COLLECTION_NAME), task)
+    with pytest.raises(QueueFullError):
+        producer.submit(IngestionJob(filename="ipsum.txt", collection_name=TEST_COLLECTION_NAME), task)
+
+    # A worker that dies holding a job stops renewing its lease, once it runs out another worker takes the job
+    worker.lease_seconds = -1
+    claimed_job, claimed_task = worker.claim()
+    assert (claimed_job.id, claimed_task) == (job.id, task)
+    assert producer.get_job(job.id).status is JobStatus.PARSING
+    worker.worker_id = "another-worker"
+    worker.lease_seconds = 60
+    claimed_job, claimed_task = worker.claim()
+    assert claimed_job.id == job.id
+
+    worker._run(claimed_job, claimed_task)
+    assert ran == [task]
+    assert producer.get_job(job.id).status is JobStatus.DONE
+    assert producer.outstanding() == 0
+    assert worker.claim() is None
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def assert_finished(job: IngestionJob) -> IngestionJob:
+    assert job.status in FINISHED_STATUSES
+    return job
+
+
+@pytest.fixture
+def shared_chroma():
+    # A stand-in Chroma server and a directory with the queue and spool that ingestion worker processes share
+    if shutil.which("chroma") is None:
+        pytest.skip("The chroma CLI is needed to run a stand-in Chroma server")
+    directory = tempfile.mkdtemp()
+    port = free_port()
+    os.makedirs(os.path.join(directory, "shared", "spool"))
+    # The server writes its log to the working directory
+    chroma_server = subprocess.Popen(["chroma", "run", "--path", os.path.join(directory, "chroma"), "--port", str(port)],
+                                     cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        # The client connects as soon as it is created, which fails until the server is up
+        connect = retry(stop=stop_after_delay(30), wait=wait_fixed(0.5))(chromadb.HttpClient)
+        yield directory, port, connect(host="localhost", port=port)
+    finally:
+        chroma_server.terminate()
+        chroma_server.wait(30)
+
+
+def start_worker(directory: str, port: int, embeddings: MockOpenAIServer, **env: str) -> subprocess.Popen:
+    # The worker runs in its own process, all it shares with the test is Chroma and the queue
+    return subprocess.Popen([sys.executable, os.path.join(os.path.dirname(main.__file__), "worker.py")],
+                            cwd=directory,
+                            env={**os.environ, "CHROMA_BACKEND": "http", "CHROMA_HOST": "localhost",
+                                 "CHROMA_PORT": str(port), "INGESTION_QUEUE": "sqlite",
+                                 "INGESTION_QUEUE_PATH": os.path.join(directory, "shared", "queue.sqlite3"),
+                                 "SPOOL_DIRECTORY": os.path.join(directory, "shared", "spool"),
+                                 "INGESTION_WORKERS": "1", "INGESTION_MAX_ATTEMPTS": "1", "PARSER_WORKERS": "0",
+                                 "OPENAI_API_BASE": embeddings.api_base, **env})
+
+
+def submit_spooled_file(directory: str, collection_name: str) -> tuple[SqliteIngestionQueue, IngestionJob, str]:
+    file_path = os.path.join(directory, "shared", "spool", "lorem.txt")
+    with open(file_path, "w") as file:
+        file.write("Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 50)
+    producer = SqliteIngestionQueue(path=os.path.join(directory, "shared", "queue.sqlite3"), workers=0,
+                                    max_queued=10, run_task=None)
+    job = producer.submit(IngestionJob(filename="lorem.txt", collection_name=collection_name),
+                          IngestionTask(files=[("lorem.txt", file_path)], collection_name=collection_name))
+    return producer, job, file_path
+
+
+@pytest.mark.timeout(180)
+def test_ingestion_worker_process(shared_chroma):
+    directory, port, client = shared_chroma
+    embeddings = MockOpenAIServer().start()
+    worker = start_worker(directory, port, embeddings)
+    try:
+        producer, job, file_path = submit_spooled_file(directory, "worker-process")
+
+        wait_for_job = retry(stop=stop_after_delay(120), wait=wait_fixed(0.5))(
+            lambda: assert_finished(producer.get_job(job.id)))
+        assert wait_for_job().status is JobStatus.DONE
+        assert client.get_collection("worker-process").count() > 0
+        # The spooled upload is released once its job is finished
+        assert not os.path.exists(file_path)
+    finally:
+        worker.terminate()
+        worker.wait(30)
+        embeddings.shutdown()
+
+
+@pytest.mark.timeout(180)
+def test_ingestion_worker_killed(shared_chroma):
+    directory, port, client = shared_chroma
+    # Slow embeddings in small batches, so the worker can be killed while it is adding chunks
+    embeddings = MockOpenAIServer(embedding_latency=0.2).start()
+    settings = {"INGESTION_LEASE_SECONDS": "3", "EMBEDDING_BATCH_SIZE": "2", "EMBEDDING_CONCURRENCY": "1",
+                "CHUNK_SIZE": "16", "OVERLAP_SIZE": "0"}
+    workers = [start_worker(directory, port, embeddings, **settings)]
+    try:
+        producer, job, _ = submit_spooled_file(directory, "worker-killed")
+
+        def assert_adding_chunks() -> None:
+            assert len(producer.get_job(job.id).pending_documents) == 1
+            assert client.get_collection("worker-killed").count() > 0
+
+        retry(stop=stop_after_delay(120), wait=wait_fixed(0.1))(assert_adding_chunks)()
+        workers[0].kill()
+        workers[0].wait(30)
+
+        # Once the dead worker's lease runs out the next one runs the job again, without the first one's chunks
+        workers.append(start_worker(directory, port, embeddings, **settings))
+        finished = retry(stop=stop_after_delay(120), wait=wait_fixed(0.5))(
+            lambda: assert_finished(producer.get_job(job.id)))()
+        assert finished.status is JobStatus.DONE
+        assert (finished.attempts, finished.pending_documents) == (2, {})
+        stored = client.get_collection("worker-killed").get(include=["metadatas"])
+        assert len(stored["ids"]) == finished.chunks
+        assert {metadata["uuid"] for metadata in stored["metadatas"]} == {finished.documents["lorem.txt"]}
+    finally:
+        for worker in workers:
+            worker.kill()
+            worker.wait(30)
+        embeddings.shutdown()
+
+
+def test_ingestion_retries():
+    attempts = []
+    released = []
+
+    def run_task(task, job):
+        attempts.append(dict(job.documents))
+        job.documents["lorem.txt"] = "lorem-uuid"
+        job.failed_files["ipsum.txt"] = f"failed attempt {job.attempts}"
+
+    queue = SqliteIngestionQueue(path=os.path.join(tempfile.mkdtemp(), "queue.sqlite3"), workers=0, max_queued=10,
+                                 run_task=run_task, release_task=released.append, max_attempts=2, retry_seconds=0)
+    task = IngestionTask(files=[("lorem.txt", "spool/lorem.txt"), ("ipsum.txt", "spool/ipsum.txt")],
+                         collection_name=TEST_COLLECTION_NAME, batch=True)
+    job = queue.submit(IngestionJob(filename="2 files", collection_name=TEST_COLLECTION_NAME), task)
+    assert queue.pending_files() == {"spool/lorem.txt", "spool/ipsum.txt"}
+
+    # The first attempt is queued again and its files are kept, the retry knows which documents were ingested
+    queue._run(*queue.claim())
+    assert queue.get_job(job.id).status is JobStatus.QUEUED
+    assert released == []
+    retried_job, retried_task = queue.claim()
+    assert retried_task == task
+    queue._run(retried_job, retried_task)
+    assert attempts == [{}, {"lorem.txt": "lorem-uuid"}]
+    assert released == [task]
+
+    finished = queue.get_job(job.id)
+    assert (finished.status, finished.attempts) == (JobStatus.DONE, 2)
+    [letter] = queue.dead_letters(TEST_COLLECTION_NAME)
+    assert (letter.job_id, letter.files, letter.attempts) == (job.id, {"ipsum.txt": "failed attempt 2"}, 2)
+    assert queue.dead_letters("other") == []
+    assert queue.pending_files() == set()
+
+
+def test_unknown_collection():
+    with TestClient(app) as client:
+        assert client.get("/list/", params={"collection_name": "not-a-collection"}).status_code == 404
+        assert client.get("/list/count", params={"collection_name": "not-a-collection"}).status_code == 404
+        assert client.post("/query/raw", json={"input": "pump", "collection_name": "not-a-collection"}).status_code \
+            == 404
+        assert client.get("/admin/collections/not-a-collection").status_code == 404
+        assert client.delete("/admin/collections/not-a-collection").status_code == 404
+        assert "not-a-collection" not in [c["name"] for c in client.get("/admin/collections").json()]
+
+
+def test_upload_spool_full():
+    spooled = os.listdir(main.upload_spool.directory)
+    # A handed off upload keeps its bytes reserved until whichever process ingests it removes it
+    handed_off = main.upload_spool.spool_bytes(b"x" * 600, "handed-off.txt")
+    main.upload_spool.hand_off(handed_off)
+    main.upload_spool.max_inflight_bytes = main.upload_spool.inflight_bytes + 500
+    try:
+        with TestClient(app) as client:
+            response = client.post("/upload/batch", files=[("files", ("big.txt", b"x" * 1200))])
+            assert response.status_code == 503
+            assert response.headers["Retry-After"] == "30"
+            assert client.post("/upload/", files={"file": ("lorem.txt", b"x" * 600)}).status_code == 503
+            assert client.post("/upload/batch", files=[("other", ("lorem.txt", b"x"))]).status_code == 422
+            assert sorted(os.listdir(main.upload_spool.directory)) == sorted(spooled + [os.path.basename(handed_off)])
+
+            os.remove(handed_off)
+            main.upload_spool.forget_removed()
+            assert handed_off not in main.upload_spool.reserved
+    finally:
+        main.upload_spool.max_inflight_bytes = 1024 ** 3
+        main.upload_spool.release(handed_off)
+
+
+def test_archive_limits():
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w") as zf:
+        zf.writestr("docs/lorem.txt", "Lorem ipsum dolor sit amet.")
+        zf.writestr("docs/oversized.txt", "x" * 5000)
+        zf.writestr("docs/ipsum.txt", "Consectetur adipiscing elit.")
+
+    with tempfile.TemporaryDirectory() as directory:
+        spool = UploadSpool(directory, max_inflight_bytes=10000, max_archive_expanded_bytes=4000)
+        archive_path = spool.spool_bytes(archive.getvalue(), "docs.zip")
+        members = spool.expand_archive(archive_path, "docs.zip")
+        assert next(members)[0] == "docs/lorem.txt"
+        with pytest.raises(ArchiveTooLargeError):
+            next(members)
+        # The member that was being copied out is removed and its reserved bytes given back
+        assert os.listdir(directory) == [os.path.basename(archive_path)]
+        assert spool.inflight_bytes == len(archive.getvalue())
+
+        # Members count against the budget of the whole spool
+        spool.max_archive_expanded_bytes = 10000
+        with pytest.raises(SpoolFullError):
+            list(spool.expand_archive(archive_path, "docs.zip"))
+        spool.max_inflight_bytes = 20000
+        spool.max_archive_members = 2
+        with pytest.raises(ArchiveTooLargeError):
+            list(spool.expand_archive(archive_path, "docs.zip"))
+        assert os.listdir(directory) == [os.path.basename(archive_path)]
+
+    # During ingestion the archive fails like a file that couldn't be parsed, the rest of the batch goes on
+    job = IngestionJob(filename="2 files", collection_name=TEST_COLLECTION_NAME)
+    spooled = [("docs.zip", main.upload_spool.spool_bytes(archive.getvalue(), "docs.zip")),
+               ("lorem.txt", main.upload_spool.spool_bytes(b"Lorem ipsum dolor sit amet.", "lorem.txt"))]
+    main.upload_spool.max_archive_expanded_bytes = 4000
+    try:
+        for _, _, on_parsed in main.expand_uploads(spooled, main.upload_spool.release, job):
+            job.files += 1
+            on_parsed()
+    finally:
+        main.upload_spool.max_archive_expanded_bytes = 4 * 1024 ** 3
+    assert job.files == 3
+    assert list(job.failed_files) == ["docs.zip"]
+    assert main.upload_spool.reserved == {}
+
+
+def test_get_unknown_job():
+    with TestClient(app) as client:
+        response = client.get("/jobs/not-a-job")
+        assert response.status_code == 404
+
+
+def test_upload_incremental(collection):
+    with TestClient(app) as client:
+        params = {"data": "Lorem ipsum dolor sit amet.", "filename": "lorem.txt",
+                  "collection_name": TEST_COLLECTION_NAME, "incremental": True}
+        first_job_id = client.post("/upload/raw", params=params).json()["job_id"]
+
+        sleep(30)
+
+        second_job_id = client.post("/upload/raw", params=params).json()["job_id"]
+
+        sleep(5)
+
+        assert client.get(f"/jobs/{first_job_id}").json()["unchanged"] is False
+        second_job = client.get(f"/jobs/{second_job_id}").json()
+        assert second_job["status"] == "done"
+        assert second_job["unchanged"] is True
+
+        response = http_get_list_from_collection(client)
+        assert len(response.json()) == 1
+
+
 def test_query_raw(collection):
     with open("tests/resources/lorem-ipsum.pdf", "rb") as f:
         files = {'file': f}
@@ -167,3 +799,9 @@ def test_query_raw(collection):
             assert response.status_code == 200
             query_response: main.QueryResponse = response.json()
             assert "\xa0Lorem\xa0ipsum\xa0dolor" in query_response['results']
+            assert response.headers["X-Cache"] == "MISS"
+
+            response = http_post_query_raw_from_collection(client, "  Lorem ipsum  dolor ")
+            assert response.status_code == 200
+            assert response.headers["X-Cache"] == "HIT"
+            assert response.json() == query_response